@@ -0,0 +1,149 @@
+"""
+Parity and latency check of the ONNX query encoders against sentence-transformers.
+
+Encodes a random sample of corpus sentences with the original model and with each
+ONNX export (float32 and int8), then reports per backend the cosine similarity to
+the original embeddings, the overlap of the faiss_index top-k results, load time
+and p50/p99 single-query latency (the way retrieve() encodes a query). The ONNX
+encoders are loaded first, so their load time does not include importing torch.
+Exits with status 1 if any backend's lowest cosine similarity is below --min-cosine.
+
+Usage:
+    python -m benchmarks.encoder_benchmark --onnx-dir onnx_encoder --queries 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.report import write_report
+from metadata_store import MetadataStore
+
+ONNX_MODEL_FILES = ('model.onnx', 'model_int8.onnx')
+
+def sample_sentences(store_directory, n, seed=0):
+    """
+    Returns a random sample of n sentences from a metadata store.
+    """
+    store = MetadataStore(store_directory)
+    rows = np.sort(np.random.default_rng(seed).choice(len(store), size=min(n, len(store)), replace=False))
+    return store.gather(rows, columns=('sentence',))['sentence']
+
+def timed_load(factory):
+    """
+    Returns the encoder built by factory and the seconds it took.
+    """
+    start = time.perf_counter()
+    encoder = factory()
+    return encoder, time.perf_counter() - start
+
+def measure(encoder, texts):
+    """
+    Encodes one text at a time and returns the embeddings with latency percentiles.
+
+    Returns:
+        tuple[np.ndarray, dict]: The (n, dimension) embeddings and a dict of p50/p99 in milliseconds.
+    """
+    embeddings = []
+    latencies = np.empty(len(texts))
+    for i, text in enumerate(texts):
+        start = time.perf_counter()
+        embeddings.append(np.asarray(encoder.encode([text], convert_to_numpy=True, show_progress_bar=False), dtype=np.float32)[0])
+        latencies[i] = time.perf_counter() - start
+    latencies_ms = latencies * 1000
+    return np.stack(embeddings), {
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+    }
+
+def cosine_agreement(reference, candidate):
+    """
+    Cosine similarity between corresponding rows of two embedding matrices.
+    """
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    cosines = (reference * candidate).sum(axis=1)
+    return {
+        'cosine_min': float(cosines.min()),
+        'cosine_p1': float(np.percentile(cosines, 1)),
+        'cosine_mean': float(cosines.mean()),
+    }
+
+def topk_overlap(index, reference, candidate, k):
+    """
+    Mean fraction of the index's top-k results for the reference embeddings that
+    the candidate embeddings also return.
+    """
+    _, expected = index.search(reference, k)
+    _, found = index.search(candidate, k)
+    return float(np.mean([len(np.intersect1d(f, e)) / k for f, e in zip(found, expected)]))
+
+def format_row(row, k):
+    overlap = f"top{k}={row['topk_overlap']:.3f}  " if 'topk_overlap' in row else ""
+    return (
+        f"{row['backend']:<22} cos min={row['cosine_min']:.4f} mean={row['cosine_mean']:.4f}  {overlap}"
+        f"p50={row['p50_ms']:.2f}ms  p99={row['p99_ms']:.2f}ms  load={row['load_s']:.1f}s"
+    )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the ONNX query encoders with sentence-transformers.")
+    parser.add_argument('--model', default='all-MiniLM-L6-v2', help="The sentence-transformers model the index was built with.")
+    parser.add_argument('--onnx-dir', default='onnx_encoder', help="Directory written by export_onnx.py.")
+    parser.add_argument('--metadata-store', default='metadata_store', help="Store to sample sentences from.")
+    parser.add_argument('--index', default='faiss_index', help="Index for the top-k overlap; skipped if missing.")
+    parser.add_argument('--queries', type=int, default=500, help="Number of sampled sentences.")
+    parser.add_argument('--k', type=int, default=10, help="Number of neighbours for the top-k overlap.")
+    parser.add_argument('--min-cosine', type=float, default=0.95, help="Fail if any cosine similarity is below this.")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    texts = sample_sentences(args.metadata_store, args.queries)
+    print(f"{len(texts)} sentences")
+
+    # ONNX first, before torch is imported
+    from onnx_encoder import OnnxEncoder
+    candidates = {}
+    for model_file in ONNX_MODEL_FILES:
+        if os.path.exists(os.path.join(args.onnx_dir, model_file)):
+            encoder, load_seconds = timed_load(lambda: OnnxEncoder(args.onnx_dir, model_file))
+            candidates[f'onnx/{model_file}'] = (encoder, load_seconds)
+
+    def load_reference():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(args.model, device='cpu')
+    reference, reference_load = timed_load(load_reference)
+    reference_embeddings, reference_latency = measure(reference, texts)
+
+    index = None
+    if os.path.exists(args.index):
+        import faiss
+        index = faiss.read_index(args.index)
+
+    rows = [dict(backend='sentence_transformers', **cosine_agreement(reference_embeddings, reference_embeddings),
+                 load_s=reference_load, **reference_latency)]
+    for backend, (encoder, load_seconds) in candidates.items():
+        embeddings, latency = measure(encoder, texts)
+        row = dict(backend=backend, **cosine_agreement(reference_embeddings, embeddings), load_s=load_seconds, **latency)
+        if index is not None:
+            row['topk_overlap'] = topk_overlap(index, reference_embeddings, embeddings, args.k)
+        rows.append(row)
+    if index is not None:
+        rows[0]['topk_overlap'] = 1.0
+
+    for row in rows:
+        print(format_row(row, args.k))
+
+    if args.json_path:
+        write_report(args.json_path, 'encoder', {'sentences': len(texts), 'k': args.k}, rows)
+
+    failed = [row['backend'] for row in rows if row['cosine_min'] < args.min_cosine]
+    if not candidates:
+        print(f"No ONNX export found in {args.onnx_dir}/; run export_onnx.py first.")
+        sys.exit(1)
+    if failed:
+        print(f"Cosine similarity below {args.min_cosine}: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,156 @@
+"""
+Local OpenAI-compatible stub server for load tests.
+
+Serves POST /v1/chat/completions, streamed (server-sent events) or not, with a canned
+response. The first token is sent after --first-token-ms and each further token after
+--token-ms, so the app can be load tested against a model with a known, fixed speed and
+no API key or cost. Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+GET /stats returns the number of requests served and the peak number in flight.
+
+Usage:
+    python -m benchmarks.fake_openai --port 8799 --first-token-ms 300 --token-ms 20
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_RESPONSE = (
+    "The wind carried the smell of rain across the valley, and Mara knew the storm "
+    "would reach the village before nightfall."
+)
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+        self._send_json(200, self.server.stats())
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        self.server.started()
+        try:
+            tokens = self.server.tokens
+            time.sleep(self.server.first_token_seconds)
+            if not request.get("stream"):
+                time.sleep(self.server.token_seconds * (len(tokens) - 1))
+                return self._send_json(200, {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "fake"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+                })
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for position, token in enumerate(tokens):
+                if position:
+                    time.sleep(self.server.token_seconds)
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model", "fake"),
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self._send_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed the stream early, e.g. a cancelled request
+            self.close_connection = True
+        finally:
+            self.server.finished()
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    The stub server, to run in a background thread of a load test.
+
+    Args:
+        port (int): Port to listen on (0 picks a free one).
+        first_token_ms (float): Delay before the first token.
+        token_ms (float): Delay between tokens.
+        response (str): Canned response, streamed word by word.
+    """
+    daemon_threads = True
+    # Many simulated sessions connect at once; the socketserver default backlog is 5
+    request_queue_size = 128
+
+    def __init__(self, port=0, first_token_ms=300, token_ms=20, response=CANNED_RESPONSE):
+        super().__init__(("127.0.0.1", port), FakeOpenAIHandler)
+        self.first_token_seconds = first_token_ms / 1000
+        self.token_seconds = token_ms / 1000
+        self.tokens = [word + " " for word in response.split()]
+        self.tokens[-1] = self.tokens[-1].rstrip()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "in_flight": self.in_flight, "peak_in_flight": self.peak_in_flight}
+
+    def start(self):
+        """
+        Serves in a daemon thread and returns the server.
+        """
+        threading.Thread(target=self.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve canned chat completions with fixed delays.")
+    parser.add_argument('--port', type=int, default=8799, help="Port to listen on.")
+    parser.add_argument('--first-token-ms', type=float, default=300, help="Delay before the first token.")
+    parser.add_argument('--token-ms', type=float, default=20, help="Delay between tokens.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = FakeOpenAIServer(args.port, args.first_token_ms, args.token_ms)
+    print(f"Fake OpenAI server on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
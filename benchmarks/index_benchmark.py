@@ -0,0 +1,178 @@
+"""
+Recall / latency / memory benchmark for the index types in indexing.py.
+
+Uses the embeddings written by preprocessing.py. A random sample of sentences is
+held out as queries, every index type is built over the remaining vectors, and for
+each search setting the benchmark reports recall@k against the exact flat index
+next to p50/p99 single-query latency (the way retrieve() searches) and the memory
+footprint of the index. With --rerank-factors, each setting is also measured with
+exact re-ranking of top_k * factor candidates, as retrieval.py does with
+RETRIEVAL_RERANK_FACTOR.
+
+Usage:
+    python -m benchmarks.index_benchmark --work-dir build --k 10 --nprobe 1 4 16 64 --ef-search 16 64 256
+    python -m benchmarks.index_benchmark --index-types flat fp16 int8 pq --rerank-factors 0 4
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from benchmarks.report import write_report
+from indexing import INDEX_TYPES, build_index, configure_search, index_memory_bytes, rerank
+from preprocessing import load_embeddings
+
+def split_queries(embeddings, n_queries, max_vectors=None, seed=0):
+    """
+    Holds out a random sample of embeddings as queries.
+
+    Args:
+        embeddings (np.ndarray): The corpus embeddings.
+        n_queries (int): Number of queries to hold out.
+        max_vectors (int, optional): Cap on the database size, to benchmark smaller corpora.
+        seed (int): Random seed.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The database and query vectors.
+    """
+    rng = np.random.default_rng(seed)
+    n_total = embeddings.shape[0] if max_vectors is None else min(embeddings.shape[0], max_vectors + n_queries)
+    order = rng.permutation(embeddings.shape[0])[:n_total]
+    queries = np.ascontiguousarray(embeddings[np.sort(order[:n_queries])], dtype=np.float32)
+    database = np.ascontiguousarray(embeddings[np.sort(order[n_queries:])], dtype=np.float32)
+    return database, queries
+
+def recall_at_k(found, truth):
+    """
+    Mean fraction of the true top-k neighbours that were found.
+    """
+    k = truth.shape[1]
+    hits = sum(len(np.intersect1d(f[f >= 0], t)) for f, t in zip(found, truth))
+    return hits / (k * truth.shape[0])
+
+def measure(index, queries, k, rerank_factor=0, database=None):
+    """
+    Searches one query at a time and returns the results with latency percentiles.
+
+    Args:
+        index (faiss.Index): The index to search.
+        queries (np.ndarray): The query vectors.
+        k (int): Number of neighbours per query.
+        rerank_factor (int): If > 0, re-rank k * rerank_factor candidates against database.
+        database (np.ndarray, optional): Full-precision vectors used for re-ranking.
+
+    Returns:
+        tuple[np.ndarray, dict]: The (n_queries, k) result ids and a dict of p50/p99 in milliseconds.
+    """
+    found = np.empty((queries.shape[0], k), dtype=np.int64)
+    latencies = np.empty(queries.shape[0])
+    n_candidates = k * rerank_factor if rerank_factor > 0 else k
+    for i in range(queries.shape[0]):
+        start = time.perf_counter()
+        _, candidates = index.search(queries[i:i + 1], n_candidates)
+        if rerank_factor > 0:
+            _, candidates = rerank(queries[i:i + 1], candidates, database, k)
+        found[i] = candidates[0]
+        latencies[i] = time.perf_counter() - start
+    latencies_ms = latencies * 1000
+    return found, {
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+    }
+
+def search_settings(index_type, nprobe_values, ef_search_values):
+    """
+    Search-time parameter combinations to sweep for an index type.
+    """
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return [{'nprobe': value} for value in nprobe_values]
+    if index_type == 'hnsw':
+        return [{'ef_search': value} for value in ef_search_values]
+    return [{}]
+
+def run_benchmark(database, queries, k, index_types, index_params, nprobe_values, ef_search_values, rerank_factors=(0,)):
+    """
+    Builds each index type once and sweeps its search parameters and re-ranking factors.
+
+    Returns:
+        list[dict]: One row per (index type, search setting).
+    """
+    ground_truth_index = faiss.IndexFlatL2(database.shape[1])
+    ground_truth_index.add(database)
+    _, ground_truth = ground_truth_index.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index = build_index(database, index_type=index_type, **index_params)
+        build_seconds = time.perf_counter() - start
+        memory_mb = index_memory_bytes(index) / 2 ** 20
+
+        for setting in search_settings(index_type, nprobe_values, ef_search_values):
+            configure_search(index, **setting)
+            for rerank_factor in rerank_factors:
+                found, latency = measure(index, queries, k, rerank_factor, database)
+                rows.append(dict(
+                    index_type=index_type,
+                    **setting,
+                    rerank_factor=rerank_factor,
+                    recall=recall_at_k(found, ground_truth),
+                    memory_mb=memory_mb,
+                    build_s=build_seconds,
+                    **latency,
+                ))
+    return rows
+
+def format_row(row, k):
+    setting = ', '.join(f'{key}={row[key]}' for key in ('nprobe', 'ef_search') if key in row)
+    if row['rerank_factor']:
+        setting = ', '.join(filter(None, (setting, f"rerank={row['rerank_factor']}")))
+    return (
+        f"{row['index_type']:<10} {setting:<26} recall@{k}={row['recall']:.3f}  "
+        f"p50={row['p50_ms']:.3f}ms  p99={row['p99_ms']:.3f}ms  "
+        f"memory={row['memory_mb']:.1f}MB  build={row['build_s']:.1f}s"
+    )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark recall@k and query latency of FAISS index types.")
+    parser.add_argument('--work-dir', default='build', help="Work directory of a preprocessing.py build.")
+    parser.add_argument('--k', type=int, default=10, help="Number of neighbours per query.")
+    parser.add_argument('--queries', type=int, default=1000, help="Number of held-out query vectors.")
+    parser.add_argument('--max-vectors', type=int, help="Benchmark on a random subset of the corpus.")
+    parser.add_argument('--index-types', nargs='+', choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument('--nprobe', nargs='+', type=int, default=[1, 4, 16, 64], help="nprobe values to sweep.")
+    parser.add_argument('--ef-search', nargs='+', type=int, default=[16, 64, 256], help="efSearch values to sweep.")
+    parser.add_argument('--rerank-factors', nargs='+', type=int, default=[0],
+                        help="Re-ranking factors to sweep (0 = no re-ranking).")
+    parser.add_argument('--nlist', type=int, help="IVF cells (default 4 * sqrt(n)).")
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--ef-construction', type=int, default=200)
+    parser.add_argument('--pq-m', type=int, default=48)
+    parser.add_argument('--pq-nbits', type=int, default=8)
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    database, queries = split_queries(load_embeddings(args.work_dir), args.queries, args.max_vectors)
+    print(f"{database.shape[0]} vectors, {queries.shape[0]} queries, k={args.k}")
+
+    rows = run_benchmark(
+        database, queries, args.k, args.index_types,
+        index_params={
+            'nlist': args.nlist,
+            'hnsw_m': args.hnsw_m,
+            'ef_construction': args.ef_construction,
+            'pq_m': args.pq_m,
+            'pq_nbits': args.pq_nbits,
+        },
+        nprobe_values=args.nprobe,
+        ef_search_values=args.ef_search,
+        rerank_factors=args.rerank_factors,
+    )
+    for row in rows:
+        print(format_row(row, args.k))
+
+    if args.json_path:
+        write_report(args.json_path, 'index', {'vectors': database.shape[0], 'queries': queries.shape[0], 'k': args.k}, rows)
@@ -0,0 +1,227 @@
+"""
+End-to-end load test of the app with simulated concurrent sessions.
+
+Each simulated session is a Streamlit AppTest of notepad.py running in its own
+process, since AppTest swaps process-wide Streamlit state and only runs one app at a
+time. A session writes into the notepad, then repeatedly sends chat messages (the
+handle_user_input path) and clicks Autocomplete. Every action is a full script
+rerun, as in the browser, and is timed from the interaction to the end of the rerun.
+The sessions load their retrieval resources, then start together. The OpenAI
+requests go to a local fake_openai.py server that streams a canned response at a
+fixed speed, so the results do not depend on the API. Run it from the repository
+root, after preprocessing, so the app finds its index and metadata.
+
+Every session process loads its own retrieval model, index and OpenAI client, so
+OPENAI_MAX_CONCURRENCY applies per session. To load the model once, start
+retrieval_server.py and set RETRIEVAL_SERVER_URL; the sessions inherit it.
+
+Reported per action: count, error rate, throughput and p50/p95/p99 latency, plus the
+p50/p95 of each stage recorded in the request traces (embedding, search, time to
+first token, ...). The fake server's peak number of requests in flight and the
+OpenAI clients' throttling and retry counters, summed over the sessions, are
+reported too.
+
+Usage:
+    python -m benchmarks.load_test --sessions 8 --turns 5 --json load.json
+    python -m benchmarks.load_test --sessions 16 --actions chat --first-token-ms 800 --token-ms 40
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.report import write_report
+
+NOTEPAD_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'notepad.py')
+ACTIONS = ('chat', 'autocomplete')
+API_KEY = "sk-load-test"
+
+STORY_OPENING = "Mara climbed the hill above the village to watch the storm roll in. The first drops of rain began to fall."
+CHAT_MESSAGES = (
+    "What does Mara see from the hill?",
+    "Describe the storm reaching the village.",
+    "How does her brother react to the rain?",
+    "Write the moment the power goes out.",
+)
+
+# OpenAI client counters summed over the session processes
+CLIENT_COUNTERS = ('requests', 'throttled', 'throttled_seconds', 'retries', 'errors')
+
+def run_session(session_number, turns, actions, timeout, start_barrier, reports):
+    """
+    Simulates one user in a child process: loads retrieval, opens the app and writes
+    into the notepad, waits for the other sessions, then performs the actions turns
+    times. Puts (session_number, samples, client_stats, error) on reports, where samples
+    are (action, seconds, trace, error) tuples.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    try:
+        import retrieval
+        retrieval.retrieve("warm up", 1)
+        app = AppTest.from_file(NOTEPAD_PATH, default_timeout=timeout)
+        app.secrets["OPENAI_API_KEY"] = API_KEY
+        app.run()
+        app.text_area(key="notepad").set_value(f"{STORY_OPENING} (Session {session_number}.)").run()
+        start_barrier.wait()
+    except BaseException as e:
+        # release the other sessions rather than leave them waiting for this one
+        start_barrier.abort()
+        reports.put((session_number, [], {}, f"{type(e).__name__}: {e}"))
+        return
+
+    samples = []
+
+    for turn in range(turns):
+        for action in actions:
+            start = time.perf_counter()
+            try:
+                if action == 'chat':
+                    message = CHAT_MESSAGES[turn % len(CHAT_MESSAGES)]
+                    app.chat_input[0].set_value(f"{message} (session {session_number}, turn {turn})").run()
+                else:
+                    next(button for button in app.button if button.key == "autocomplete").click().run()
+                seconds = time.perf_counter() - start
+                failures = [element.value for element in list(app.exception) + list(app.error)]
+                error = str(failures[0]) if failures else None
+            except Exception as e:
+                seconds = time.perf_counter() - start
+                error = f"{type(e).__name__}: {e}"
+            trace = app.session_state["last_trace"] if "last_trace" in app.session_state else None
+            samples.append((action, seconds, trace, error))
+
+    import llm_client
+    reports.put((session_number, samples, llm_client.get_client(API_KEY).stats(), None))
+
+def collect_reports(reports, processes, timeout):
+    """
+    Gathers one report per session process, giving up on sessions whose process
+    exited without one or that have not reported within timeout seconds.
+    """
+    collected = []
+    deadline = time.monotonic() + timeout
+    while len(collected) < len(processes) and time.monotonic() < deadline:
+        try:
+            collected.append(reports.get(timeout=1))
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+    return collected
+
+def summarize(samples, wall_seconds):
+    """
+    Aggregates the samples into one row per action.
+    """
+    rows = []
+    for action in ACTIONS:
+        action_samples = [sample for sample in samples if sample[0] == action]
+        if not action_samples:
+            continue
+        latencies_ms = np.array([seconds for _, seconds, _, _ in action_samples]) * 1000
+        stages = defaultdict(list)
+        for _, _, trace, error in action_samples:
+            if trace is not None and error is None:
+                for recorded in trace["spans"]:
+                    stages[recorded["stage"]].append(recorded["ms"])
+        row = dict(
+            action=action,
+            count=len(action_samples),
+            error_rate=sum(1 for sample in action_samples if sample[3] is not None) / len(action_samples),
+            throughput_per_s=len(action_samples) / wall_seconds,
+            p50_ms=float(np.percentile(latencies_ms, 50)),
+            p95_ms=float(np.percentile(latencies_ms, 95)),
+            p99_ms=float(np.percentile(latencies_ms, 99)),
+        )
+        for stage, durations in sorted(stages.items()):
+            row[f'{stage}_p50_ms'] = float(np.percentile(durations, 50))
+            row[f'{stage}_p95_ms'] = float(np.percentile(durations, 95))
+        rows.append(row)
+    return rows
+
+def format_row(row):
+    return (
+        f"{row['action']:<13} n={row['count']:<4} errors={row['error_rate']:.0%}  {row['throughput_per_s']:.2f}/s  "
+        f"p50={row['p50_ms']:.0f}ms  p95={row['p95_ms']:.0f}ms  p99={row['p99_ms']:.0f}ms"
+    )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test notepad.py with concurrent simulated sessions.")
+    parser.add_argument('--sessions', type=int, default=8, help="Number of concurrent simulated sessions.")
+    parser.add_argument('--turns', type=int, default=5, help="Times each session performs its actions.")
+    parser.add_argument('--actions', nargs='+', choices=ACTIONS, default=list(ACTIONS), help="Actions performed each turn.")
+    parser.add_argument('--first-token-ms', type=float, default=300, help="Fake server delay before the first token.")
+    parser.add_argument('--token-ms', type=float, default=20, help="Fake server delay between tokens.")
+    parser.add_argument('--requests-per-minute', type=float, default=60000,
+                        help="OPENAI_REQUESTS_PER_MINUTE for the run (high, so the app rather than the limiter is measured).")
+    parser.add_argument('--max-concurrency', type=int, help="OPENAI_MAX_CONCURRENCY of each session (default: the app's).")
+    parser.add_argument('--timeout', type=float, default=120, help="Seconds before a script rerun counts as failed.")
+    parser.add_argument('--startup-timeout', type=float, default=600,
+                        help="Seconds the sessions may take to load retrieval and open the app.")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = FakeOpenAIServer(0, args.first_token_ms, args.token_ms).start()
+
+    # Configure the app before the sessions start; they inherit the environment, and
+    # traces go to the report, not traces.jsonl
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ['OPENAI_REQUESTS_PER_MINUTE'] = str(args.requests_per_minute)
+    if args.max_concurrency:
+        os.environ['OPENAI_MAX_CONCURRENCY'] = str(args.max_concurrency)
+    os.environ.setdefault('TRACE_LOG_PATH', '')
+
+    context = multiprocessing.get_context('spawn')
+    start_barrier = context.Barrier(args.sessions + 1)
+    reports = context.Queue()
+    processes = [
+        context.Process(target=run_session, args=(number, args.turns, args.actions, args.timeout, start_barrier, reports))
+        for number in range(args.sessions)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    try:
+        start_barrier.wait(timeout=args.startup_timeout)
+    except threading.BrokenBarrierError:
+        for process in processes:
+            process.terminate()
+        failures = [error for _, _, _, error in collect_reports(reports, processes, 10) if error]
+        raise SystemExit(f"A session failed to start: {failures[0] if failures else 'see the error above'}")
+    print(f"Sessions started in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    collected = collect_reports(reports, processes, args.timeout * args.turns * len(args.actions) + 60)
+    wall_seconds = time.perf_counter() - start
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    samples = [sample for _, session_samples, _, _ in collected for sample in session_samples]
+    client_stats = {counter: sum(stats.get(counter, 0) for _, _, stats, _ in collected) for counter in CLIENT_COUNTERS}
+    missing = args.sessions - len(collected)
+
+    rows = summarize(samples, wall_seconds)
+    print(f"{args.sessions} sessions x {args.turns} turns in {wall_seconds:.1f}s")
+    if missing:
+        print(f"{missing} sessions did not report; their actions are missing from the results")
+    for row in rows:
+        print(format_row(row))
+    server_stats = server.stats()
+    print(f"Fake OpenAI server: {server_stats['requests']} requests, peak {server_stats['peak_in_flight']} in flight")
+    print(f"OpenAI clients: {client_stats['throttled']} throttled ({client_stats['throttled_seconds']:.1f}s), "
+          f"{client_stats['retries']} retries, {client_stats['errors']} errors")
+    server.shutdown()
+
+    if args.json_path:
+        config = {**vars(args), 'wall_s': wall_seconds, 'missing_sessions': missing, 'fake_server': server_stats,
+                  'openai_clients': client_stats}
+        write_report(args.json_path, 'load_test', config, rows)
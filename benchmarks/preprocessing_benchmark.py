@@ -0,0 +1,115 @@
+"""
+Throughput benchmark of the preprocessing pipeline, in sentences per second.
+
+Runs on the first --stories stories of the dataset and measures
+    - text: process_chunk(), splitting stories into cleaned sentence rows,
+    - encode: encode_sentences() for each --batch-sizes value and each --workers value,
+    - pipeline: a complete preprocess_pipeline() build in a temporary directory,
+      including the checkpointed writes, index build and metadata store.
+
+Usage:
+    python -m benchmarks.preprocessing_benchmark --stories 2000 --batch-sizes 64 256 --workers 0 4 --json preprocessing.json
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks.report import write_report
+from indexing import INDEX_TYPES
+from preprocessing import MODEL_NAME, SENTENCES_PER_STORY, encode_sentences, preprocess_pipeline, process_chunk
+
+def timed(function, *args, **kwargs):
+    """
+    Returns the result of a call and the seconds it took.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def benchmark_text(stories):
+    """
+    Times process_chunk() over the stories.
+    """
+    metadata, seconds = timed(process_chunk, stories)
+    return metadata, {'stage': 'text', 'sentences': len(metadata), 'seconds': seconds, 'sentences_per_s': len(metadata) / seconds}
+
+def benchmark_encode(sentences, batch_sizes, worker_counts):
+    """
+    Times encode_sentences() for each batch size and number of encoder processes.
+    """
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(MODEL_NAME, device='cpu')
+    encode_sentences(model, sentences[:64], 64)  # warm up
+
+    rows = []
+    for workers in worker_counts:
+        pool = model.start_multi_process_pool(target_devices=['cpu'] * workers) if workers > 0 else None
+        try:
+            for batch_size in batch_sizes:
+                _, seconds = timed(encode_sentences, model, sentences, batch_size, pool)
+                rows.append({'stage': 'encode', 'batch_size': batch_size, 'workers': workers, 'sentences': len(sentences),
+                             'seconds': seconds, 'sentences_per_s': len(sentences) / seconds})
+        finally:
+            if pool is not None:
+                model.stop_multi_process_pool(pool)
+    return rows
+
+def benchmark_pipeline(stories, batch_size, workers, index_type):
+    """
+    Times a full preprocess_pipeline() build of the stories in a temporary directory.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'stories.csv')
+        stories.to_csv(file_path, index=False)
+        # the pipeline reports every chunk; keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, seconds = timed(
+                preprocess_pipeline, file_path,
+                work_dir=os.path.join(directory, 'build'),
+                index_file=os.path.join(directory, 'faiss_index'),
+                metadata_file=os.path.join(directory, 'metadata.csv'),
+                metadata_store=os.path.join(directory, 'metadata_store'),
+                batch_size=batch_size, workers=workers, fresh=True, index_type=index_type,
+            )
+    sentences = len(stories) * SENTENCES_PER_STORY
+    return {'stage': 'pipeline', 'batch_size': batch_size, 'workers': workers, 'index_type': index_type,
+            'sentences': sentences, 'seconds': seconds, 'sentences_per_s': sentences / seconds}
+
+def format_row(row):
+    setting = ', '.join(f'{key}={row[key]}' for key in ('batch_size', 'workers', 'index_type') if key in row)
+    return f"{row['stage']:<9} {setting:<44} {row['sentences']} sentences in {row['seconds']:.2f}s = {row['sentences_per_s']:.0f} sentences/s"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark preprocessing throughput in sentences per second.")
+    parser.add_argument('file_path', nargs='?', default=os.path.join('datasets', 'ROCStories_winter2017.csv'),
+                        help="Path to the ROCStories CSV.")
+    parser.add_argument('--stories', type=int, default=2000, help="Number of stories to process.")
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[64, 256], help="Encoder batch sizes to measure.")
+    parser.add_argument('--workers', nargs='+', type=int, default=[0], help="Encoder process counts to measure.")
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default='flat', help="Index type of the full pipeline build.")
+    parser.add_argument('--skip-pipeline', action='store_true', help="Only measure the text and encode stages.")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    stories = pd.read_csv(args.file_path, nrows=args.stories)
+    print(f"{len(stories)} stories")
+
+    metadata, text_row = benchmark_text(stories)
+    rows = [text_row]
+    print(format_row(text_row))
+    for row in benchmark_encode(metadata['Sentence'].tolist(), args.batch_sizes, args.workers):
+        rows.append(row)
+        print(format_row(row))
+    if not args.skip_pipeline:
+        rows.append(benchmark_pipeline(stories, max(args.batch_sizes), args.workers[-1], args.index_type))
+        print(format_row(rows[-1]))
+
+    if args.json_path:
+        write_report(args.json_path, 'preprocessing', vars(args), rows)
@@ -0,0 +1,91 @@
+"""
+JSON reports of benchmark runs, and a comparison of two of them.
+
+Every benchmark writes {"benchmark", "run", "config", "results"} with --json, where
+"run" records when and on what the benchmark ran, and "results" is a list of rows of
+metrics. compare() matches the rows of two reports on their non-metric fields (index
+type, top_k, ...) and prints the relative change of each metric.
+
+Usage:
+    python -m benchmarks.report before.json after.json
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+def run_info():
+    """
+    Describes the current run: time, git commit, Python version, platform and CPU count.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def write_report(path, benchmark, config, results):
+    """
+    Writes a benchmark report.
+
+    Args:
+        path (str): The JSON file to write.
+        benchmark (str): Name of the benchmark.
+        config (dict): The settings of the run.
+        results (list[dict]): One row of metrics per measured configuration.
+    """
+    with open(path, 'w') as f:
+        json.dump({'benchmark': benchmark, 'run': run_info(), 'config': config, 'results': results}, f, indent=2)
+
+def _is_metric(value):
+    return isinstance(value, float)
+
+def compare(before, after):
+    """
+    Matches the result rows of two reports and returns the changes of their metrics.
+
+    Args:
+        before (dict): The earlier report.
+        after (dict): The later report.
+
+    Returns:
+        list[dict]: For each matched row, its key fields and {metric: (before, after, relative change)}.
+    """
+    def key(row):
+        return tuple(sorted((name, json.dumps(value)) for name, value in row.items() if not _is_metric(value)))
+
+    earlier = {key(row): row for row in before['results']}
+    changes = []
+    for row in after['results']:
+        matched = earlier.get(key(row))
+        if matched is None:
+            continue
+        metrics = {}
+        for name, value in row.items():
+            if _is_metric(value) and _is_metric(matched.get(name)):
+                relative = (value - matched[name]) / matched[name] if matched[name] else float('nan')
+                metrics[name] = (matched[name], value, relative)
+        changes.append({'key': {name: value for name, value in row.items() if not _is_metric(value)}, 'metrics': metrics})
+    return changes
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python -m benchmarks.report before.json after.json")
+    with open(sys.argv[1]) as f:
+        before = json.load(f)
+    with open(sys.argv[2]) as f:
+        after = json.load(f)
+    print(f"{before.get('benchmark')}: {before['run']['commit']} ({before['run']['timestamp']}) -> "
+          f"{after['run']['commit']} ({after['run']['timestamp']})")
+    for change in compare(before, after):
+        print(', '.join(f'{name}={value}' for name, value in change['key'].items()))
+        for name, (old, new, relative) in change['metrics'].items():
+            print(f"    {name:<24} {old:>12.3f} -> {new:>12.3f}  {relative:+.1%}")
@@ -0,0 +1,152 @@
+"""
+Latency and throughput micro-benchmark of retrieval.retrieve() at several top_k values.
+
+Unlike index_benchmark.py, which times index.search alone, this measures the whole
+retrieval path the app runs for each request: query embedding, index search (with
+re-ranking and the RETRIEVAL_* settings of the environment) and metadata gathering.
+For each index and top_k it reports
+    - cold p50/p99: one query at a time with the caches cleared before each query,
+    - warm p50/p99: the same queries again, served from the result cache,
+    - batch throughput: all queries in one retrieve_many() call, in queries per second.
+By default the built faiss_index is measured. With --index-types, each type is built
+from the embeddings of a preprocessing.py work directory instead. With --shards, the
+queries search those corpus shards (see shards.py), so the fan-out over several
+shards can be compared with a single one. Each index is measured in a fresh process,
+so it is loaded exactly as the app loads it.
+
+Usage:
+    python -m benchmarks.retrieval_benchmark --top-k 1 5 10 --queries 500 --json retrieval.json
+    python -m benchmarks.retrieval_benchmark --index-types flat hnsw ivf_pq --work-dir build
+    python -m benchmarks.retrieval_benchmark --shards rocstories cloze_val cloze_test
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.encoder_benchmark import sample_sentences
+from benchmarks.report import write_report
+from indexing import INDEX_TYPES
+
+def percentiles(latencies):
+    """
+    Returns the p50 and p99 of a list of durations in seconds, in milliseconds.
+    """
+    latencies_ms = np.asarray(latencies) * 1000
+    return float(np.percentile(latencies_ms, 50)), float(np.percentile(latencies_ms, 99))
+
+def measure_retrieve(index_file, queries, top_k_values, shards=None):
+    """
+    Loads retrieval.py with the given index and times retrieve() for each top_k.
+    Runs in a child process. shards selects the searched shards, see retrieval.search.
+
+    Returns:
+        list[dict]: One row per top_k.
+    """
+    import retrieval
+    retrieval.INDEX_FILE = index_file
+
+    start = time.perf_counter()
+    retrieval.retrieve(queries[0], 1, shards=shards)
+    load_seconds = time.perf_counter() - start
+
+    rows = []
+    for top_k in top_k_values:
+        cold = []
+        for query in queries:
+            retrieval.clear_caches()
+            start = time.perf_counter()
+            retrieval.retrieve(query, top_k, shards=shards)
+            cold.append(time.perf_counter() - start)
+
+        warm = []
+        for query in queries:
+            start = time.perf_counter()
+            retrieval.retrieve(query, top_k, shards=shards)
+            warm.append(time.perf_counter() - start)
+
+        retrieval.clear_caches()
+        start = time.perf_counter()
+        retrieval.retrieve_many(queries, top_k, shards=shards)
+        batch_seconds = time.perf_counter() - start
+
+        cold_p50, cold_p99 = percentiles(cold)
+        warm_p50, warm_p99 = percentiles(warm)
+        rows.append(dict(
+            top_k=top_k,
+            cold_p50_ms=cold_p50,
+            cold_p99_ms=cold_p99,
+            warm_p50_ms=warm_p50,
+            warm_p99_ms=warm_p99,
+            batch_qps=len(queries) / batch_seconds,
+            load_s=load_seconds,
+        ))
+    return rows
+
+def measure_in_process(index_file, queries, top_k_values, shards=None):
+    """
+    Runs measure_retrieve in a fresh process, so every index is loaded from scratch.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(measure_retrieve, index_file, queries, top_k_values, shards).result()
+
+def build_indexes(work_dir, index_types, output_dir):
+    """
+    Builds and writes one index per type from a build's embeddings.
+
+    Returns:
+        dict: Index type -> path of the written index.
+    """
+    import faiss
+
+    from indexing import build_index
+    from preprocessing import load_embeddings
+
+    embeddings = load_embeddings(work_dir)
+    paths = {}
+    for index_type in index_types:
+        print(f"Building {index_type} index...")
+        paths[index_type] = os.path.join(output_dir, f'{index_type}.faiss')
+        faiss.write_index(build_index(embeddings, index_type=index_type), paths[index_type])
+    return paths
+
+def format_row(row):
+    return (
+        f"{row['index']:<12} shards={row['shards']:<10} top_k={row['top_k']:<3} cold p50={row['cold_p50_ms']:.2f}ms p99={row['cold_p99_ms']:.2f}ms  "
+        f"warm p50={row['warm_p50_ms']:.3f}ms p99={row['warm_p99_ms']:.3f}ms  batch={row['batch_qps']:.0f} q/s"
+    )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark retrieve() latency and throughput.")
+    parser.add_argument('--top-k', nargs='+', type=int, default=[1, 5, 10], help="top_k values to measure.")
+    parser.add_argument('--queries', type=int, default=500, help="Number of sampled query sentences.")
+    parser.add_argument('--metadata-store', default='metadata_store', help="Store to sample query sentences from.")
+    parser.add_argument('--index-file', default='faiss_index', help="Index to measure without --index-types.")
+    parser.add_argument('--index-types', nargs='+', choices=INDEX_TYPES, help="Build and measure these index types instead.")
+    parser.add_argument('--work-dir', default='build', help="Work directory of a preprocessing.py build, for --index-types.")
+    parser.add_argument('--shards', nargs='+', help="Shards to search (default: RETRIEVAL_SHARDS).")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    queries = list(sample_sentences(args.metadata_store, args.queries))
+    print(f"{len(queries)} queries")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        if args.index_types:
+            index_files = build_indexes(args.work_dir, args.index_types, output_dir)
+        else:
+            index_files = {os.path.basename(args.index_file): args.index_file}
+        for name, index_file in index_files.items():
+            for row in measure_in_process(index_file, queries, args.top_k, args.shards):
+                rows.append({'index': name, 'shards': ','.join(args.shards or []) or 'default', **row})
+                print(format_row(rows[-1]))
+
+    if args.json_path:
+        write_report(args.json_path, 'retrieval', {'queries': len(queries), 'top_k': args.top_k, 'shards': args.shards}, rows)
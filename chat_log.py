@@ -0,0 +1,144 @@
+"""
+Bounded, append-only chat history for long sessions.
+
+The chat history used to be a list in session state that grew without limit and was
+rendered in full on every rerun. A ChatLog keeps only the most recent messages in
+memory; older ones are spilled to an append-only JSON lines file on local disk, with
+the byte offset of each line kept in a compact array so any page of earlier messages
+is read back with one seek. Only the newest messages can still change (feedback is
+attached to the latest response), so spilled messages are never rewritten.
+Subclasses can spill elsewhere by overriding spilled, _spill() and _read_spilled(),
+see session_store.SessionChatLog.
+
+The spill file is deleted when the log is garbage collected, i.e. when the Streamlit
+session it belongs to ends.
+"""
+import json
+import os
+import tempfile
+import threading
+import weakref
+from array import array
+
+CHAT_LOG_DIR = os.environ.get('CHAT_LOG_DIR', os.path.join(tempfile.gettempdir(), 'storytelling_chat_logs'))
+CHAT_MEMORY_MESSAGES = int(os.environ.get('CHAT_MEMORY_MESSAGES', 50))
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class ChatLog:
+    """
+    Chat messages (dicts with "role" and "content") in order, with the older ones on disk.
+
+    Supports len(), indexing (negative indexes count from the newest message), slicing
+    and iteration like the list it replaces; slices and iteration read spilled
+    messages back from disk.
+
+    Args:
+        max_in_memory (int): Number of most recent messages kept in memory (at least 1).
+        directory (str): Directory of the spill file, created on the first spill.
+    """
+    def __init__(self, max_in_memory=CHAT_MEMORY_MESSAGES, directory=CHAT_LOG_DIR):
+        self.max_in_memory = max(1, max_in_memory)
+        self.directory = directory
+        self._recent = []
+        self._offsets = array('q')  # byte offset of each spilled message
+        self._end = 0  # byte offset where the next spilled message goes
+        self._path = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.spilled + len(self._recent)
+
+    @property
+    def spilled(self):
+        """
+        Number of messages stored on disk; they are the first ones of the log.
+        """
+        return len(self._offsets)
+
+    def append(self, message):
+        """
+        Appends a message, spilling the oldest in-memory messages to disk if needed.
+        """
+        with self._lock:
+            self._recent.append(message)
+            overflow = len(self._recent) - self.max_in_memory
+            if overflow > 0:
+                self._spill(self._recent[:overflow])
+                del self._recent[:overflow]
+
+    def _spill(self, messages):
+        if self._path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, self._path = tempfile.mkstemp(prefix='chat-', suffix='.jsonl', dir=self.directory)
+            os.close(fd)
+            weakref.finalize(self, _remove, self._path)
+        lines = [json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n' for message in messages]
+        with open(self._path, 'ab') as f:
+            f.write(b''.join(lines))
+        for line in lines:
+            self._offsets.append(self._end)
+            self._end += len(line)
+
+    def _read_spilled(self, start, stop):
+        if start >= stop:
+            return []
+        end = self._offsets[stop] if stop < len(self._offsets) else self._end
+        with open(self._path, 'rb') as f:
+            f.seek(self._offsets[start])
+            data = f.read(end - self._offsets[start])
+        return [json.loads(line) for line in data.splitlines()]
+
+    def page(self, start, stop):
+        """
+        Returns the messages with positions in [start, stop), reading spilled ones from disk.
+        """
+        with self._lock:
+            start, stop, _ = slice(start, stop).indices(len(self))
+            spilled = self.spilled
+            messages = self._read_spilled(start, min(stop, spilled))
+            messages.extend(self._recent[max(start - spilled, 0):max(stop - spilled, 0)])
+            return messages
+
+    def recent(self, n):
+        """
+        Returns the last n messages.
+        """
+        return self.page(max(len(self) - n, 0), len(self))
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            if position.step not in (None, 1):
+                raise ValueError("ChatLog slices do not support a step")
+            return self.page(*slice(position.start, position.stop).indices(len(self))[:2])
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("chat message index out of range")
+        return self.page(position, position + 1)[0]
+
+    def __iter__(self):
+        return iter(self.page(0, len(self)))
+
+    def update(self, position, **fields):
+        """
+        Sets fields of an in-memory message, e.g. its feedback. Spilled messages cannot change.
+
+        Returns:
+            dict: The updated message.
+
+        Raises:
+            IndexError: If the message has been spilled to disk.
+        """
+        with self._lock:
+            if position < 0:
+                position += len(self)
+            recent_position = position - self.spilled
+            if not 0 <= recent_position < len(self._recent):
+                raise IndexError("only the most recent chat messages can be updated")
+            self._recent[recent_position].update(fields)
+            return self._recent[recent_position]
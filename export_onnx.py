@@ -0,0 +1,104 @@
+"""
+Exports the retrieval embedding model to ONNX for onnx_encoder.OnnxEncoder.
+
+Writes the transformer as model.onnx, a dynamically int8-quantized model_int8.onnx,
+the fast tokenizer and the pooling settings. Only this script needs torch and
+sentence-transformers; the exported encoder runs with onnxruntime alone.
+
+Usage:
+    python export_onnx.py --model all-MiniLM-L6-v2 --output onnx_encoder
+    python -m benchmarks.encoder_benchmark --onnx-dir onnx_encoder    # check parity and latency
+"""
+import argparse
+import json
+import os
+import shutil
+
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from sentence_transformers import SentenceTransformer
+from sentence_transformers.models import Normalize, Pooling
+
+from onnx_encoder import CONFIG_FILE, TOKENIZER_FILE
+
+class _TokenEmbeddings(torch.nn.Module):
+    """
+    Wraps the Hugging Face model so the export has a single token embeddings output.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        if token_type_ids is None:
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids).last_hidden_state
+
+def export_onnx(model_name, output_dir, opset=17, quantize=True):
+    """
+    Exports a sentence-transformers model with mean pooling to an ONNX encoder directory.
+    The export is written to a temporary directory and moved into place when complete.
+
+    Args:
+        model_name (str): Name or path of the sentence-transformers model.
+        output_dir (str): Directory to write the export to; replaced if it exists.
+        opset (int): ONNX opset version.
+        quantize (bool): Also write the int8-quantized model_int8.onnx.
+    """
+    model = SentenceTransformer(model_name, device='cpu')
+    pooling = next((module for module in model if isinstance(module, Pooling)), None)
+    if pooling is None or pooling.get_pooling_mode_str() != 'mean':
+        raise ValueError(f"{model_name} does not use mean pooling, which is the only pooling OnnxEncoder implements.")
+    transformer = model[0].auto_model.eval()
+
+    tmp_dir = output_dir.rstrip('/\\') + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    sample = model.tokenizer(["An example sentence.", "A second, longer example sentence."], padding=True, return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['token_embeddings'] = {0: 'batch', 1: 'sequence'}
+
+    print(f"Exporting {model_name} to {output_dir}/model.onnx...")
+    with torch.no_grad():
+        torch.onnx.export(
+            _TokenEmbeddings(transformer),
+            tuple(sample[name] for name in input_names),
+            os.path.join(tmp_dir, 'model.onnx'),
+            input_names=input_names,
+            output_names=['token_embeddings'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            dynamo=False,
+        )
+    if quantize:
+        print("Quantizing to model_int8.onnx...")
+        quantize_dynamic(os.path.join(tmp_dir, 'model.onnx'), os.path.join(tmp_dir, 'model_int8.onnx'), weight_type=QuantType.QInt8)
+
+    model.tokenizer.backend_tokenizer.save(os.path.join(tmp_dir, TOKENIZER_FILE))
+    with open(os.path.join(tmp_dir, CONFIG_FILE), 'w') as f:
+        json.dump({
+            'model': model_name,
+            'max_seq_length': model.max_seq_length,
+            'dimension': model.get_sentence_embedding_dimension(),
+            'pooling': pooling.get_pooling_mode_str(),
+            'normalize': any(isinstance(module, Normalize) for module in model),
+            'inputs': input_names,
+        }, f, indent=2)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    print("Export complete!")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the retrieval embedding model to ONNX.")
+    parser.add_argument('--model', default='all-MiniLM-L6-v2', help="Name or path of the sentence-transformers model.")
+    parser.add_argument('--output', default='onnx_encoder', help="Output directory.")
+    parser.add_argument('--opset', type=int, default=17, help="ONNX opset version.")
+    parser.add_argument('--no-quantize', action='store_true', help="Skip writing model_int8.onnx.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    export_onnx(args.model, args.output, opset=args.opset, quantize=not args.no_quantize)
@@ -0,0 +1,228 @@
+"""
+FAISS index construction shared by the preprocessing pipeline, retrieval.py and the benchmarks.
+
+Supported index types:
+    flat      exact brute-force search (IndexFlatL2), the original behaviour
+    ivf_flat  inverted file over k-means cells, searched `nprobe` cells at a time
+    hnsw      hierarchical navigable small world graph, searched with beam width `efSearch`
+    ivf_pq    inverted file with product-quantized vectors, smallest memory footprint
+    fp16      exact scan over float16 vectors, half the memory of flat
+    int8      exact scan over int8 scalar-quantized vectors, a quarter of the memory of flat
+    pq        exact scan over product-quantized codes, pq_m bytes per vector at 8 bits
+
+The quantized types lose some accuracy, which rerank() recovers by re-scoring the
+top candidates against the full-precision embeddings written by preprocessing.py.
+"""
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw', 'ivf_pq', 'fp16', 'int8', 'pq')
+
+# FAISS warns below roughly 39 training points per centroid
+TRAINING_POINTS_PER_CELL = 64
+
+def default_nlist(n_vectors):
+    """
+    Rule-of-thumb number of IVF cells for a corpus of the given size (about 4 * sqrt(n)).
+    """
+    return max(1, min(65536, int(4 * math.sqrt(n_vectors))))
+
+def index_factory_string(index_type, n_vectors, nlist=None, hnsw_m=32, pq_m=48, pq_nbits=8):
+    """
+    Returns the faiss.index_factory description for an index type.
+
+    Args:
+        index_type (str): One of INDEX_TYPES.
+        n_vectors (int): Number of vectors that will be added.
+        nlist (int, optional): Number of IVF cells; defaults to default_nlist(n_vectors).
+        hnsw_m (int): Neighbours per node in the HNSW graph.
+        pq_m (int): Number of PQ sub-quantizers; must divide the embedding dimension.
+        pq_nbits (int): Bits per PQ code.
+
+    Returns:
+        str: The factory string.
+    """
+    nlist = nlist or default_nlist(n_vectors)
+    if index_type == 'flat':
+        return 'Flat'
+    if index_type == 'ivf_flat':
+        return f'IVF{nlist},Flat'
+    if index_type == 'hnsw':
+        return f'HNSW{hnsw_m}'
+    if index_type == 'ivf_pq':
+        return f'IVF{nlist},PQ{pq_m}x{pq_nbits}'
+    if index_type == 'fp16':
+        return 'SQfp16'
+    if index_type == 'int8':
+        return 'SQ8'
+    if index_type == 'pq':
+        return f'PQ{pq_m}x{pq_nbits}'
+    raise ValueError(f"Unknown index type '{index_type}'. Expected one of {', '.join(INDEX_TYPES)}.")
+
+def build_index(embeddings, index_type='flat', nlist=None, hnsw_m=32, ef_construction=200, pq_m=48, pq_nbits=8,
+                add_batch_size=65536, seed=0):
+    """
+    Builds a FAISS index of the requested type over the embeddings.
+
+    Args:
+        embeddings (np.ndarray): float32 array of shape (n, dimension), may be memory-mapped.
+        index_type (str): One of INDEX_TYPES.
+        nlist (int, optional): Number of IVF cells for ivf_flat / ivf_pq.
+        hnsw_m (int): Neighbours per node for hnsw.
+        ef_construction (int): Beam width used while building the HNSW graph.
+        pq_m (int): Number of PQ sub-quantizers for ivf_pq / pq.
+        pq_nbits (int): Bits per PQ code for ivf_pq / pq.
+        add_batch_size (int): Vectors added per call, so memory-mapped input is streamed.
+        seed (int): Seed for sampling the training set.
+
+    Returns:
+        faiss.Index: The populated index.
+    """
+    n_vectors, dimension = embeddings.shape
+    index = faiss.index_factory(
+        dimension,
+        index_factory_string(index_type, n_vectors, nlist=nlist, hnsw_m=hnsw_m, pq_m=pq_m, pq_nbits=pq_nbits),
+        faiss.METRIC_L2
+    )
+    if index_type == 'hnsw':
+        index.hnsw.efConstruction = ef_construction
+
+    if not index.is_trained:
+        ivf = faiss.try_extract_index_ivf(index)
+        n_cells = ivf.nlist if ivf is not None else 1
+        n_train = min(n_vectors, max(n_cells, 2 ** pq_nbits) * TRAINING_POINTS_PER_CELL)
+        sample = np.sort(np.random.default_rng(seed).choice(n_vectors, size=n_train, replace=False))
+        index.train(np.ascontiguousarray(embeddings[sample], dtype=np.float32))
+
+    for start in range(0, n_vectors, add_batch_size):
+        index.add(np.ascontiguousarray(embeddings[start:start + add_batch_size], dtype=np.float32))
+    return index
+
+def configure_search(index, nprobe=None, ef_search=None):
+    """
+    Applies search-time parameters to an index. Parameters that do not apply to
+    the index type (e.g. nprobe on an HNSW index) are ignored.
+
+    Args:
+        index (faiss.Index): The index to configure.
+        nprobe (int, optional): Number of IVF cells visited per query.
+        ef_search (int, optional): HNSW search beam width.
+    """
+    parameter_space = faiss.ParameterSpace()
+    for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+        if value is None:
+            continue
+        try:
+            parameter_space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+def index_memory_bytes(index):
+    """
+    Approximate memory footprint of an index: the size of its serialized form.
+    """
+    return faiss.serialize_index(index).nbytes
+
+def rerank(query_embeddings, candidate_ids, embeddings, top_k):
+    """
+    Re-scores candidates by exact L2 distance to the full-precision embeddings and
+    keeps the best top_k per query.
+
+    Args:
+        query_embeddings (np.ndarray): float32 array of shape (n_queries, dimension).
+        candidate_ids (np.ndarray): int64 array of shape (n_queries, n_candidates), -1 for none.
+        embeddings (np.ndarray): The corpus embeddings, typically memory-mapped.
+        top_k (int): Number of results to keep per query.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Distances and ids of shape (n_queries, top_k),
+        ordered by distance, with ids of -1 where there were too few candidates.
+    """
+    n_queries, n_candidates = candidate_ids.shape
+    valid = candidate_ids >= 0
+    flat_ids = np.where(valid, candidate_ids, 0).ravel()
+    # read the memory-mapped rows in file order
+    order = np.argsort(flat_ids, kind='stable')
+    vectors = np.empty((flat_ids.shape[0], embeddings.shape[1]), dtype=np.float32)
+    vectors[order] = embeddings[flat_ids[order]]
+    vectors = vectors.reshape(n_queries, n_candidates, -1)
+
+    distances = ((vectors - query_embeddings[:, None, :]) ** 2).sum(axis=2)
+    distances[~valid] = np.inf
+
+    best = np.argsort(distances, axis=1)[:, :top_k]
+    distances = np.take_along_axis(distances, best, axis=1)
+    ids = np.take_along_axis(candidate_ids, best, axis=1)
+    ids[np.isinf(distances)] = -1
+    return distances.astype(np.float32), ids
+
+def id_selector(ids, n_vectors):
+    """
+    Builds a FAISS ID selector allowing only the given ids.
+
+    Args:
+        ids (np.ndarray): The allowed ids.
+        n_vectors (int): Number of vectors in the index.
+
+    Returns:
+        tuple[faiss.IDSelector, np.ndarray]: The selector and the bitmap it reads,
+        which must be kept alive while the selector is used.
+    """
+    allowed = np.zeros(n_vectors, dtype=bool)
+    allowed[ids] = True
+    bitmap = np.packbits(allowed, bitorder='little')
+    return faiss.IDSelectorBitmap(n_vectors, faiss.swig_ptr(bitmap)), bitmap
+
+def filtered_search(index, query_embeddings, k, ids, nprobe=None, ef_search=None, batch_size=65536):
+    """
+    Searches the index among the given ids only. The ids are applied inside the
+    search through an ID selector; the search parameters passed with it replace the
+    ones set by configure_search, so nprobe and ef_search must be given again.
+    Index types without selector support (pq) scan the allowed vectors instead.
+
+    Args:
+        index (faiss.Index): The index to search.
+        query_embeddings (np.ndarray): float32 array of shape (n_queries, dimension).
+        k (int): Number of results per query.
+        ids (np.ndarray): The allowed ids.
+        nprobe (int, optional): Number of IVF cells visited per query.
+        ef_search (int, optional): HNSW search beam width.
+        batch_size (int): Allowed vectors decoded at a time when scanning.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Distances and ids of shape (n_queries, k), -1 where not found.
+    """
+    if isinstance(index, faiss.IndexPQ):
+        return _scan_subset(index, query_embeddings, k, ids, batch_size)
+
+    # the bitmap must stay referenced until the search returns
+    selector, bitmap = id_selector(ids, index.ntotal)
+    if faiss.try_extract_index_ivf(index) is not None:
+        params = faiss.SearchParametersIVF(sel=selector)
+        if nprobe is not None:
+            params.nprobe = nprobe
+    elif isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector)
+        if ef_search is not None:
+            params.efSearch = ef_search
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(query_embeddings, k, params=params)
+
+def _scan_subset(index, query_embeddings, k, ids, batch_size):
+    # exact distances to the decoded allowed vectors, merged batch by batch
+    n_queries = query_embeddings.shape[0]
+    best_distances = np.full((n_queries, k), np.inf, dtype=np.float32)
+    best_ids = np.full((n_queries, k), -1, dtype=np.int64)
+    for start in range(0, len(ids), batch_size):
+        batch_ids = np.asarray(ids[start:start + batch_size], dtype=np.int64)
+        vectors = index.reconstruct_batch(batch_ids)
+        distances, positions = faiss.knn(query_embeddings, vectors, min(k, len(batch_ids)))
+        merged_distances = np.concatenate([best_distances, distances], axis=1)
+        merged_ids = np.concatenate([best_ids, batch_ids[positions]], axis=1)
+        order = np.argsort(merged_distances, axis=1)[:, :k]
+        best_distances = np.take_along_axis(merged_distances, order, axis=1)
+        best_ids = np.take_along_axis(merged_ids, order, axis=1)
+    return best_distances, best_ids
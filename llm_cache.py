@@ -0,0 +1,211 @@
+"""
+Opt-in, disk-backed cache of OpenAI chat completions.
+
+The autocomplete, chat and feedback refinement prompts are fully determined by the
+notepad text, retrieved context and settings, so identical requests can reuse an
+earlier response. Entries are keyed on a hash of the model, messages and request
+parameters and stored in a local SQLite database. They expire after a TTL, and the
+least recently used entries are evicted once the database exceeds a size limit.
+Cached responses to streamed requests are replayed as a stream.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = os.environ.get('LLM_CACHE_PATH', 'llm_cache.sqlite')
+CACHE_TTL_SECONDS = float(os.environ.get('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+CACHE_MAX_BYTES = int(float(os.environ.get('LLM_CACHE_MAX_MB', 100)) * 1024 * 1024)
+
+# Words plus their trailing whitespace, the granularity used to replay cached streams
+_REPLAY_PATTERN = re.compile(r'\S+\s*|\s+')
+
+class LLMCache:
+    """
+    SQLite-backed response cache, safe to share between threads.
+
+    Args:
+        path (str): Path of the SQLite database file.
+        ttl_seconds (float): Entries older than this are treated as missing.
+        max_bytes (int): Total response size above which the least recently used entries are evicted.
+    """
+    def __init__(self, path=CACHE_PATH, ttl_seconds=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT NOT NULL,"
+                " response TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    @staticmethod
+    def make_key(model, messages, **params):
+        """
+        Returns the cache key of a request: a hash of the model, messages and parameters.
+        """
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        """
+        Stores a response and evicts expired and least recently used entries as needed.
+        """
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now)
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        # Called with the lock held, inside a transaction
+        self.evictions += self._connection.execute(
+            "DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,)
+        ).rowcount
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Returns the hit/miss/eviction counters of this process and the size of the database.
+        """
+        with self._lock:
+            entries, total = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+            }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns the process-wide LLMCache, opening the database on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
+
+########################################
+#################### CACHED COMPLETIONS
+########################################
+
+def complete(client, model, messages, cache=None, **params):
+    """
+    Returns the text of a (non-streamed) chat completion, served from the cache if possible.
+
+    Args:
+        client (OpenAI): The OpenAI client.
+        model (str): The model name.
+        messages (list[dict]): The chat messages.
+        cache (LLMCache, optional): The cache to use; None bypasses caching.
+        **params: Extra parameters for client.chat.completions.create, part of the cache key.
+
+    Returns:
+        str: The response text.
+    """
+    key = LLMCache.make_key(model, messages, **params) if cache is not None else None
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    response = client.chat.completions.create(model=model, messages=messages, **params)
+    text = response.choices[0].message.content
+    if cache is not None:
+        cache.put(key, model, text)
+    return text
+
+def stream_completion(client, model, messages, cache=None, **params):
+    """
+    Yields the text of a streamed chat completion as it arrives. A cached response is
+    replayed word by word. A response is only cached once the stream is fully read,
+    so a cancelled stream is never stored. Closing the generator closes the HTTP stream.
+
+    Args:
+        client (OpenAI): The OpenAI client.
+        model (str): The model name.
+        messages (list[dict]): The chat messages.
+        cache (LLMCache, optional): The cache to use; None bypasses caching.
+        **params: Extra parameters for client.chat.completions.create, part of the cache key.
+
+    Yields:
+        str: Successive pieces of the response text.
+    """
+    key = LLMCache.make_key(model, messages, **params) if cache is not None else None
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            yield from _REPLAY_PATTERN.findall(cached)
+            return
+
+    stream = client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+    parts = []
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            chunk_text = chunk.choices[0].delta.content or ""
+            parts.append(chunk_text)
+            yield chunk_text
+    finally:
+        stream.close()
+
+    if cache is not None:
+        cache.put(key, model, "".join(parts))
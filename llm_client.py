@@ -0,0 +1,216 @@
+"""
+Process-wide OpenAI client shared by every session.
+
+main() used to build a new OpenAI client on every rerun, so each session opened its
+own connections and bursts of requests ran into rate limits uncoordinated. Instead,
+get_client() returns one client per process with a pooled HTTP connection, and every
+chat completion request passes through:
+    - a token bucket limiting the request rate (OPENAI_REQUESTS_PER_MINUTE),
+    - a semaphore limiting the requests in flight (OPENAI_MAX_CONCURRENCY); a stream
+      holds its slot until it is read to the end or closed,
+    - retries with full-jitter exponential backoff on 429, 5xx and connection errors,
+      honouring the Retry-After header.
+The wrapper has the same client.chat.completions.create interface, so llm_cache.py
+and prompt_builder.py use it unchanged. stats() reports queue depth and throttling.
+"""
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+from openai import OpenAI
+
+from telemetry import record
+
+MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', 8))
+REQUESTS_PER_MINUTE = float(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', 500))
+MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 4))
+BACKOFF_BASE_SECONDS = float(os.environ.get('OPENAI_BACKOFF_BASE_SECONDS', 0.5))
+BACKOFF_MAX_SECONDS = float(os.environ.get('OPENAI_BACKOFF_MAX_SECONDS', 20))
+
+# Errors worth retrying: rate limits, server errors and dropped connections
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, safe to share between threads.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Maximum number of tokens, i.e. the largest burst.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token, waiting for it if the bucket is empty.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class _SlotStream:
+    """
+    Wraps a response stream so its concurrency slot is released when the stream
+    is exhausted or closed.
+    """
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            with self._lock:
+                released, self._released = self._released, True
+            if not released:
+                self._release()
+
+class ThrottledOpenAI:
+    """
+    OpenAI client whose chat completions are rate limited, concurrency limited and retried.
+
+    Args:
+        api_key (str): The OpenAI API key.
+        max_concurrency (int): Maximum number of requests in flight.
+        requests_per_minute (float): Sustained request rate; bursts of up to
+            max_concurrency requests are allowed.
+        max_retries (int): Retries of a failed request before the error is raised.
+    """
+    def __init__(self, api_key, max_concurrency=MAX_CONCURRENCY, requests_per_minute=REQUESTS_PER_MINUTE,
+                 max_retries=MAX_RETRIES):
+        # retries are handled here, so they can be coordinated and counted
+        self.client = OpenAI(
+            api_key=api_key,
+            max_retries=0,
+            http_client=openai.DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+            ),
+        )
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(requests_per_minute / 60, max(1, max_concurrency))
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._stats_lock = threading.Lock()
+        self._counters = {"requests": 0, "queued": 0, "in_flight": 0, "throttled": 0, "throttled_seconds": 0.0, "retries": 0, "errors": 0}
+        # the interface used by llm_cache.py: client.chat.completions.create(...)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _count(self, **changes):
+        with self._stats_lock:
+            for name, change in changes.items():
+                self._counters[name] += change
+
+    def _acquire(self):
+        # rate limit, then wait for a free slot; both waits count as queueing
+        self._count(queued=1)
+        start = time.perf_counter()
+        try:
+            throttled = self._bucket.acquire()
+            self._slots.acquire()
+        finally:
+            self._count(queued=-1)
+        waited = time.perf_counter() - start
+        if throttled > 0:
+            self._count(throttled=1, throttled_seconds=throttled)
+        record("openai_queue", waited)
+        self._count(in_flight=1)
+
+    def _release(self):
+        self._count(in_flight=-1)
+        self._slots.release()
+
+    def _backoff(self, attempt, error):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def create(self, **params):
+        """
+        Calls client.chat.completions.create through the rate limiter and semaphore,
+        retrying retryable errors. With stream=True, the returned stream holds its
+        concurrency slot until it is exhausted or closed.
+        """
+        self._count(requests=1)
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                response = self.client.chat.completions.create(**params)
+            except RETRYABLE_ERRORS as e:
+                self._release()
+                if attempt == self.max_retries:
+                    self._count(errors=1)
+                    raise
+                self._count(retries=1)
+                delay = self._backoff(attempt, e)
+                print(f"OpenAI request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            except Exception:
+                self._release()
+                self._count(errors=1)
+                raise
+            except BaseException:
+                # e.g. Streamlit's StopException when a rerun interrupts the request
+                self._release()
+                raise
+
+            if params.get("stream"):
+                return _SlotStream(response, self._release)
+            self._release()
+            return response
+
+    def stats(self):
+        """
+        Returns the request, queue depth, throttling, retry and error counters.
+        """
+        with self._stats_lock:
+            return {**self._counters, "max_concurrency": self.max_concurrency}
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client(api_key):
+    """
+    Returns the process-wide ThrottledOpenAI client, creating it on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ThrottledOpenAI(api_key)
+        return _client
@@ -0,0 +1,74 @@
+"""
+Thread-safe, bounded least-recently-used cache with hit/miss/eviction counters.
+"""
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+class LRUCache:
+    """
+    Maps keys to values, evicting the least recently used entry once maxsize is reached.
+    Safe to share between threads, e.g. between all Streamlit sessions of a process.
+
+    Args:
+        maxsize (int): Maximum number of entries; 0 disables the cache.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default, and counts a hit or a miss.
+        """
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries if the cache is full.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Removes every entry. The counters are kept.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        Returns the counters and the current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
@@ -0,0 +1,222 @@
+"""
+Precomputed inverted index over the metadata store, used to restrict retrieval to
+sentences matching metadata filters without over-fetching and filtering afterwards.
+
+Filters are a dict with any of the keys:
+    title           terms that must all appear in the story title
+    sentence_index  SentenceIndex values to keep (0-4, e.g. 4 for story endings)
+    keywords        terms of which at least one must appear in the sentence, e.g. mood keywords
+Each value is a string (split into terms) or a list. Different keys must all match.
+allowed_ids() turns filters into a sorted array of FAISS ids, which retrieval.py
+passes to the index as an ID selector.
+
+Layout of the filter index directory (inside the metadata store):
+    filter_index.json       vocabularies: term -> [start, count] into the postings files
+    title_postings.bin      int32, story numbers of each title term, ascending
+    sentence_postings.bin   int32, row ids of each sentence term, ascending
+    position_rows.bin       int32, row ids grouped by SentenceIndex, ascending within a group
+    story_offsets.bin       int64, first row of each story number, plus the row count
+"""
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+from metadata_store import MetadataStore
+
+FILTER_INDEX_DIR = 'filter_index'
+HEADER_FILE = 'filter_index.json'
+FILTER_KEYS = ('title', 'sentence_index', 'keywords')
+
+TERM_PATTERN = re.compile(r"[a-z0-9']+")
+
+def tokenize(text):
+    """
+    Splits text into the lowercase terms used by the inverted index.
+    """
+    return TERM_PATTERN.findall(text.lower())
+
+def normalize_filters(filters):
+    """
+    Returns a canonical, hashable form of filters, or None if they filter nothing.
+    Used as part of the retrieval cache keys.
+
+    Args:
+        filters (dict, optional): The filters, see the module docstring.
+
+    Returns:
+        tuple | None: Sorted (key, values) pairs of the non-empty filters.
+    """
+    if not filters:
+        return None
+    unknown = set(filters) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown filter keys {sorted(unknown)}. Expected any of {', '.join(FILTER_KEYS)}.")
+
+    normalized = []
+    for key in FILTER_KEYS:
+        value = filters.get(key)
+        if value is None:
+            continue
+        if key == 'sentence_index':
+            values = [value] if isinstance(value, (int, np.integer)) else value
+            values = tuple(sorted({int(v) for v in values}))
+        else:
+            values = [value] if isinstance(value, str) else value
+            values = tuple(sorted({term for v in values for term in tokenize(v)}))
+        if values:
+            normalized.append((key, values))
+    return tuple(normalized) or None
+
+def _write_postings(directory, name, term_ids, ids, vocabulary):
+    # Group (term, id) pairs by term, ids ascending, and record each term's range
+    pairs = np.unique(np.stack([term_ids, ids]), axis=1) if len(ids) else np.zeros((2, 0), dtype=np.int64)
+    counts = np.bincount(pairs[0], minlength=len(vocabulary))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    with open(os.path.join(directory, f'{name}.bin'), 'wb') as f:
+        f.write(pairs[1].astype(np.int32).tobytes())
+    return {term: [int(starts[i]), int(counts[i])] for term, i in vocabulary.items()}
+
+def _collect_terms(texts, ids, vocabulary):
+    # (term id, id) pairs of the distinct terms of each text
+    term_ids, owners = [], []
+    for text, owner in zip(texts, ids):
+        for term in set(tokenize(text)):
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            owners.append(owner)
+    return np.asarray(term_ids, dtype=np.int64), np.asarray(owners, dtype=np.int64)
+
+def write_filter_index(store_directory, chunk_rows=100000):
+    """
+    Builds the filter index of a metadata store, in a filter_index directory inside it.
+    The index is written to a temporary directory and moved into place when complete.
+
+    Args:
+        store_directory (str): Directory written by write_metadata_store.
+        chunk_rows (int): Number of sentences tokenized at a time.
+    """
+    store = MetadataStore(store_directory)
+    directory = os.path.join(store_directory, FILTER_INDEX_DIR)
+    tmp_directory = directory + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    sentence_vocabulary, sentence_terms, sentence_rows = {}, [], []
+    stories, positions = [], []
+    for start in range(0, len(store), chunk_rows):
+        rows = np.arange(start, min(start + chunk_rows, len(store)))
+        chunk = store.gather(rows, columns=('sentence', 'story', 'sentence_index'))
+        term_ids, owners = _collect_terms(chunk['sentence'], rows, sentence_vocabulary)
+        sentence_terms.append(term_ids)
+        sentence_rows.append(owners)
+        stories.append(chunk['story'])
+        positions.append(chunk['sentence_index'])
+    stories = np.concatenate(stories) if stories else np.zeros(0, dtype=np.int32)
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int8)
+
+    # rows of a story are consecutive, so a story is the row range between two offsets
+    story_offsets = np.searchsorted(stories, np.arange(store.n_stories + 1)).astype(np.int64)
+    with open(os.path.join(tmp_directory, 'story_offsets.bin'), 'wb') as f:
+        f.write(story_offsets.tobytes())
+
+    first_rows = story_offsets[:-1]
+    titles = store.gather(first_rows, columns=('story_title',))['story_title'] if len(first_rows) else []
+    title_vocabulary = {}
+    title_terms, title_stories = _collect_terms(titles, np.arange(store.n_stories), title_vocabulary)
+
+    order = np.argsort(positions, kind='stable')
+    with open(os.path.join(tmp_directory, 'position_rows.bin'), 'wb') as f:
+        f.write(order.astype(np.int32).tobytes())
+    values, counts = np.unique(positions, return_counts=True)
+    position_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    header = {
+        'rows': len(store),
+        'stories': store.n_stories,
+        'title_terms': _write_postings(tmp_directory, 'title_postings', title_terms, title_stories, title_vocabulary),
+        'sentence_terms': _write_postings(
+            tmp_directory, 'sentence_postings',
+            np.concatenate(sentence_terms) if sentence_terms else np.zeros(0, dtype=np.int64),
+            np.concatenate(sentence_rows) if sentence_rows else np.zeros(0, dtype=np.int64),
+            sentence_vocabulary,
+        ),
+        'positions': {str(int(v)): [int(s), int(c)] for v, s, c in zip(values, position_starts, counts)},
+    }
+    with open(os.path.join(tmp_directory, HEADER_FILE), 'w') as f:
+        json.dump(header, f)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+def _map(path, dtype):
+    # np.memmap cannot map empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+class FilterIndex:
+    """
+    Read-only, memory-mapped view of the filter index of a metadata store.
+
+    Args:
+        store_directory (str): Directory of a metadata store with a built filter index.
+    """
+    def __init__(self, store_directory):
+        directory = os.path.join(store_directory, FILTER_INDEX_DIR)
+        with open(os.path.join(directory, HEADER_FILE)) as f:
+            header = json.load(f)
+        self.n_rows = header['rows']
+        self._title_terms = header['title_terms']
+        self._sentence_terms = header['sentence_terms']
+        self._positions = {int(value): bounds for value, bounds in header['positions'].items()}
+        self._title_postings = _map(os.path.join(directory, 'title_postings.bin'), np.int32)
+        self._sentence_postings = _map(os.path.join(directory, 'sentence_postings.bin'), np.int32)
+        self._position_rows = _map(os.path.join(directory, 'position_rows.bin'), np.int32)
+        self._story_offsets = _map(os.path.join(directory, 'story_offsets.bin'), np.int64)
+
+    @staticmethod
+    def _postings(postings, bounds):
+        if bounds is None:
+            return np.zeros(0, dtype=np.int64)
+        start, count = bounds
+        return np.asarray(postings[start:start + count], dtype=np.int64)
+
+    def _story_rows(self, stories):
+        # expand story numbers to the row ranges of those stories
+        starts = self._story_offsets[stories]
+        lengths = self._story_offsets[stories + 1] - starts
+        ends = np.cumsum(lengths)
+        return np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+    def allowed_ids(self, filters):
+        """
+        Returns the ids of the rows matching filters.
+
+        Args:
+            filters (dict | tuple): The filters, or their normalize_filters() form.
+
+        Returns:
+            np.ndarray | None: Sorted int64 row ids, or None if the filters filter nothing.
+        """
+        normalized = filters if isinstance(filters, tuple) else normalize_filters(filters)
+        if normalized is None:
+            return None
+
+        allowed = None
+        for key, values in normalized:
+            if key == 'title':
+                # stories whose title has every term
+                stories = self._postings(self._title_postings, self._title_terms.get(values[0]))
+                for term in values[1:]:
+                    stories = np.intersect1d(stories, self._postings(self._title_postings, self._title_terms.get(term)), assume_unique=True)
+                ids = self._story_rows(stories)
+            elif key == 'sentence_index':
+                ids = np.sort(np.concatenate([self._postings(self._position_rows, self._positions.get(v)) for v in values]))
+            else:
+                ids = np.unique(np.concatenate([self._postings(self._sentence_postings, self._sentence_terms.get(t)) for t in values]))
+            allowed = ids if allowed is None else np.intersect1d(allowed, ids, assume_unique=True)
+            if not len(allowed):
+                break
+        return allowed
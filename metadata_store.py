@@ -0,0 +1,177 @@
+"""
+Compact, memory-mapped columnar storage for the retrieval metadata.
+
+Replaces the pandas DataFrame loaded from metadata.csv. Each text column is a
+single UTF-8 blob plus an int64 offsets array, so a whole array of FAISS ids is
+gathered with a few vectorized lookups instead of one `iloc` per hit, and the
+data stays in the OS page cache instead of the Python heap.
+
+Layout of a store directory:
+    store.json                  row and story counts
+    sentences.bin               UTF-8 sentences, concatenated
+    sentence_offsets.bin        int64, rows + 1 offsets into sentences.bin
+    story.bin                   int32, story number of each row
+    sentence_index.bin          int8, SentenceIndex of each row
+    story_ids.bin, story_id_offsets.bin   UTF-8 StoryID of each story number
+    titles.bin, title_offsets.bin         UTF-8 StoryTitle of each story number
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+HEADER_FILE = 'store.json'
+
+# name -> dtype of every fixed-width array in a store
+_ARRAYS = {
+    'sentences': np.uint8,
+    'sentence_offsets': np.int64,
+    'story': np.int32,
+    'sentence_index': np.int8,
+    'story_ids': np.uint8,
+    'story_id_offsets': np.int64,
+    'titles': np.uint8,
+    'title_offsets': np.int64,
+}
+
+# text column -> (blob, offsets, row -> position array or None if indexed by row)
+_TEXT_COLUMNS = {
+    'sentence': ('sentences', 'sentence_offsets', None),
+    'story_title': ('titles', 'title_offsets', 'story'),
+    'story_id': ('story_ids', 'story_id_offsets', 'story'),
+}
+
+class _TextColumnWriter:
+    """
+    Appends strings to a UTF-8 blob file and its offsets file.
+    """
+    def __init__(self, directory, blob_name, offsets_name):
+        self.blob = open(os.path.join(directory, f'{blob_name}.bin'), 'wb')
+        self.offsets = open(os.path.join(directory, f'{offsets_name}.bin'), 'wb')
+        self.size = 0
+        self.offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def append(self, values):
+        encoded = [value.encode('utf-8') for value in values]
+        ends = self.size + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+        self.blob.write(b''.join(encoded))
+        self.offsets.write(ends.tobytes())
+        if len(ends):
+            self.size = int(ends[-1])
+
+    def close(self):
+        self.blob.close()
+        self.offsets.close()
+
+def write_metadata_store(metadata_file, directory, chunksize=100000):
+    """
+    Converts a metadata CSV (StoryID, StoryTitle, SentenceIndex, Sentence) into a
+    metadata store. Rows of the same story must be consecutive, as the preprocessing
+    pipeline writes them. The store is written to a temporary directory and moved
+    into place when complete.
+
+    Args:
+        metadata_file (str): Path of the metadata CSV.
+        directory (str): Directory to write the store to; replaced if it exists.
+        chunksize (int): Number of CSV rows converted at a time.
+    """
+    tmp_directory = directory.rstrip('/\\') + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    sentences = _TextColumnWriter(tmp_directory, 'sentences', 'sentence_offsets')
+    story_ids = _TextColumnWriter(tmp_directory, 'story_ids', 'story_id_offsets')
+    titles = _TextColumnWriter(tmp_directory, 'titles', 'title_offsets')
+    n_rows = 0
+    n_stories = 0
+    last_story_id = None
+    with open(os.path.join(tmp_directory, 'story.bin'), 'wb') as story_out, \
+            open(os.path.join(tmp_directory, 'sentence_index.bin'), 'wb') as sentence_index_out:
+        for chunk in pd.read_csv(metadata_file, chunksize=chunksize, dtype={'StoryID': str}, keep_default_na=False):
+            ids = chunk['StoryID'].to_numpy()
+            # a new story starts wherever the StoryID differs from the previous row
+            starts = np.ones(len(ids), dtype=bool)
+            starts[1:] = ids[1:] != ids[:-1]
+            if len(ids):
+                starts[0] = ids[0] != last_story_id
+                last_story_id = ids[-1]
+
+            story_numbers = n_stories - 1 + np.cumsum(starts)
+            story_out.write(story_numbers.astype(np.int32).tobytes())
+            sentence_index_out.write(chunk['SentenceIndex'].to_numpy().astype(np.int8).tobytes())
+            sentences.append(chunk['Sentence'].astype(str))
+            story_ids.append(ids[starts])
+            titles.append(chunk['StoryTitle'].astype(str).to_numpy()[starts])
+
+            n_rows += len(chunk)
+            n_stories += int(starts.sum())
+
+    for writer in (sentences, story_ids, titles):
+        writer.close()
+    with open(os.path.join(tmp_directory, HEADER_FILE), 'w') as f:
+        json.dump({'rows': n_rows, 'stories': n_stories}, f)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+class MetadataStore:
+    """
+    Read-only, memory-mapped view of a metadata store.
+
+    Args:
+        directory (str): Directory written by write_metadata_store.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, HEADER_FILE)) as f:
+            header = json.load(f)
+        self.n_rows = header['rows']
+        self.n_stories = header['stories']
+        self._arrays = {}
+        for name, dtype in _ARRAYS.items():
+            path = os.path.join(directory, f'{name}.bin')
+            # np.memmap cannot map empty files
+            if os.path.getsize(path) == 0:
+                self._arrays[name] = np.zeros(0, dtype=dtype)
+            else:
+                self._arrays[name] = np.memmap(path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.n_rows
+
+    def _gather_text(self, column, positions):
+        blob_name, offsets_name, _ = _TEXT_COLUMNS[column]
+        blob = self._arrays[blob_name]
+        offsets = self._arrays[offsets_name]
+        starts = offsets[positions]
+        lengths = offsets[positions + 1] - starts
+        # copy all requested bytes out of the blob with one fancy index, then split
+        ends = np.cumsum(lengths)
+        byte_positions = np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+        data = blob[byte_positions].tobytes()
+        bounds = np.concatenate(([0], ends)).tolist()
+        return [data[bounds[i]:bounds[i + 1]].decode('utf-8') for i in range(len(positions))]
+
+    def gather(self, indices, columns=('sentence', 'story_title')):
+        """
+        Looks up the metadata of many rows at once.
+
+        Args:
+            indices (np.ndarray): Row ids, e.g. the ids returned by index.search.
+            columns (tuple[str]): Any of 'sentence', 'story_title', 'story_id',
+                'story' (int story number) and 'sentence_index'.
+
+        Returns:
+            dict: column name -> list of strings or np.ndarray of ints, aligned with indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        result = {}
+        for column in columns:
+            if column in ('story', 'sentence_index'):
+                result[column] = np.asarray(self._arrays[column][indices])
+                continue
+            _, _, position_array = _TEXT_COLUMNS[column]
+            positions = indices if position_array is None else np.asarray(self._arrays[position_array][indices], dtype=np.int64)
+            result[column] = self._gather_text(column, positions)
+        return result
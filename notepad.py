@@ -1,8 +1,45 @@
 import streamlit as st
 from streamlit_feedback import streamlit_feedback
-from openai import OpenAI
 import json
-from retrieval import retrieve
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from retrieval import retrieve, search, encode, embedding_dimension, warm_up, is_ready, load_errors, load_times, cache_stats, available_shards, default_shards
+from story_segments import RECENT_SEGMENTS, SegmentEmbeddings, split_segments
+from story_index import merge_results, open_story_index
+from llm_cache import get_cache, stream_completion
+from llm_client import get_client
+from chat_log import ChatLog
+from session_store import SessionChatLog, get_store
+from telemetry import trace, span, record, stage_percentiles, current_trace
+from prompt_builder import Section, StorySummarizer, build_prompt, character_items, compress_story, count_message_tokens, llm_summarizer
+
+# Pause before an Autocomplete request that follows the previous click within this
+# window, so a further rapid click replaces it before another request is sent
+AUTOCOMPLETE_DEBOUNCE_SECONDS = 0.3
+
+# Chat messages rendered per page; older ones are shown on request with "Load earlier messages"
+CHAT_PAGE_SIZE = 20
+
+# Share of the prompt token budget the story may use in Autocomplete prompts
+STORY_BUDGET_SHARE = 0.6
+
+# Session state saved to the session store (when SESSION_STORE_PATH is set), with defaults
+PERSISTED_STATE = {
+    "notepad": "",
+    "characters": [],
+    "cur_msg_history": [],
+}
+
+# Retrieval position filter options -> SentenceIndex values of the five-sentence stories
+SENTENCE_POSITIONS = {
+    "Anywhere": None,
+    "Story openings": [0],
+    "Story middles": [1, 2, 3],
+    "Story endings": [4],
+}
 
 def main():
     """
@@ -21,9 +58,13 @@ def main():
     
     # Initialize session state variables if they don't exist
     initialize_session_state()
+
+    # Start loading the retrieval index, metadata and model in the background
+    warm_up()
+    render_retrieval_status()
     
-    # Initialize OpenAI client
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    # Shared, rate-limited OpenAI client of this server process
+    client = get_client(st.secrets["OPENAI_API_KEY"])
     
     # Create the three main tabs
     notepad_tab, chat_tab, settings_tab = st.tabs(["Notepad 🗒️", "Chat 💬", "Settings ⚙️"])
@@ -41,11 +82,28 @@ def initialize_session_state():
     """
     Initializes necessary session state variables to maintain state across interactions.
     """
+    # Resume the session named in the URL from the session store, if enabled
+    store = get_store()
+    if store is not None and "session_id" not in st.session_state:
+        session_id = st.query_params.get("session") or uuid.uuid4().hex
+        st.query_params["session"] = session_id
+        st.session_state["session_id"] = session_id
+        for key, default in PERSISTED_STATE.items():
+            st.session_state[key] = store.load(session_id, key, default)
+        # Only the latest chat messages are loaded; earlier ones are read when shown
+        st.session_state["chat_history"] = SessionChatLog(store, session_id)
+
     if "notepad" not in st.session_state:
         st.session_state['notepad'] = ""
 
+    # Per-session embeddings of the notepad's sentences, used by Autocomplete retrieval
+    if "notepad_segments" not in st.session_state:
+        st.session_state["notepad_segments"] = SegmentEmbeddings()
+
+    # Bounded chat history: recent messages in memory, older ones spilled to disk
     if "chat_history" not in st.session_state:
-        st.session_state["chat_history"] = []
+        st.session_state["chat_history"] = ChatLog()
+    st.session_state.setdefault("chat_visible_messages", CHAT_PAGE_SIZE)
     
     if "openai_model" not in st.session_state:
         st.session_state["openai_model"] = "gpt-4o"
@@ -58,9 +116,36 @@ def initialize_session_state():
 
     st.session_state.setdefault("retrieve_top_k", 5)
     st.session_state.setdefault("formality_level", "Informal")
+    st.session_state.setdefault("use_llm_cache", False)
+    st.session_state.setdefault("prompt_token_budget", 4000)
+    st.session_state.setdefault("last_prompt_report", None)
+    st.session_state.setdefault("last_trace", None)
+    st.session_state.setdefault("autocomplete_clicked_at", None)
+
+    # Alternative refinements generated in parallel after feedback, waiting for the user to pick one
+    st.session_state.setdefault("refine_count", 3)
+    st.session_state.setdefault("pending_refinements", None)
+    st.session_state.setdefault("show_feedback_form", False)
+
+    # Cached summary of the older part of long stories, used to fit prompts in the budget
+    if "story_summarizer" not in st.session_state:
+        st.session_state["story_summarizer"] = StorySummarizer()
     
     if "mood_keywords" not in st.session_state:
         st.session_state["mood_keywords"] = ''
+
+    # Live index of this story's own sentences, private to the session
+    st.session_state.setdefault("use_story_index", True)
+    st.session_state.setdefault("story_name", "Untitled story")
+    st.session_state.setdefault("story_indexes", {})
+    st.session_state.setdefault("story_index_synced", {})
+
+    # Metadata filters applied to retrieval
+    st.session_state.setdefault("retrieve_position", "Anywhere")
+    st.session_state.setdefault("filter_by_mood", False)
+    st.session_state.setdefault("title_filter", '')
+    if "retrieve_shards" not in st.session_state:
+        st.session_state["retrieve_shards"] = default_shards()
     
     if "characters" not in st.session_state:
         st.session_state["characters"] = []  # To store multiple characters
@@ -89,7 +174,7 @@ def render_notepad_tab(client):
     and edit text in a notepad-like interface.
 
     Args:
-        client (OpenAI): The initialized OpenAI client for generating responses.
+        client (ThrottledOpenAI): The shared OpenAI client for generating responses.
     """
     # Create four columns for Save, Load, Clear, and Autocomplete functionalities
     col1, col2, col3, col4 = st.columns([2, 2, 1, 1])
@@ -117,6 +202,7 @@ def render_notepad_tab(client):
             if uploaded_file is not None:
                 try:
                     st.session_state['notepad'] = uploaded_file.read().decode("utf-8")
+                    persist("notepad")
                     st.success("File loaded successfully!")
                 except Exception as e:
                     st.error(f"Error loading file: {e}")
@@ -126,69 +212,120 @@ def render_notepad_tab(client):
         with st.expander("🗑️ Clear Notepad"):
             if st.button("Confirm", key="clear_notepad"):
                 st.session_state['notepad'] = ""
+                persist("notepad")
                 st.info("Notepad cleared.")
 
     # Autocomplete Expander
     with col4:
         with st.expander("✨ Autocomplete"):
-            if st.button("Confirm"):
-                # Call OpenAI API with the current notepad content, context and custom prompt
-                context_results = retrieve(st.session_state['notepad'], st.session_state["retrieve_top_k"])
-                context_string = "\n".join([
-                                f"- Sentence: {result['sentence']} (from '{result['story_title']}')"
-                                for result in context_results
-                            ])
-                full_prompt = (
-                                f"You are an AI which is designed to autocomplete sentences in a story."
-                                f"The current content of the story is as follows: {st.session_state['notepad']}\n\n"
-                                f"Context:\n{context_string}\n\n"
-                                f"Respond in {st.session_state['formality_level']} tone. "
-                                f"Keywords: {st.session_state['mood_keywords']} "
-                                f"Characters: {json.dumps(st.session_state['characters'])}"
-                                f"It is crucial that you output only the completion of the last sentence, or"
-                                f"if the last sentence is finished, it is crucial that you continue the story with only one new sentence."
-                            )
-                print("\n\n",full_prompt,"\n\n")
-                try:
-                    response = client.chat.completions.create(
-                        model=st.session_state["openai_model"],
-                        messages=[
-                            {"role": "system", "content": full_prompt}
-                        ]
-                    )
-                except Exception as e:
-                    st.error(f"Error communicating with OpenAI API: {e}")
-                    return
-                st.success(response.choices[0].message.content)
-                # Add response to current notepad content
+            if st.button("Confirm", key="autocomplete"):
+                # Debounce rapid clicks only: a click arriving during the pause reruns
+                # the script, which stops this run at its next Streamlit call
+                last_click = st.session_state["autocomplete_clicked_at"]
+                st.session_state["autocomplete_clicked_at"] = time.monotonic()
+                if last_click is not None and st.session_state["autocomplete_clicked_at"] - last_click < AUTOCOMPLETE_DEBOUNCE_SECONDS:
+                    time.sleep(AUTOCOMPLETE_DEBOUNCE_SECONDS)
+
+                with trace("autocomplete") as request_trace:
+                    autocomplete(client)
+                st.session_state["last_trace"] = request_trace.to_dict()
+            elif st.session_state.get("cancel_autocomplete"):
+                st.info("Autocomplete cancelled.")
 
     # Notepad Text Area
     st.text_area(
         "",
         height=400,
         key="notepad",
-        placeholder="📝 Start writing!"
+        placeholder="📝 Start writing!",
+        on_change=on_notepad_change
     )
 
+def autocomplete(client):
+    """
+    Retrieves context for the notepad, builds the autocomplete prompt and streams the
+    suggestion into the Autocomplete expander.
+
+    Args:
+        client (ThrottledOpenAI): The shared OpenAI client for generating responses.
+    """
+    suggestion_placeholder = st.empty()
+    # Clicking Cancel (or Confirm again) reruns the script, interrupting this request at
+    # its next Streamlit call: before retrieval and summarization as well as the stream
+    st.button("Cancel", key="cancel_autocomplete")
+
+    # Call OpenAI API with the current notepad content, context and custom prompt
+    with retrieval_spinner():
+        context_results = retrieve_for_notepad(st.session_state['notepad'], st.session_state["retrieve_top_k"])
+    try:
+        with span("story_compression"):
+            story = compress_story(
+                st.session_state['notepad'],
+                int(st.session_state["prompt_token_budget"] * STORY_BUDGET_SHARE),
+                st.session_state["story_summarizer"],
+                llm_summarizer(client, st.session_state["openai_model"], cache=session_llm_cache()),
+                model=st.session_state["openai_model"],
+            )
+    except Exception as e:
+        st.error(f"Error communicating with OpenAI API: {e}")
+        return
+    messages, prompt_report = assemble_prompt([
+        Section("instructions", ["You are an AI which is designed to autocomplete sentences in a story."], priority=100, min_items=1),
+        Section("story", [story], header="The current content of the story is as follows: ", footer="\n\n", priority=100, min_items=1),
+        Section("context", context_items(context_results), header="Context:\n", footer="\n\n", priority=0),
+        Section("style", [style_instructions()], priority=100, min_items=1),
+        Section("characters", character_items(st.session_state['characters'], story), header="Characters: [", footer="]", separator=", ", priority=1),
+        Section("task", [
+            "It is crucial that you output only the completion of the last sentence, or"
+            "if the last sentence is finished, it is crucial that you continue the story with only one new sentence."
+        ], priority=100, min_items=1),
+    ])
+    full_prompt = messages[0]["content"]
+    print("\n\n",full_prompt,"\n\n")
+    try:
+        stream = stream_completion(
+            client,
+            model=st.session_state["openai_model"],
+            messages=messages,
+            cache=session_llm_cache(),
+        )
+        suggestion = stream_to_placeholder(stream, suggestion_placeholder)
+    except Exception as e:
+        st.error(f"Error communicating with OpenAI API: {e}")
+        return
+    suggestion_placeholder.success(suggestion)
+    st.caption(format_prompt_report(prompt_report))
+    # Add response to current notepad content
+
 def render_chat_tab(client):
     """
     Renders the Chat tab, which includes the chat interface, message handling,
     interaction with the OpenAI API, and feedback mechanisms.
     
     Args:
-        client (OpenAI): The initialized OpenAI client for generating responses.
+        client (ThrottledOpenAI): The shared OpenAI client for generating responses.
     """
     # Chat messages container
     global chat_container 
     chat_container = st.container()
     with chat_container:
-        for message in st.session_state['chat_history']:
+        # Render only the most recent page(s) of the history
+        hidden = len(st.session_state['chat_history']) - st.session_state["chat_visible_messages"]
+        if hidden > 0:
+            st.button(f"⬆️ Load earlier messages ({hidden} more)", key="load_earlier_chat", on_click=show_earlier_messages)
+        for message in st.session_state['chat_history'].recent(st.session_state["chat_visible_messages"]):
             avatar = "🤖" if message['role'] == "assistant" else "😊"
             with st.chat_message(message["role"], avatar=avatar):
                 st.markdown(message["content"])
+
+        # Refinements to choose from, or the feedback form of the chosen one
+        if st.session_state["pending_refinements"]:
+            render_refinement_choices()
+        elif st.session_state["show_feedback_form"]:
+            render_feedback_form(client)
     
     # Chat input from the user
-    user_input = st.chat_input("Send a message!")
+    user_input = st.chat_input("Send a message!", on_submit=on_chat_submit)
     if user_input:
         handle_user_input(user_input, client)
 
@@ -199,10 +336,11 @@ def handle_user_input(user_input, client):
     
     Args:
         user_input (str): The message input by the user.
-        client (OpenAI): The initialized OpenAI client for generating responses.
+        client (ThrottledOpenAI): The shared OpenAI client for generating responses.
     """
     # Reset current message history
     st.session_state['cur_msg_history'] = []
+    persist("cur_msg_history")
     
     # Append user message to chat history
     st.session_state['chat_history'].append({"role": "user", "content": user_input})
@@ -210,67 +348,122 @@ def handle_user_input(user_input, client):
         with st.chat_message("user", avatar="😊"):
             st.markdown(user_input)
 
-    # Assistant response
-    with chat_container:
+    # Assistant response, timed stage by stage
+    with chat_container, trace("chat") as request_trace:
         with st.chat_message("assistant", avatar="🤖"):
             response_placeholder = st.empty()  # Placeholder for dynamic response
 
             # Retrieve relevant context
-            context_results = retrieve(user_input, st.session_state["retrieve_top_k"])
+            with retrieval_spinner():
+                context_results = retrieve_for_chat(user_input, st.session_state["retrieve_top_k"])
             st.session_state["cur_msg_context"] = context_results
-            context_string = "\n".join([
-                f"- Sentence: {result['sentence']} (from '{result['story_title']}')"
-                for result in context_results
+            
+            # Construct the prompt for OpenAI, trimmed to the token budget
+            messages, prompt_report = assemble_prompt([
+                Section("context", context_items(context_results), header="Context:\n", footer="\n\n", priority=0),
+                Section("query", [user_input], header="User Query: ", footer="\n\n", priority=100, min_items=1),
+                Section("style", [style_instructions()], priority=100, min_items=1),
+                Section("characters", character_items(st.session_state['characters'], user_input), header="Characters: [", footer="]", separator=", ", priority=1),
             ])
             
-            # Construct the prompt for OpenAI
-            full_prompt = (
-                f"Context:\n{context_string}\n\n"
-                f"User Query: {user_input}\n\n"
-                f"Respond in {st.session_state['formality_level']} tone. "
-                f"Keywords: {st.session_state['mood_keywords']} "
-                f"Characters: {json.dumps(st.session_state['characters'])}"
+            # Generate response stream from OpenAI (or replay it from the response cache)
+            stream = stream_completion(
+                client,
+                model=st.session_state["openai_model"],
+                messages=messages,
+                cache=session_llm_cache(),
             )
-            
-            # Generate response stream from OpenAI
-            try:
-                stream = client.chat.completions.create(
-                    model=st.session_state["openai_model"],
-                    messages=[{"role": "system", "content": full_prompt}],
-                    stream=True,
-                )
-            except Exception as e:
-                st.error(f"Error communicating with OpenAI API: {e}")
-                return
 
             # Dynamically update assistant's response
-            response_text = ""
             try:
-                for chunk in stream:
-                    chunk_text = chunk.choices[0].delta.content or ""
-                    response_text += chunk_text
-                    response_placeholder.markdown(response_text)
+                response_text = stream_to_placeholder(stream, response_placeholder)
             except Exception as e:
-                st.error(f"Error during response streaming: {e}")
+                st.error(f"Error communicating with OpenAI API: {e}")
                 return
 
+            st.caption(format_prompt_report(prompt_report))
+
             # Append assistant response to chat history
             st.session_state['chat_history'].append({"role": "assistant", "content": response_text})
+            sync_story_index()
 
             # Add feedback form below the assistant's response
             with chat_container:
-                with st.form(f"feedback_form", clear_on_submit=True):
-                    streamlit_feedback(
-                        feedback_type="thumbs", 
-                        optional_text_label="[Optional]",
-                        align="flex-start",
-                        key=f"fb_k"
-                    )
-                    st.form_submit_button("Save feedback", on_click=fbcb, args=[client])
+                render_feedback_form(client)
 
     # Initialize or update the chat sidebar with feedback and context
+    st.session_state["last_trace"] = request_trace.to_dict()
     init_chat_sidebar()
 
+def on_chat_submit():
+    """
+    Callback of the chat input, run before the rerun renders the chat: drops the
+    refinements not chosen and the previous feedback form, and goes back to the
+    latest page of the history.
+    """
+    st.session_state["pending_refinements"] = None
+    st.session_state["show_feedback_form"] = False
+    st.session_state["chat_visible_messages"] = CHAT_PAGE_SIZE
+
+def show_earlier_messages():
+    """
+    Callback of the "Load earlier messages" button: renders one more page of the chat history.
+    """
+    st.session_state["chat_visible_messages"] += CHAT_PAGE_SIZE
+
+def render_feedback_form(client):
+    """
+    Renders the feedback form for the latest assistant response.
+
+    Args:
+        client (ThrottledOpenAI): The shared OpenAI client for generating responses.
+    """
+    with st.form(f"feedback_form", clear_on_submit=True):
+        streamlit_feedback(
+            feedback_type="thumbs", 
+            optional_text_label="[Optional]",
+            align="flex-start",
+            key=f"fb_k"
+        )
+        st.form_submit_button("Save feedback", on_click=fbcb, args=[client])
+
+def render_refinement_choices():
+    """
+    Renders the pending refinements side by side, each with a button to accept it.
+    """
+    pending = st.session_state["pending_refinements"]
+    with st.chat_message("assistant", avatar="🤖"):
+        st.caption("Pick the refinement to keep:")
+        columns = st.columns(len(pending["candidates"]))
+        for index, (column, candidate) in enumerate(zip(columns, pending["candidates"])):
+            with column:
+                st.markdown(candidate)
+                st.button("✅ Use this", key=f"choose_refinement_{index}", on_click=choose_refinement, args=[index])
+        st.caption(pending["report"])
+
+def render_retrieval_status():
+    """
+    Shows the errors of retrieval resources that failed to load, or a notice while
+    they are still loading in the background. Nothing is polled once they are ready.
+    """
+    errors = load_errors()
+    if errors:
+        for name, error in errors.items():
+            st.error(f"Could not load retrieval {name}: {error}")
+    elif not is_ready():
+        render_warming_up_notice()
+
+@st.fragment(run_every=2)
+def render_warming_up_notice():
+    """
+    Shows the warming-up notice, rerunning on its own every few seconds while loading.
+    Once loading has finished or failed, reruns the whole app, which no longer renders
+    this fragment and so stops the polling.
+    """
+    if is_ready() or load_errors():
+        st.rerun()
+    st.caption("⏳ Retrieval warming up...")
+
 def render_settings_tab():
     """
     Renders the Settings tab, which includes options to adjust retrieval settings,
@@ -299,6 +492,102 @@ def render_settings_tab():
         key="mood_keywords"
     )
 
+    # Story Index Settings
+    st.text_input(
+        label="📖 Story name",
+        max_chars=100,
+        key="story_name"
+    )
+    st.toggle(
+        "🔁 Also retrieve from my own story",
+        key="use_story_index"
+    )
+
+    # Retrieval Filter Settings
+    st.selectbox(
+        "📍 Which sentences should I retrieve?",
+        options=list(SENTENCE_POSITIONS),
+        key="retrieve_position"
+    )
+    st.toggle(
+        "🎭 Only retrieve sentences containing a mood keyword",
+        key="filter_by_mood"
+    )
+    st.text_input(
+        label="📚 Only retrieve from stories whose title contains",
+        max_chars=100,
+        key="title_filter"
+    )
+    shards = available_shards()
+    if len(shards) > 1:
+        st.multiselect(
+            "🗂️ Which story collections should I retrieve from?",
+            options=shards,
+            key="retrieve_shards"
+        )
+
+    # Prompt Token Budget Setting
+    st.number_input(
+        "🔢 Maximum prompt size in tokens",
+        min_value=500,
+        max_value=32000,
+        step=500,
+        key="prompt_token_budget"
+    )
+
+    # Refinement Candidates Setting
+    st.number_input(
+        "✨ How many refinements should I suggest after feedback? (1-4)",
+        min_value=1,
+        max_value=4,
+        step=1,
+        key="refine_count"
+    )
+
+    # LLM Response Cache Setting
+    st.toggle(
+        "♻️ Reuse cached responses for identical requests",
+        key="use_llm_cache"
+    )
+    if st.session_state["use_llm_cache"]:
+        stats = get_cache().stats()
+        st.caption(
+            f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), "
+            f"{stats['entries']} entries, {stats['bytes'] / 1024:.0f} KB"
+        )
+
+    # OpenAI Client Section
+    with st.expander("📡 OpenAI Requests", expanded=False):
+        # Counters are shared by all sessions of this process
+        stats = get_client(st.secrets["OPENAI_API_KEY"]).stats()
+        st.write(f"- **In flight:** {stats['in_flight']}/{stats['max_concurrency']}, **queued:** {stats['queued']}")
+        st.write(f"- **Requests:** {stats['requests']}, **retries:** {stats['retries']}, **errors:** {stats['errors']}")
+        st.write(f"- **Rate limited:** {stats['throttled']} times, {stats['throttled_seconds']:.1f}s in total")
+
+    # Session Store Section
+    store = get_store()
+    if store is not None:
+        with st.expander("💾 Saved Session", expanded=False):
+            st.write(f"Your work is saved as session `{st.session_state['session_id']}`. Open this page's address again to continue where you left off.")
+            stats = store.stats()
+            st.caption(f"Session store: {stats['rows_written']} rows written in {stats['flushes']} flushes, {stats['pending']} changes pending")
+
+    # Retrieval Status Section
+    with st.expander("📈 Retrieval Status", expanded=False):
+        if is_ready():
+            for name, seconds in load_times().items():
+                st.write(f"- **{name}:** loaded in {seconds:.2f}s")
+        else:
+            st.info("Retrieval is still warming up.")
+
+        # Cache counters are shared by all sessions of this process
+        for name, stats in cache_stats().items():
+            st.write(
+                f"- **{name} cache:** {stats['size']}/{stats['maxsize']} entries, "
+                f"{stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+                f"{stats['evictions']} evictions"
+            )
+
     # Character Builder Section
     with st.expander("🧑‍🤝‍🧑 Character Builder", expanded=False):
         col1, col2 = st.columns([1.5, 1])
@@ -340,6 +629,7 @@ def render_settings_tab():
                     if "characters" not in st.session_state:
                         st.session_state["characters"] = []
                     st.session_state["characters"].append(st.session_state["current_character"].copy())
+                    persist("characters")
 
                     # Clear all fields except 'Additional Information'
                     for key in st.session_state["current_character"]:
@@ -364,6 +654,7 @@ def render_settings_tab():
                     characters = json.load(uploaded_file)
                     if isinstance(characters, list):
                         st.session_state["characters"] = characters
+                        persist("characters")
                         st.success("Characters loaded successfully!")
                         # Reset the upload_key to prevent immediate reload
                         st.session_state["upload_key"] +=1
@@ -394,6 +685,7 @@ def render_settings_tab():
                 with col_clear:
                     if st.button("🗑️ Clear Characters", key="clear_characters"):
                         st.session_state["characters"] = []
+                        persist("characters")
                         st.session_state["upload_key"] +=1  # Reset the uploader
                         st.info("All characters have been cleared.")
                 # Display each character
@@ -408,15 +700,322 @@ def render_settings_tab():
 #################### HELPER FUNCTIONS
 ########################################
 
+def context_items(context_results):
+    """
+    Formats retrieved results as prompt lines, most relevant first.
+    """
+    return [
+        f"- Sentence: {result['sentence']} (from '{result['story_title']}')"
+        for result in context_results
+    ]
+
+def style_instructions():
+    """
+    Returns the tone and mood keyword instructions from the Settings tab.
+    """
+    return (
+        f"Respond in {st.session_state['formality_level']} tone. "
+        f"Keywords: {st.session_state['mood_keywords']} "
+    )
+
+def retrieval_filters():
+    """
+    Returns the metadata filters for retrieval from the Settings tab, or None.
+    """
+    filters = {
+        "sentence_index": SENTENCE_POSITIONS[st.session_state["retrieve_position"]],
+        "title": st.session_state["title_filter"],
+        "keywords": st.session_state["mood_keywords"] if st.session_state["filter_by_mood"] else None,
+    }
+    return {key: value for key, value in filters.items() if value} or None
+
+def retrieval_shards():
+    """
+    Returns the corpus shards selected in the Settings tab, or None for the default ones.
+    """
+    return st.session_state["retrieve_shards"] or None
+
+def assemble_prompt(sections, system=None):
+    """
+    Builds the messages of a request within the session's token budget. The sections
+    form the system message, or the user message after a fixed system prompt, which
+    counts against the budget too. The tokens sent are recorded in the active trace.
+
+    Args:
+        sections (list[Section]): The prompt sections.
+        system (str, optional): A fixed system prompt sent before the sections.
+
+    Returns:
+        tuple[list[dict], dict]: The messages, and the token report from
+        prompt_builder.build_prompt with "tokens" counting all of the messages.
+    """
+    model = st.session_state["openai_model"]
+    budget = st.session_state["prompt_token_budget"]
+    fixed = [{"role": "system", "content": system}] if system else []
+    reserved = count_message_tokens(fixed + [{"role": "user", "content": ""}], model)
+    with span("prompt_construction"):
+        prompt, report = build_prompt(sections, budget - reserved, model)
+    messages = fixed + [{"role": "user" if system else "system", "content": prompt}]
+    report = dict(report, tokens=count_message_tokens(messages, model), budget=budget)
+    st.session_state["last_prompt_report"] = report
+
+    active = current_trace()
+    if active is not None:
+        active.attributes["prompt_tokens"] = report["tokens"]
+        active.attributes["prompt_budget"] = budget
+        active.attributes["prompt_dropped"] = {name: section["dropped"] for name, section in report["sections"].items() if section["dropped"]}
+    return messages, report
+
+def format_prompt_report(report):
+    """
+    Formats a prompt token report for display below a response.
+    """
+    dropped = sum(section["dropped"] for section in report["sections"].values())
+    text = f"🔢 {report['tokens']} prompt tokens (budget {report['budget']})"
+    if dropped:
+        text += f", {dropped} low-priority items left out"
+    return text
+
+def stream_to_placeholder(stream, placeholder):
+    """
+    Renders a streamed completion into a placeholder as text arrives.
+
+    The stream is always closed, so when a rerun interrupts the loop (a Cancel click
+    or a newer request), the HTTP response is dropped and generation stops instead
+    of running to the end.
+
+    Args:
+        stream (Generator[str]): Text pieces, as yielded by llm_cache.stream_completion.
+        placeholder (DeltaGenerator): The st.empty() placeholder to render into.
+
+    Returns:
+        str: The full response text.
+    """
+    response_text = ""
+    start = time.perf_counter()
+    try:
+        with span("stream"):
+            for chunk_text in stream:
+                if chunk_text and not response_text:
+                    record("time_to_first_token", time.perf_counter() - start)
+                response_text += chunk_text
+                placeholder.markdown(response_text)
+    finally:
+        stream.close()
+    return response_text
+
+def stream_candidates(streams, placeholders):
+    """
+    Renders several streamed completions side by side as their text arrives.
+
+    Each stream is read on a pool thread, so the requests run concurrently; only the
+    script thread writes to the placeholders. When a rerun interrupts rendering, the
+    remaining streams are closed on their next chunk.
+
+    Args:
+        streams (list[Generator[str]]): Text pieces, as yielded by llm_cache.stream_completion.
+        placeholders (list[DeltaGenerator]): One st.empty() placeholder per stream.
+
+    Returns:
+        tuple[list[str], list[Exception]]: The full text of each stream, and the error
+        each one raised or None.
+    """
+    updates = queue.Queue()
+    cancelled = threading.Event()
+
+    def read(position, stream):
+        error = None
+        try:
+            for chunk_text in stream:
+                if cancelled.is_set():
+                    break
+                updates.put((position, chunk_text, None))
+        except Exception as e:
+            error = e
+        finally:
+            stream.close()
+            updates.put((position, None, error))
+
+    texts = [""] * len(streams)
+    errors = [None] * len(streams)
+    pending = len(streams)
+    start = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=len(streams), thread_name_prefix="refine")
+    try:
+        for position, stream in enumerate(streams):
+            pool.submit(read, position, stream)
+        with span("stream"):
+            while pending:
+                position, chunk_text, error = updates.get()
+                if chunk_text is None:
+                    errors[position] = error
+                    pending -= 1
+                    continue
+                if chunk_text and not any(texts):
+                    record("time_to_first_token", time.perf_counter() - start)
+                texts[position] += chunk_text
+                placeholders[position].markdown(texts[position])
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False)
+    return texts, errors
+
+def persist(*keys):
+    """
+    Saves session state values to the session store, if it is enabled.
+
+    Args:
+        *keys (str): Session state keys, from PERSISTED_STATE.
+    """
+    store = get_store()
+    if store is not None:
+        for key in keys:
+            store.save(st.session_state["session_id"], key, st.session_state[key])
+
+def session_llm_cache():
+    """
+    Returns the shared LLM response cache if this session has enabled it in Settings, else None.
+    """
+    return get_cache() if st.session_state["use_llm_cache"] else None
+
+def retrieval_spinner():
+    """
+    Returns a spinner for a retrieve() call, telling the user when the call is
+    waiting for the retrieval resources to finish loading.
+    """
+    return st.spinner("Retrieval warming up..." if not is_ready() else "Retrieving context...")
+
+def response_sentences(messages):
+    """
+    Returns the sentences of the assistant's responses among messages, except those rated 👎.
+    """
+    sentences = []
+    for message in messages:
+        feedback = message.get("feedback") or {}
+        if message["role"] == "assistant" and feedback.get("score") != "👎":
+            sentences.extend(split_segments(message["content"].removeprefix("**(Refined)** ")))
+    return sentences
+
+def sync_chat_sentences(story_index, synced):
+    """
+    Indexes the sentences of the assistant's chat responses, except those rated 👎.
+    Spilled messages never change, so only the ones spilled since the index last saw
+    the chat are read, and their sentences are added for good. The in-memory messages,
+    whose feedback can still change, are synced like the notepad.
+
+    Args:
+        story_index (StoryIndex): The story's index.
+        synced (dict): The story's sentences per source at this session's previous sync.
+    """
+    chat_history = st.session_state["chat_history"]
+    previous = set(synced.get("chat", ()))
+    # Saved with the index, so a resumed session does not read its spilled history again
+    indexed = story_index.marks.get("chat_spilled", 0)
+    if indexed < chat_history.spilled:
+        newly_spilled = response_sentences(chat_history.page(indexed, chat_history.spilled))
+        story_index.sync("chat", newly_spilled, encode)
+        story_index.set_mark("chat_spilled", chat_history.spilled)
+        # they stay indexed as they leave the in-memory messages
+        previous -= set(newly_spilled)
+    in_memory = response_sentences(chat_history.page(chat_history.spilled, len(chat_history)))
+    synced["chat"] = story_index.sync("chat", in_memory, encode, previous)
+
+def session_story_index():
+    """
+    Returns this session's index of the story named in the Settings tab, opening it on
+    first use. With the session store enabled it is saved with the session and comes
+    back when the session is resumed; otherwise it is kept in memory only.
+    """
+    name = st.session_state["story_name"].strip() or "Untitled story"
+    indexes = st.session_state["story_indexes"]
+    if name not in indexes:
+        session_id = st.session_state["session_id"] if get_store() is not None else None
+        indexes[name] = open_story_index(name, embedding_dimension(), session_id)
+    return indexes[name]
+
+def sync_story_index():
+    """
+    Adds new notepad sentences and accepted chat responses to the story's live index
+    and removes the ones deleted in this session.
+
+    Returns:
+        StoryIndex: The story's index, or None if disabled in Settings.
+    """
+    if not st.session_state["use_story_index"]:
+        return None
+    story_index = session_story_index()
+    synced = st.session_state["story_index_synced"].setdefault(story_index.name, {})
+    with span("story_index_update"):
+        synced["notepad"] = story_index.sync("notepad", split_segments(st.session_state["notepad"]), encode, synced.get("notepad", ()))
+        sync_chat_sentences(story_index, synced)
+    return story_index
+
+def on_notepad_change():
+    """
+    Saves the notepad as it is edited and indexes it, unless the model is still loading.
+    """
+    persist("notepad")
+    if is_ready():
+        sync_story_index()
+
+def retrieve_for_notepad(text, top_k):
+    """
+    Retrieves context for Autocomplete from the most recent sentences of the notepad.
+    Sentence embeddings are kept per session so only new or edited sentences are encoded.
+    Without filters, earlier sentences of the user's own story are ranked in as well.
+
+    Args:
+        text (str): The current notepad content.
+        top_k (int): Number of closest matches to retrieve.
+
+    Returns:
+        list[dict]: The retrieved results, empty if the notepad is empty.
+    """
+    query_embedding = st.session_state["notepad_segments"].query_embedding(text, encode)
+    if query_embedding is None:
+        return []
+    filters = retrieval_filters()
+    results = search(query_embedding, top_k, filters, retrieval_shards())[0]
+
+    # story sentences have no corpus metadata, so filters leave them out
+    story_index = sync_story_index() if filters is None else None
+    if story_index is not None:
+        # the sentences the query was built from would match themselves
+        with span("story_index_search"):
+            recent = set(split_segments(text)[-RECENT_SEGMENTS:])
+            results = merge_results([results, story_index.search(query_embedding, top_k, exclude=recent)[0]], top_k)
+    return results
+
+def retrieve_for_chat(query, top_k):
+    """
+    Retrieves context for a chat message, ranking in the user's own story like
+    retrieve_for_notepad.
+
+    Args:
+        query (str): The chat message.
+        top_k (int): Number of closest matches to retrieve.
+
+    Returns:
+        list[dict]: The retrieved results.
+    """
+    filters = retrieval_filters()
+    results = retrieve(query, top_k, filters, retrieval_shards())
+    story_index = sync_story_index() if filters is None else None
+    if story_index is not None:
+        with span("story_index_search"):
+            results = merge_results([results, story_index.search(encode([query]), top_k)[0]], top_k)
+    return results
+
 def refine_prompt_with_feedback(feedback, message_id, client):
     """
     Refines the previous assistant response based on user feedback by generating
-    a new response from the OpenAI API.
+    several alternative responses from the OpenAI API concurrently. They are streamed
+    side by side and kept as pending refinements until the user picks one.
     
     Args:
         feedback (dict): The feedback provided by the user.
         message_id (int): The ID of the message being refined.
-        client (OpenAI): The initialized OpenAI client for generating responses.
+        client (ThrottledOpenAI): The shared OpenAI client for generating responses.
     """
     if not feedback:
         return
@@ -436,42 +1035,60 @@ def refine_prompt_with_feedback(feedback, message_id, client):
         }
     }
     st.session_state["cur_msg_history"].append(old_version)
+    persist("cur_msg_history")
 
     # Create refined prompt based on feedback
-    refined_prompt = (
-        f"The user provided feedback: {feedback}. Please refine the previous response accordingly.\n\n"
-        f"Previous Response: {last_response}\n\nRefined Response:"
-    )
+    messages, prompt_report = assemble_prompt([
+        Section("feedback", [f"The user provided feedback: {feedback}. Please refine the previous response accordingly.\n\n"], priority=100, min_items=1),
+        Section("previous_response", [last_response], header="Previous Response: ", footer="\n\nRefined Response:", priority=100, min_items=1),
+    ], system="You are an AI that refines responses based on user feedback.")
 
-    # Call OpenAI API with the refined prompt
-    try:
-        response = client.chat.completions.create(
-            model=st.session_state["openai_model"],
-            messages=[
-                {"role": "system", "content": "You are an AI that refines responses based on user feedback."},
-                {"role": "user", "content": refined_prompt}
-            ]
-        )
-    except Exception as e:
-        st.error(f"Error communicating with OpenAI API: {e}")
+    # Generate several refinements at once and stream them side by side; a different
+    # seed per candidate varies them and keeps them apart in the response cache
+    cache = session_llm_cache()
+    count = st.session_state["refine_count"]
+    streams = [
+        stream_completion(client, model=st.session_state["openai_model"], messages=messages, cache=cache, seed=seed)
+        for seed in range(count)
+    ]
+    with chat_container:
+        with st.chat_message("assistant", avatar="🤖"):
+            placeholders = [column.empty() for column in st.columns(count)]
+            texts, errors = stream_candidates(streams, placeholders)
+
+    candidates = [text for text, error in zip(texts, errors) if error is None and text.strip()]
+    failed = [error for error in errors if error is not None]
+    if not candidates:
+        st.error(f"Error communicating with OpenAI API: {failed[0] if failed else 'empty response'}")
         return
+    if failed:
+        st.warning(f"{len(failed)} of {count} refinements failed: {failed[0]}")
+
+    st.session_state["pending_refinements"] = {
+        "candidates": candidates,
+        "report": format_prompt_report(prompt_report),
+    }
+    # With a single refinement there is nothing to choose
+    if len(candidates) == 1:
+        choose_refinement(0)
 
-    # Extract refined response
-    refined_response = response.choices[0].message.content
+def choose_refinement(index):
+    """
+    Callback of the refinement buttons: adds the chosen refinement to the chat history
+    and shows the feedback form for it.
 
-    # Append the refined response to chat history with a "(Refined)" tag
-    st.session_state["chat_history"].append({"role": "assistant", "content": f"**(Refined)** {refined_response}"})
+    Args:
+        index (int): Position of the chosen refinement among the pending ones.
+    """
+    pending = st.session_state["pending_refinements"]
+    if not pending:
+        return
 
-    # Re-render the feedback form for the refined response
-    with chat_container:
-        with st.form(f"feedback_form", clear_on_submit=True):
-            streamlit_feedback(
-                feedback_type="thumbs", 
-                optional_text_label="[Optional]",
-                align="flex-start",
-                key=f"fb_k"
-            )
-            st.form_submit_button("Save feedback", on_click=fbcb, args=[client])
+    # Append the refined response to chat history with a "(Refined)" tag
+    st.session_state["chat_history"].append({"role": "assistant", "content": f"**(Refined)** {pending['candidates'][index]}"})
+    st.session_state["pending_refinements"] = None
+    st.session_state["show_feedback_form"] = True
+    sync_story_index()
 
 def fbcb(client):
     """
@@ -480,13 +1097,16 @@ def fbcb(client):
     
     Args:
         message_id (int): The ID of the message being refined.
-        client (OpenAI): The initialized OpenAI client for generating responses.
+        client (ThrottledOpenAI): The shared OpenAI client for generating responses.
     """
+    st.session_state["show_feedback_form"] = False
     message_id = len(st.session_state.chat_history) - 1
     if message_id >= 0:
         # feedback = st.session_state[feedback_key]
-        st.session_state.chat_history[message_id]["feedback"] = st.session_state["fb_k"]
-        refine_prompt_with_feedback(st.session_state["fb_k"], message_id, client)
+        st.session_state.chat_history.update(message_id, feedback=st.session_state["fb_k"])
+        with trace("refine") as request_trace:
+            refine_prompt_with_feedback(st.session_state["fb_k"], message_id, client)
+        st.session_state["last_trace"] = request_trace.to_dict()
         init_chat_sidebar()
 
 def init_chat_sidebar():    
@@ -510,6 +1130,22 @@ def init_chat_sidebar():
                     st.caption(f"🤖 {message['content']}")
                     st.caption(formatted_feedback)
 
+        # Latency Section
+        st.subheader("⏱️ Latency")
+        if not st.session_state["last_trace"]:
+            st.write("Nothing here yet :(")
+        else:
+            last_trace = st.session_state["last_trace"]
+            st.caption(f"Last {last_trace['trace']} request: {last_trace['total_ms']:.0f} ms")
+            for recorded in last_trace["spans"]:
+                st.caption(f"- {recorded['stage']}: {recorded['ms']:.1f} ms")
+            with st.expander("All requests (this server process)"):
+                st.table([
+                    {"stage": stage, "count": stats["count"], "p50 ms": round(stats["p50_ms"], 1),
+                     "p95 ms": round(stats["p95_ms"], 1), "p99 ms": round(stats["p99_ms"], 1)}
+                    for stage, stats in stage_percentiles().items()
+                ])
+
         # Retrieved Context Section
         st.subheader("📚 Retrieved Context")
         if not st.session_state["cur_msg_context"]:
@@ -0,0 +1,98 @@
+"""
+Torch-free query encoder running an ONNX export of the sentence-transformers model.
+
+Importing torch and sentence-transformers takes seconds, and on CPU-only hosts the
+PyTorch forward pass dominates retrieve() latency. OnnxEncoder runs the exported
+transformer with onnxruntime and the fast tokenizer of the `tokenizers` package,
+then applies the same mean pooling and L2 normalization as the original model, so
+its embeddings are compatible with the faiss_index built by preprocessing.py.
+
+Create an export (model.onnx and its int8-quantized model_int8.onnx) with:
+    python export_onnx.py --output onnx_encoder
+
+Layout of an export directory:
+    encoder.json        max_seq_length, dimension, pooling, normalize and input names
+    tokenizer.json      the model's fast tokenizer
+    model.onnx          float32 transformer, outputs token embeddings
+    model_int8.onnx     dynamically int8-quantized copy of model.onnx
+"""
+import json
+import os
+
+import numpy as np
+import onnxruntime
+from tokenizers import Tokenizer
+
+CONFIG_FILE = 'encoder.json'
+TOKENIZER_FILE = 'tokenizer.json'
+
+class OnnxEncoder:
+    """
+    Drop-in replacement for the parts of SentenceTransformer used by retrieval.py.
+
+    Args:
+        model_dir (str): Directory written by export_onnx.py.
+        model_file (str): The ONNX model in model_dir, e.g. model.onnx or model_int8.onnx.
+    """
+    def __init__(self, model_dir, model_file='model_int8.onnx'):
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        if self.config['pooling'] != 'mean':
+            raise ValueError(f"Unsupported pooling '{self.config['pooling']}' in {model_dir}; only mean pooling is implemented.")
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=self.config['max_seq_length'])
+        self.tokenizer.no_padding()
+
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, model_file),
+            providers=['CPUExecutionProvider'],
+        )
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self):
+        return self.config['dimension']
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        length = max(len(encoding.ids) for encoding in encodings)
+        # pad to the longest text of the batch; padded positions are masked out below
+        feeds = {name: np.zeros((len(texts), length), dtype=np.int64) for name in ('input_ids', 'attention_mask', 'token_type_ids')}
+        for i, encoding in enumerate(encodings):
+            n = len(encoding.ids)
+            feeds['input_ids'][i, :n] = encoding.ids
+            feeds['attention_mask'][i, :n] = encoding.attention_mask
+            feeds['token_type_ids'][i, :n] = encoding.type_ids
+        token_embeddings = self.session.run(None, {name: feeds[name] for name in self.input_names})[0]
+
+        # mean pooling over the real tokens
+        mask = feeds['attention_mask'][:, :, None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config['normalize']:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings.astype(np.float32)
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        """
+        Embeds sentences like SentenceTransformer.encode.
+
+        Args:
+            sentences (str | list[str]): The text or texts to embed.
+            batch_size (int): Texts per forward pass. Texts are sorted by length so
+                each batch has little padding.
+            convert_to_numpy (bool): Accepted for compatibility; results are always numpy.
+            show_progress_bar (bool): Accepted for compatibility; ignored.
+
+        Returns:
+            np.ndarray: float32 array of shape (len(sentences), dimension), or
+            (dimension,) for a single string.
+        """
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embeddings = np.zeros((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            embeddings[batch] = self._encode_batch([texts[i] for i in batch])
+        return embeddings[0] if single else embeddings
@@ -0,0 +1,356 @@
+"""
+Command-line version of the preprocessing pipeline in data_preprocessing.ipynb.
+
+Builds the `faiss_index`, `metadata.csv` and memory-mapped `metadata_store/` (with
+its metadata filter index) loaded by retrieval.py. Other corpora, such as the Story
+Cloze Test files, are built as separate shards with --shard (see shards.py). Unlike the
+notebook, the dataset is read in chunks, sentences are encoded in large batches
+(optionally spread over a process pool), and embeddings are appended to disk as
+each chunk finishes so an interrupted build resumes from its last checkpoint.
+
+Usage:
+    python preprocessing.py datasets/ROCStories_winter2017.csv --batch-size 256 --workers 4
+    python preprocessing.py datasets/cloze_test_val_winter2018.csv --shard cloze_val
+"""
+import argparse
+import json
+import os
+import shutil
+
+import faiss
+import numpy as np
+import pandas as pd
+from sentence_transformers import SentenceTransformer
+
+from indexing import INDEX_TYPES, build_index
+from metadata_store import write_metadata_store
+from metadata_filters import write_filter_index
+from shards import DEFAULT_SHARD, shard_paths
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+SENTENCES_PER_STORY = 5
+CLOZE_INPUT_SENTENCES = 4
+
+# Files kept in the work directory while the build is in progress
+EMBEDDINGS_FILE = 'embeddings.f32'
+METADATA_PART_FILE = 'metadata.part.csv'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+########################################
+#################### TEXT PROCESSING
+########################################
+
+def clean_column(series):
+    """
+    Cleans and normalizes a column of text, vectorized version of the notebook's clean_text.
+
+    Args:
+        series (pd.Series): The raw text column.
+
+    Returns:
+        pd.Series: The cleaned text column.
+    """
+    return (
+        series.str.replace(r'\s+', ' ', regex=True)  # Remove excessive whitespace
+        .str.strip()  # Remove leading/trailing whitespace
+        .str.replace(r'[^\w\s\.\,\']', '', regex=True)  # Remove special characters
+    )
+
+def process_chunk(df):
+    """
+    Turns a chunk of ROCStories rows into one metadata row per sentence, in the same
+    order and with the same columns as the notebook's generate_embeddings.
+
+    Args:
+        df (pd.DataFrame): A chunk of the ROCStories dataset.
+
+    Returns:
+        pd.DataFrame: Metadata with StoryID, StoryTitle, SentenceIndex and Sentence columns.
+    """
+    titles = clean_column(df['storytitle']).to_numpy()
+    sentences = np.stack(
+        [clean_column(df[f'sentence{i}']).to_numpy() for i in range(1, SENTENCES_PER_STORY + 1)],
+        axis=1
+    )
+    return pd.DataFrame({
+        'StoryID': np.repeat(df['storyid'].to_numpy(), SENTENCES_PER_STORY),
+        'StoryTitle': np.repeat(titles, SENTENCES_PER_STORY),
+        'SentenceIndex': np.tile(np.arange(SENTENCES_PER_STORY), len(df)),
+        'Sentence': sentences.reshape(-1),
+    })
+
+def process_cloze_chunk(df):
+    """
+    Turns a chunk of Story Cloze Test rows into metadata rows like process_chunk. Each
+    story keeps its four input sentences, followed by its right ending where the file
+    labels it (AnswerRightEnding, in the validation set); the unlabelled quiz endings of
+    the test set are left out, since one of each pair is wrong. The corpus has no
+    titles, so each story is titled with its first sentence.
+
+    Args:
+        df (pd.DataFrame): A chunk of a Story Cloze Test CSV.
+
+    Returns:
+        pd.DataFrame: Metadata with StoryID, StoryTitle, SentenceIndex and Sentence columns.
+    """
+    columns = [clean_column(df[f'InputSentence{i}']).to_numpy() for i in range(1, CLOZE_INPUT_SENTENCES + 1)]
+    if 'AnswerRightEnding' in df.columns:
+        endings = df['RandomFifthSentenceQuiz1'].where(df['AnswerRightEnding'] == 1, df['RandomFifthSentenceQuiz2'])
+        columns.append(clean_column(endings).to_numpy())
+    sentences = np.stack(columns, axis=1)
+    per_story = sentences.shape[1]
+    return pd.DataFrame({
+        'StoryID': np.repeat(df['InputStoryid'].to_numpy(), per_story),
+        'StoryTitle': np.repeat(columns[0], per_story),
+        'SentenceIndex': np.tile(np.arange(per_story), len(df)),
+        'Sentence': sentences.reshape(-1),
+    })
+
+# Dataset formats, recognized by the first sentence column of their header
+CORPUS_FORMATS = {
+    'rocstories': ('sentence1', process_chunk),
+    'cloze': ('InputSentence1', process_cloze_chunk),
+}
+
+def detect_format(file_path):
+    """
+    Returns the CORPUS_FORMATS name of a dataset from its header.
+    """
+    columns = pd.read_csv(file_path, nrows=0).columns
+    for name, (column, _) in CORPUS_FORMATS.items():
+        if column in columns:
+            return name
+    raise ValueError(f"Unrecognized dataset format in '{file_path}'. Expected one of: {', '.join(CORPUS_FORMATS)}.")
+
+########################################
+#################### EMBEDDINGS
+########################################
+
+def encode_sentences(model, sentences, batch_size, pool=None):
+    """
+    Encodes a list of sentences in batches.
+
+    Args:
+        model (SentenceTransformer): The embedding model.
+        sentences (list[str]): The sentences to encode.
+        batch_size (int): Number of sentences per forward pass.
+        pool (dict, optional): A pool from model.start_multi_process_pool().
+
+    Returns:
+        np.ndarray: float32 array of shape (len(sentences), dimension).
+    """
+    if pool is not None:
+        embeddings = model.encode_multi_process(sentences, pool, batch_size=batch_size)
+    else:
+        embeddings = model.encode(sentences, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+def load_embeddings(work_dir):
+    """
+    Memory-maps the embeddings written by a build.
+
+    Args:
+        work_dir (str): The work directory of the build.
+
+    Returns:
+        np.memmap: float32 array of shape (n_sentences, dimension).
+    """
+    checkpoint = read_checkpoint(work_dir)
+    if checkpoint is None:
+        raise FileNotFoundError(f"No build checkpoint found in '{work_dir}'.")
+    return np.memmap(
+        os.path.join(work_dir, EMBEDDINGS_FILE),
+        dtype=np.float32,
+        mode='r',
+        shape=(checkpoint['rows_done'], checkpoint['dimension'])
+    )
+
+########################################
+#################### CHECKPOINTING
+########################################
+
+def read_checkpoint(work_dir):
+    """
+    Reads the build checkpoint, or returns None if there is none.
+    """
+    path = os.path.join(work_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_checkpoint(work_dir, checkpoint):
+    """
+    Atomically replaces the build checkpoint.
+    """
+    path = os.path.join(work_dir, CHECKPOINT_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def resume_checkpoint(work_dir, file_path, chunk_size, dimension):
+    """
+    Loads the checkpoint for this build, truncating any output written after it.
+    Starts a new checkpoint if there is none or it belongs to a different build.
+
+    Args:
+        work_dir (str): The work directory of the build.
+        file_path (str): The dataset being processed.
+        chunk_size (int): Number of stories per chunk.
+        dimension (int): Embedding dimension of the model.
+
+    Returns:
+        dict: The checkpoint to continue from.
+    """
+    checkpoint = read_checkpoint(work_dir)
+    expected = {
+        'dataset': os.path.abspath(file_path),
+        'model': MODEL_NAME,
+        'chunk_size': chunk_size,
+        'dimension': dimension,
+    }
+    if checkpoint is not None and all(checkpoint.get(key) == value for key, value in expected.items()):
+        print(f"Resuming after chunk {checkpoint['chunks_done']} ({checkpoint['rows_done']} sentences)...")
+        # Drop anything appended after the last checkpoint was written
+        with open(os.path.join(work_dir, EMBEDDINGS_FILE), 'r+b') as f:
+            f.truncate(checkpoint['rows_done'] * dimension * np.dtype(np.float32).itemsize)
+        with open(os.path.join(work_dir, METADATA_PART_FILE), 'r+b') as f:
+            f.truncate(checkpoint['metadata_bytes'])
+        return checkpoint
+
+    if checkpoint is not None:
+        print("Existing checkpoint is for a different build, starting over...")
+    for name in (EMBEDDINGS_FILE, METADATA_PART_FILE):
+        open(os.path.join(work_dir, name), 'wb').close()
+    checkpoint = dict(expected, chunks_done=0, rows_done=0, metadata_bytes=0, complete=False)
+    write_checkpoint(work_dir, checkpoint)
+    return checkpoint
+
+########################################
+#################### PIPELINE
+########################################
+
+def preprocess_pipeline(file_path, work_dir='build', index_file='faiss_index', metadata_file='metadata.csv',
+                        metadata_store='metadata_store', chunk_size=2000, batch_size=256, workers=0, fresh=False, index_type='flat', index_params=None,
+                        corpus_format=None):
+    """
+    Complete preprocessing pipeline for the ROCStories dataset, or another corpus shard.
+
+    Args:
+        file_path (str): Path to the ROCStories (or Story Cloze Test) CSV.
+        work_dir (str): Directory for the incremental embeddings and checkpoint.
+        index_file (str): Where to write the FAISS index.
+        metadata_file (str): Where to write the metadata CSV.
+        metadata_store (str): Directory to write the memory-mapped metadata store to.
+        chunk_size (int): Number of stories read and checkpointed at a time.
+        batch_size (int): Number of sentences per encoder forward pass.
+        workers (int): Number of encoder processes; 0 encodes in this process.
+        fresh (bool): Ignore any existing checkpoint and start over.
+        index_type (str): One of indexing.INDEX_TYPES.
+        index_params (dict, optional): Extra keyword arguments for indexing.build_index.
+        corpus_format (str, optional): One of CORPUS_FORMATS; detected from the header if omitted.
+    """
+    _, process = CORPUS_FORMATS[corpus_format or detect_format(file_path)]
+    os.makedirs(work_dir, exist_ok=True)
+    if fresh and os.path.exists(os.path.join(work_dir, CHECKPOINT_FILE)):
+        os.remove(os.path.join(work_dir, CHECKPOINT_FILE))
+
+    print("Loading model...")
+    model = SentenceTransformer(MODEL_NAME)
+    dimension = model.get_sentence_embedding_dimension()
+    checkpoint = resume_checkpoint(work_dir, file_path, chunk_size, dimension)
+
+    if not checkpoint['complete']:
+        pool = model.start_multi_process_pool(target_devices=['cpu'] * workers) if workers > 0 else None
+        try:
+            with open(os.path.join(work_dir, EMBEDDINGS_FILE), 'ab') as embeddings_out, \
+                    open(os.path.join(work_dir, METADATA_PART_FILE), 'ab') as metadata_out:
+                for chunk_number, chunk in enumerate(pd.read_csv(file_path, chunksize=chunk_size)):
+                    if chunk_number < checkpoint['chunks_done']:
+                        continue
+
+                    metadata = process(chunk)
+                    embeddings = encode_sentences(model, metadata['Sentence'].tolist(), batch_size, pool)
+
+                    embeddings_out.write(embeddings.tobytes())
+                    metadata_out.write(
+                        metadata.to_csv(index=False, header=checkpoint['metadata_bytes'] == 0).encode('utf-8')
+                    )
+                    for f in (embeddings_out, metadata_out):
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                    checkpoint['chunks_done'] = chunk_number + 1
+                    checkpoint['rows_done'] += len(metadata)
+                    checkpoint['metadata_bytes'] = metadata_out.tell()
+                    write_checkpoint(work_dir, checkpoint)
+                    print(f"Chunk {chunk_number + 1}: {checkpoint['rows_done']} sentences embedded")
+        finally:
+            if pool is not None:
+                model.stop_multi_process_pool(pool)
+
+        checkpoint['complete'] = True
+        write_checkpoint(work_dir, checkpoint)
+
+    print(f"Building FAISS index ({index_type})...")
+    index = build_index(load_embeddings(work_dir), index_type=index_type, **(index_params or {}))
+
+    print("Saving preprocessed data...")
+    shutil.copyfile(os.path.join(work_dir, METADATA_PART_FILE), metadata_file)
+    write_metadata_store(metadata_file, metadata_store)
+    write_filter_index(metadata_store)
+    faiss.write_index(index, index_file)
+    print("Preprocessing complete!")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the FAISS index and metadata used by retrieval.py.")
+    parser.add_argument('file_path', nargs='?', default=os.path.join('datasets', 'ROCStories_winter2017.csv'),
+                        help="Path to the ROCStories (or Story Cloze Test) CSV.")
+    parser.add_argument('--shard', default=DEFAULT_SHARD,
+                        help="Shard to build; the output paths default to its directory (see shards.py).")
+    parser.add_argument('--format', dest='corpus_format', choices=CORPUS_FORMATS, help="Dataset format (default: detected).")
+    parser.add_argument('--work-dir', help="Directory for incremental embeddings and the checkpoint.")
+    parser.add_argument('--index-file', help="Output path of the FAISS index.")
+    parser.add_argument('--metadata-file', help="Output path of the metadata CSV.")
+    parser.add_argument('--metadata-store', help="Output directory of the metadata store.")
+    parser.add_argument('--chunk-size', type=int, default=2000, help="Stories read and checkpointed at a time.")
+    parser.add_argument('--batch-size', type=int, default=256, help="Sentences per encoder forward pass.")
+    parser.add_argument('--workers', type=int, default=0, help="Encoder processes (0 encodes in this process).")
+    parser.add_argument('--fresh', action='store_true', help="Ignore any existing checkpoint.")
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default='flat', help="FAISS index family to build.")
+    parser.add_argument('--nlist', type=int, help="IVF cells for ivf_flat/ivf_pq (default 4 * sqrt(n)).")
+    parser.add_argument('--hnsw-m', type=int, default=32, help="Neighbours per node for hnsw.")
+    parser.add_argument('--ef-construction', type=int, default=200, help="Build-time beam width for hnsw.")
+    parser.add_argument('--pq-m', type=int, default=48, help="PQ sub-quantizers for ivf_pq.")
+    parser.add_argument('--pq-nbits', type=int, default=8, help="Bits per PQ code for ivf_pq.")
+    args = parser.parse_args()
+    for name, path in shard_paths(args.shard).items():
+        if getattr(args, name) is None:
+            setattr(args, name, path)
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    preprocess_pipeline(
+        args.file_path,
+        work_dir=args.work_dir,
+        index_file=args.index_file,
+        metadata_file=args.metadata_file,
+        metadata_store=args.metadata_store,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        fresh=args.fresh,
+        index_type=args.index_type,
+        corpus_format=args.corpus_format,
+        index_params={
+            'nlist': args.nlist,
+            'hnsw_m': args.hnsw_m,
+            'ef_construction': args.ef_construction,
+            'pq_m': args.pq_m,
+            'pq_nbits': args.pq_nbits,
+        },
+    )
@@ -0,0 +1,298 @@
+"""
+Token-budgeted prompt assembly shared by the autocomplete, chat and refinement paths.
+
+A prompt is a list of Sections. Each section is a header, a list of items and a
+footer. When the prompt is over budget, items are dropped from the end of the
+lowest-priority section first (e.g. the least relevant retrieved sentence, or a
+character not mentioned in the story). Long stories are compressed separately by
+compress_story: the most recent sentences are kept verbatim and everything before
+them is replaced by an incrementally updated summary.
+
+Tokens are counted with tiktoken when it is installed, and estimated from the
+character count otherwise.
+"""
+import functools
+import hashlib
+import json
+import math
+
+from llm_cache import complete
+from story_segments import split_segments
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Rough characters per token of English text, used when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+# Share of a story's budget for older text not yet folded into the summary; the
+# summary itself gets up to SUMMARY_MAX_TOKENS and recent text the remainder
+PENDING_STORY_SHARE = 0.15
+MIN_PENDING_TOKENS = 100
+
+# Older story text is folded into the summary this many tokens at a time
+SUMMARY_CHUNK_TOKENS = 1500
+SUMMARY_MAX_TOKENS = 300
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # e.g. the encoding file cannot be downloaded
+        return None
+
+def count_tokens(text, model="gpt-4o"):
+    """
+    Counts the tokens of text for the given model.
+
+    Args:
+        text (str): The text to count.
+        model (str): The OpenAI model name, used to pick the tokenizer.
+
+    Returns:
+        int: The number of tokens (estimated if tiktoken is not installed).
+    """
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+# Tokens the chat format adds around each message, and before the reply (from OpenAI's
+# guide to counting chat tokens)
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_PRIMING_TOKENS = 3
+
+def count_message_tokens(messages, model="gpt-4o"):
+    """
+    Counts the prompt tokens of a list of chat messages, including the chat format's overhead.
+
+    Args:
+        messages (list[dict]): The messages, each with a "content".
+        model (str): The OpenAI model name, used to pick the tokenizer.
+
+    Returns:
+        int: The number of prompt tokens the messages are billed as.
+    """
+    return REPLY_PRIMING_TOKENS + sum(MESSAGE_OVERHEAD_TOKENS + count_tokens(message["content"], model) for message in messages)
+
+class Section:
+    """
+    A part of a prompt that can be trimmed item by item.
+
+    Args:
+        name (str): Name used in the token report.
+        items (list[str]): The section's items, most important first.
+        header (str): Text before the items.
+        footer (str): Text after the items.
+        separator (str): Text between items.
+        priority (int): Sections with lower priority are trimmed first.
+        min_items (int): Number of leading items that are never dropped.
+    """
+    def __init__(self, name, items, header="", footer="", separator="\n", priority=0, min_items=0):
+        self.name = name
+        self.items = list(items)
+        self.header = header
+        self.footer = footer
+        self.separator = separator
+        self.priority = priority
+        self.min_items = min_items
+
+    def render(self, n_items=None):
+        items = self.items if n_items is None else self.items[:n_items]
+        return f"{self.header}{self.separator.join(items)}{self.footer}"
+
+def build_prompt(sections, budget, model="gpt-4o"):
+    """
+    Joins sections into a prompt, dropping items from the lowest-priority sections
+    until the prompt fits the token budget.
+
+    Args:
+        sections (list[Section]): The sections, in prompt order.
+        budget (int): Maximum number of prompt tokens.
+        model (str): The OpenAI model name, used to count tokens.
+
+    Returns:
+        tuple[str, dict]: The prompt and a report with the total "tokens", the
+        "budget", and per section its "tokens" and number of "dropped" items.
+    """
+    # Count each piece once; the sum is a close estimate of the joined prompt
+    fixed = {section.name: count_tokens(section.render(0), model) for section in sections}
+    item_tokens = {
+        section.name: [count_tokens(item + section.separator, model) for item in section.items]
+        for section in sections
+    }
+    kept = {section.name: len(section.items) for section in sections}
+
+    def estimate():
+        return sum(fixed[name] + sum(item_tokens[name][:kept[name]]) for name in kept)
+
+    trimmable = sorted(sections, key=lambda section: section.priority)
+    total = estimate()
+    for section in trimmable:
+        while total > budget and kept[section.name] > section.min_items:
+            kept[section.name] -= 1
+            total -= item_tokens[section.name][kept[section.name]]
+        if total <= budget:
+            break
+
+    prompt = "".join(section.render(kept[section.name]) for section in sections)
+    report = {
+        "tokens": count_tokens(prompt, model),
+        "budget": budget,
+        "sections": {
+            section.name: {
+                "tokens": fixed[section.name] + sum(item_tokens[section.name][:kept[section.name]]),
+                "dropped": len(section.items) - kept[section.name],
+            }
+            for section in sections
+        },
+    }
+    return prompt, report
+
+def character_items(characters, mentioned_in=""):
+    """
+    Serializes characters for a prompt section, characters named in mentioned_in first.
+
+    Args:
+        characters (list[dict]): The characters from the Character Builder.
+        mentioned_in (str): Text (story or query) used to rank the characters.
+
+    Returns:
+        list[str]: One JSON object per character.
+    """
+    text = mentioned_in.lower()
+
+    def is_mentioned(character):
+        if not isinstance(character, dict):
+            return False
+        name = str(character.get("Name", "")).strip().lower()
+        return bool(name) and name in text
+
+    ranked = sorted(characters, key=lambda character: not is_mentioned(character))
+    return [json.dumps(character) for character in ranked]
+
+########################################
+#################### STORY COMPRESSION
+########################################
+
+class StorySummarizer:
+    """
+    Incrementally updated summary of the older part of a story, meant to live in
+    st.session_state. The summary covers a prefix of the story's segments and is
+    extended a chunk at a time, so only text not yet covered is sent to the
+    summarizer. If covered text was edited, the summary is rebuilt from the start.
+    """
+    def __init__(self):
+        self.summary = ""
+        self.n_segments = 0
+        self._digest = self._hash([])
+
+    @staticmethod
+    def _hash(segments):
+        return hashlib.sha256("\n".join(segments).encode("utf-8")).hexdigest()
+
+    def summarize(self, segments, summarize, min_chunk_tokens, model="gpt-4o"):
+        """
+        Extends the summary over segments while at least min_chunk_tokens of them are
+        not yet covered.
+
+        Args:
+            segments (list[str]): The older story segments, in order.
+            summarize (callable): (previous_summary, new_text) -> updated summary.
+            min_chunk_tokens (int): Uncovered text below this size is left uncovered.
+            model (str): The OpenAI model name, used to count tokens.
+
+        Returns:
+            tuple[str, int]: The summary and the number of leading segments it covers.
+        """
+        if len(segments) < self.n_segments or self._hash(segments[:self.n_segments]) != self._digest:
+            self.summary, self.n_segments = "", 0
+
+        pending = [count_tokens(segment, model) for segment in segments[self.n_segments:]]
+        while pending and sum(pending) >= min_chunk_tokens:
+            # fold up to SUMMARY_CHUNK_TOKENS of whole segments into the summary per call
+            take, chunk_tokens = 0, 0
+            while take < len(pending) and (take == 0 or chunk_tokens + pending[take] <= SUMMARY_CHUNK_TOKENS):
+                chunk_tokens += pending[take]
+                take += 1
+            chunk = segments[self.n_segments:self.n_segments + take]
+            self.summary = summarize(self.summary, " ".join(chunk))
+            self.n_segments += take
+            pending = pending[take:]
+
+        self._digest = self._hash(segments[:self.n_segments])
+        return self.summary, self.n_segments
+
+def llm_summarizer(client, model, cache=None):
+    """
+    Returns a summarize(previous_summary, new_text) function backed by the OpenAI API.
+
+    Args:
+        client (OpenAI): The OpenAI client.
+        model (str): The model name.
+        cache (LLMCache, optional): Response cache for the summary requests.
+    """
+    def summarize(previous_summary, new_text):
+        return complete(
+            client,
+            model=model,
+            messages=[
+                {"role": "system", "content": "You summarize stories. Keep characters, places, key events and open plot threads. Answer with the summary only."},
+                {"role": "user", "content": f"Summary so far: {previous_summary or '(none)'}\n\nNext part of the story: {new_text}\n\nUpdated summary:"}
+            ],
+            cache=cache,
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+    return summarize
+
+def compress_story(text, budget, summarizer, summarize, model="gpt-4o"):
+    """
+    Fits a story into a token budget. If it is too long, the most recent sentences
+    are kept verbatim and the older ones are folded into the session's summary.
+
+    Args:
+        text (str): The story text.
+        budget (int): Maximum number of tokens for the story.
+        summarizer (StorySummarizer): The session's cached summary.
+        summarize (callable): (previous_summary, new_text) -> updated summary.
+        model (str): The OpenAI model name, used to count tokens.
+
+    Returns:
+        str: The story text or its compressed form.
+    """
+    if count_tokens(text, model) <= budget:
+        return text
+
+    segments = split_segments(text)
+    if not segments:
+        # nothing but whitespace
+        return ""
+    pending_budget = max(MIN_PENDING_TOKENS, int(budget * PENDING_STORY_SHARE))
+    recent_budget = max(budget // 4, budget - SUMMARY_MAX_TOKENS - pending_budget)
+    start, recent_tokens = len(segments), 0
+    while start > 0:
+        segment_tokens = count_tokens(segments[start - 1], model) + 1
+        if recent_tokens + segment_tokens > recent_budget:
+            break
+        recent_tokens += segment_tokens
+        start -= 1
+    if start == len(segments):
+        # even the last segment alone is too long: keep its end
+        last_words = segments[-1].split()
+        return " ".join(last_words[-max(1, recent_budget // 2):])
+
+    # Older text not yet worth a summary call stays verbatim
+    summary, covered = summarizer.summarize(segments[:start], summarize, pending_budget, model)
+    story = " ".join(segments[covered:])
+    if not covered:
+        return story
+    return f"[Summary of the earlier story: {summary}]\n{story}"
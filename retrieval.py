@@ -1,36 +1,435 @@
-import pandas as pd
+import heapq
 import numpy as np
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 import faiss
-from sentence_transformers import SentenceTransformer
+from indexing import configure_search, filtered_search, rerank
+from metadata_store import MetadataStore, write_metadata_store
+from metadata_filters import FILTER_INDEX_DIR, FilterIndex, normalize_filters, write_filter_index
+from lru_cache import LRUCache
+from shards import DEFAULT_SHARD, built_shards, shard_paths
+from telemetry import attach, current_trace, span
 
-# Load faiss index
-index = faiss.read_index('faiss_index')
+# Search-time parameters for approximate index types (ignored by the flat index)
+NPROBE = int(os.environ.get('RETRIEVAL_NPROBE', 16))
+EF_SEARCH = int(os.environ.get('RETRIEVAL_EF_SEARCH', 64))
 
-# Load metadata
-metadata = pd.read_csv('metadata.csv')
+# Exact re-ranking for quantized indexes: fetch top_k * RERANK_FACTOR candidates and
+# re-score them against the full-precision embeddings from the build (0 disables)
+RERANK_FACTOR = int(os.environ.get('RETRIEVAL_RERANK_FACTOR', 0))
+RERANK_EMBEDDINGS_FILE = os.environ.get('RETRIEVAL_RERANK_EMBEDDINGS', os.path.join('build', 'embeddings.f32'))
 
-# Load embedding model
-model = SentenceTransformer('all-MiniLM-L6-v2')
+INDEX_FILE = 'faiss_index'
+METADATA_FILE = 'metadata.csv'
+METADATA_STORE = 'metadata_store'
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Corpus shards searched when a call selects none (see shards.py); only these are
+# loaded at startup, other built shards are loaded the first time they are selected
+SHARDS = [name.strip() for name in os.environ.get('RETRIEVAL_SHARDS', DEFAULT_SHARD).split(',') if name.strip()]
+# Threads searching the shards of a multi-shard query in parallel
+SHARD_SEARCH_THREADS = int(os.environ.get('RETRIEVAL_SHARD_SEARCH_THREADS', 4))
+
+# Query encoder backend: 'sentence_transformers' or 'onnx' (an export_onnx.py export,
+# which gives the same embeddings without importing torch)
+ENCODER_BACKEND = os.environ.get('RETRIEVAL_ENCODER', 'sentence_transformers')
+ONNX_ENCODER_DIR = os.environ.get('RETRIEVAL_ONNX_DIR', 'onnx_encoder')
+ONNX_ENCODER_FILE = os.environ.get('RETRIEVAL_ONNX_FILE', 'model_int8.onnx')
+
+# Number of queries per encoder forward pass in encode()
+ENCODE_BATCH_SIZE = int(os.environ.get('RETRIEVAL_ENCODE_BATCH_SIZE', 64))
+
+# Entries kept in the process-wide query embedding and search result caches (0 disables)
+EMBEDDING_CACHE_SIZE = int(os.environ.get('RETRIEVAL_EMBEDDING_CACHE_SIZE', 2048))
+RESULT_CACHE_SIZE = int(os.environ.get('RETRIEVAL_RESULT_CACHE_SIZE', 2048))
+FILTER_CACHE_SIZE = int(os.environ.get('RETRIEVAL_FILTER_CACHE_SIZE', 64))
+
+########################################
+#################### LAZY RESOURCE LOADING
+########################################
+
+# The index, metadata and model are loaded once per process, in the background,
+# the first time they are needed, and shared by every session.
+_lock = threading.Lock()
+_futures = {}
+_load_times = {}
+
+def _resource_name(kind, shard):
+    # The default shard keeps the resource names it had before there were shards
+    return kind if shard == DEFAULT_SHARD else f"{kind}:{shard}"
+
+def _shard_files(shard):
+    # Read at load time, so the default shard's paths can be changed after import
+    if shard == DEFAULT_SHARD:
+        return {'index_file': INDEX_FILE, 'metadata_file': METADATA_FILE, 'metadata_store': METADATA_STORE,
+                'rerank_embeddings': RERANK_EMBEDDINGS_FILE}
+    paths = shard_paths(shard)
+    return dict(paths, rerank_embeddings=os.path.join(paths['work_dir'], 'embeddings.f32'))
+
+def _load_index(shard=DEFAULT_SHARD):
+    # Load faiss index
+    index = faiss.read_index(_shard_files(shard)['index_file'])
+    configure_search(index, nprobe=NPROBE, ef_search=EF_SEARCH)
+    return index
+
+def _load_metadata(shard=DEFAULT_SHARD):
+    # Load metadata, converting metadata.csv once if it was built before the store existed
+    files = _shard_files(shard)
+    if not os.path.isdir(files['metadata_store']):
+        print(f"Converting {files['metadata_file']} to {files['metadata_store']}/...")
+        write_metadata_store(files['metadata_file'], files['metadata_store'])
+    return MetadataStore(files['metadata_store'])
+
+def _load_model():
+    # Load embedding model; imported here because torch alone takes seconds to import
+    if ENCODER_BACKEND == 'onnx':
+        from onnx_encoder import OnnxEncoder
+        return OnnxEncoder(ONNX_ENCODER_DIR, ONNX_ENCODER_FILE)
+    if ENCODER_BACKEND != 'sentence_transformers':
+        raise ValueError(f"Unknown RETRIEVAL_ENCODER '{ENCODER_BACKEND}'. Expected 'sentence_transformers' or 'onnx'.")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(MODEL_NAME)
+
+def _load_filters(shard=DEFAULT_SHARD):
+    # Load the metadata filter index, building it once for stores written before it existed
+    _resource(_resource_name("metadata", shard))
+    metadata_store = _shard_files(shard)['metadata_store']
+    if not os.path.isdir(os.path.join(metadata_store, FILTER_INDEX_DIR)):
+        print(f"Building filter index in {metadata_store}/...")
+        write_filter_index(metadata_store)
+    return FilterIndex(metadata_store)
+
+def _load_rerank_embeddings(shard=DEFAULT_SHARD):
+    # Memory-mapped, so the pages are shared through the OS cache by every process on the host
+    dimension = _resource(_resource_name("index", shard)).d
+    return np.memmap(_shard_files(shard)['rerank_embeddings'], dtype=np.float32, mode='r').reshape(-1, dimension)
+
+_SHARD_LOADERS = {
+    "index": _load_index,
+    "metadata": _load_metadata,
+    "filters": _load_filters,
+}
+if RERANK_FACTOR > 0:
+    _SHARD_LOADERS["rerank_embeddings"] = _load_rerank_embeddings
+
+# Every shard that can be selected: the default ones and any other built shard
+_AVAILABLE_SHARDS = list(dict.fromkeys(SHARDS + built_shards()))
+_LOADERS = {"model": _load_model}
+for _shard in _AVAILABLE_SHARDS:
+    for _kind, _loader in _SHARD_LOADERS.items():
+        _LOADERS[_resource_name(_kind, _shard)] = partial(_loader, _shard)
+# Loaded by warm_up(); the resources of the other shards load on first use
+_WARM_RESOURCES = ["model"] + [_resource_name(kind, shard) for shard in SHARDS for kind in _SHARD_LOADERS]
+
+def _timed(name, loader):
+    start = time.perf_counter()
+    resource = loader()
+    _load_times[name] = time.perf_counter() - start
+    print(f"Loaded retrieval {name} in {_load_times[name]:.2f}s")
+    return resource
+
+def _failed(future):
+    return future.done() and future.exception() is not None
+
+def _start(names):
+    # Start loading the named resources that are not loaded or loading; call with _lock held
+    pending = [name for name in names if name not in _futures or _failed(_futures[name])]
+    if not pending:
+        return
+    executor = ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="retrieval-load")
+    for name in pending:
+        _futures[name] = executor.submit(_timed, name, _LOADERS[name])
+    executor.shutdown(wait=False)
+
+def warm_up():
+    """
+    Starts loading the retrieval resources of the default shards in background
+    threads, if not already started. Resources whose previous load failed are
+    retried. Returns immediately.
+    """
+    with _lock:
+        _start(_WARM_RESOURCES)
+
+def is_ready():
+    """
+    Returns True once every retrieval resource of the default shards has finished loading.
+    """
+    with _lock:
+        futures = [_futures.get(name) for name in _WARM_RESOURCES]
+    return all(future is not None and future.done() and not _failed(future) for future in futures)
+
+def load_errors():
+    """
+    Returns the exception raised by each resource that failed to load.
+    """
+    with _lock:
+        futures = dict(_futures)
+    return {name: future.exception() for name, future in futures.items() if _failed(future)}
+
+def load_times():
+    """
+    Returns the load time in seconds of each resource that has finished loading.
+    """
+    return dict(_load_times)
+
+def _resource(name):
+    # Block until the resource is loaded, re-raising any error from its loader
+    warm_up()
+    with _lock:
+        _start([name])
+        future = _futures[name]
+    return future.result()
+
+def available_shards():
+    """
+    Returns the names of the shards that can be selected for retrieval.
+    """
+    return list(_AVAILABLE_SHARDS)
+
+def default_shards():
+    """
+    Returns the names of the shards searched when a call selects none (RETRIEVAL_SHARDS).
+    """
+    return list(SHARDS)
+
+def select_shards(shards=None):
+    """
+    Validates a selection of shards.
+
+    Args:
+        shards (str | list[str], optional): Shard names; None selects the default shards.
+
+    Returns:
+        tuple[str]: The distinct selected shards, sorted, for use in cache keys.
+    """
+    if shards is None:
+        shards = SHARDS
+    elif isinstance(shards, str):
+        shards = [shards]
+    selected = tuple(sorted(set(shards)))
+    if not selected:
+        raise ValueError("No shards selected.")
+    unknown = [shard for shard in selected if shard not in _AVAILABLE_SHARDS]
+    if unknown:
+        raise ValueError(f"Unknown shard(s) {', '.join(unknown)}. Available: {', '.join(_AVAILABLE_SHARDS)}.")
+    return selected
+
+########################################
+#################### CACHING
+########################################
+
+# Shared by every session of the process
+_embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE)
+_result_cache = LRUCache(RESULT_CACHE_SIZE)
+_filter_cache = LRUCache(FILTER_CACHE_SIZE)
+
+def normalize_query(text):
+    """
+    Normalizes a query for use as a cache key. The model's tokenizer is uncased and
+    splits on whitespace, so neither case nor runs of whitespace change the embedding.
+    """
+    return " ".join(text.split()).lower()
+
+def cache_stats():
+    """
+    Returns the hit/miss/eviction counters of the embedding, result and filter caches.
+    """
+    return {
+        "embeddings": _embedding_cache.stats(),
+        "results": _result_cache.stats(),
+        "filters": _filter_cache.stats(),
+    }
+
+def clear_caches():
+    """
+    Empties the embedding, result and filter caches, e.g. after the index is rebuilt.
+    """
+    _embedding_cache.clear()
+    _result_cache.clear()
+    _filter_cache.clear()
+
+########################################
+#################### RETRIEVAL
+########################################
 
 # Example query
 # query = "It's so good to be alive"
 
-def retrieve(query, top_k):
-    # generate query embedding
-    query_embedding = model.encode(query, convert_to_tensor=True).cpu().numpy()
+def encode(texts):
+    """
+    Embeds a batch of texts, serving repeated texts from the embedding cache and
+    encoding the rest in one call to the model.
+
+    Args:
+        texts (list[str]): The texts to embed.
+
+    Returns:
+        np.ndarray: float32 array of shape (len(texts), dimension).
+    """
+    model = _resource("model")
+    texts = list(texts)
+    if not texts:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    keys = [normalize_query(text) for text in texts]
+    embeddings = [_embedding_cache.get(key) for key in keys]
+
+    # encode each distinct uncached text once
+    missing = {key: text for key, text, embedding in zip(keys, texts, embeddings) if embedding is None}
+    if missing:
+        with span("query_embedding"):
+            encoded = model.encode(list(missing.values()), batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True, show_progress_bar=False)
+        encoded = dict(zip(missing, np.asarray(encoded, dtype=np.float32)))
+        for key, embedding in encoded.items():
+            embedding.flags.writeable = False
+            _embedding_cache.put(key, embedding)
+        embeddings = [encoded[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+
+    return np.stack(embeddings)
+
+def embedding_dimension():
+    """
+    Returns the dimension of the embeddings returned by encode().
+    """
+    return _resource("model").get_sentence_embedding_dimension()
+
+def allowed_ids(filters, shard=DEFAULT_SHARD):
+    """
+    Returns the ids of a shard's sentences matching metadata filters, or None if the
+    filters filter nothing. See metadata_filters.py for the filter keys.
+    """
+    normalized = normalize_filters(filters)
+    if normalized is None:
+        return None
+    ids = _filter_cache.get((shard, normalized))
+    if ids is None:
+        with span("filter"):
+            ids = _resource(_resource_name("filters", shard)).allowed_ids(normalized)
+        ids.flags.writeable = False
+        _filter_cache.put((shard, normalized), ids)
+    return ids
+
+# Shared by every multi-shard query; faiss releases the GIL while it searches
+_shard_executor = ThreadPoolExecutor(max_workers=SHARD_SEARCH_THREADS, thread_name_prefix="retrieval-shard")
+
+def search(query_embeddings, top_k, filters=None, shards=None):
+    """
+    Searches the selected shards with a batch of query embeddings, in a single
+    index.search call per shard. Several shards are searched in parallel threads and
+    their results merged by distance; a single shard is searched on the calling thread.
+
+    Args:
+        query_embeddings (np.ndarray): float32 array of shape (n_queries, dimension).
+        top_k (int): Number of closest matches to retrieve per query.
+        filters (dict, optional): Metadata filters, e.g. {"sentence_index": 4} for story
+            endings; only matching sentences are searched. See metadata_filters.py.
+        shards (list[str], optional): Shards to search; None searches RETRIEVAL_SHARDS.
+
+    Returns:
+        list[list[dict]]: For each query, its results ordered by distance, each with
+        "sentence", "story_title" and "distance".
+    """
+    shards = select_shards(shards)
+    if len(shards) == 1:
+        return _search_shard(shards[0], query_embeddings, top_k, filters)
+
+    # the pool threads record their stages into the caller's trace
+    active = current_trace()
+
+    def search_shard(shard):
+        with attach(active):
+            return _search_shard(shard, query_embeddings, top_k, filters)
+
+    with span("shard_search"):
+        per_shard = list(_shard_executor.map(search_shard, shards))
+    # each shard's results are already ordered by distance
+    return [
+        list(islice(heapq.merge(*shard_hits, key=lambda hit: hit["distance"]), top_k))
+        for shard_hits in zip(*per_shard)
+    ]
+
+def _search_shard(shard, query_embeddings, top_k, filters):
+    # Search one shard's index, see search()
+    index = _resource(_resource_name("index", shard))
+    metadata = _resource(_resource_name("metadata", shard))
+    if len(query_embeddings) == 0:
+        return []
+    ids = allowed_ids(filters, shard)
+    if ids is not None and not len(ids):
+        return [[] for _ in range(len(query_embeddings))]
+
+    # search, over-fetching candidates when they are re-ranked
+    n_candidates = top_k * RERANK_FACTOR if RERANK_FACTOR > 0 else top_k
+    with span("index_search"):
+        if ids is None:
+            distances, indices = index.search(query_embeddings, n_candidates)
+        else:
+            distances, indices = filtered_search(index, query_embeddings, n_candidates, ids, nprobe=NPROBE, ef_search=EF_SEARCH)
+    if RERANK_FACTOR > 0:
+        with span("rerank"):
+            distances, indices = rerank(query_embeddings, indices, _resource(_resource_name("rerank_embeddings", shard)), top_k)
+
+    # approximate indexes return -1 when fewer than top_k neighbours were found
+    found = indices >= 0
+    with span("metadata_gather"):
+        rows = metadata.gather(indices[found], columns=("sentence", "story_title"))
+        hits = [
+            {"sentence": sentence, "story_title": story_title, "distance": distance}
+            for sentence, story_title, distance in zip(rows["sentence"], rows["story_title"], distances[found])
+        ]
+
+    # split the flat list of hits back into one list per query
+    bounds = np.concatenate(([0], np.cumsum(found.sum(axis=1)))).tolist()
+    return [hits[bounds[i]:bounds[i + 1]] for i in range(len(query_embeddings))]
+
+def retrieve_many(queries, top_k, filters=None, shards=None):
+    """
+    Retrieves the closest sentences for many queries at once. Queries missing from the
+    result cache are encoded in one batch and searched with one index.search call per shard.
+
+    Args:
+        queries (list[str]): The query texts.
+        top_k (int): Number of closest matches to retrieve per query.
+        filters (dict, optional): Metadata filters applied to every query, see search().
+        shards (list[str], optional): Shards to search, see search().
+
+    Returns:
+        list[list[dict]]: The results of each query, in the same order as queries.
+    """
+    filter_key = normalize_filters(filters)
+    shards = select_shards(shards)
+    keys = [(normalize_query(query), top_k, filter_key, shards) for query in queries]
+    results = [_result_cache.get(key) for key in keys]
+
+    missing = {key: query for key, query, result in zip(keys, queries, results) if result is None}
+    if missing:
+        searched = dict(zip(missing, search(encode(list(missing.values())), top_k, filters, shards)))
+        for key, hits in searched.items():
+            _result_cache.put(key, hits)
+        results = [searched[key] if result is None else result for key, result in zip(keys, results)]
 
-    # number of closest matches to retrieve
-    # top_k = 10
+    # copy so callers cannot modify the cached results
+    return [[dict(hit) for hit in hits] for hits in results]
 
-    # search
-    distances, indices = index.search(query_embedding.reshape(1, -1), top_k)
+def retrieve(query, top_k, filters=None, shards=None):
+    """
+    Retrieves the top_k sentences closest to a single query from the selected shards,
+    optionally restricted by metadata filters (see search()).
+    """
+    return retrieve_many([query], top_k, filters, shards)[0]
 
-    results = []
-    for i, idx in enumerate(indices[0]):
-        results.append({
-            "sentence": metadata.iloc[idx]['Sentence'],
-            "story_title": metadata.iloc[idx]['StoryTitle'],
-            "distance": distances[0][i],
-        })
-    return results
+########################################
+#################### RETRIEVAL SERVER
+########################################
 
+# With a shared retrieval_server.py, the public functions above are replaced by
+# clients of the server, and this process never loads the resources itself
+if os.environ.get('RETRIEVAL_SERVER_URL') or os.environ.get('RETRIEVAL_SERVER_SOCKET'):
+    from retrieval_client import (
+        available_shards, cache_stats, default_shards, embedding_dimension, encode, is_ready, load_errors, load_times, retrieve,
+        retrieve_many, search, warm_up,
+    )
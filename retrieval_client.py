@@ -0,0 +1,151 @@
+"""
+Client side of retrieval_server.py, with the same functions as retrieval.py.
+
+retrieval.py re-exports these functions when RETRIEVAL_SERVER_URL (e.g.
+http://127.0.0.1:8765) or RETRIEVAL_SERVER_SOCKET (a Unix socket path) is set, so
+notepad.py talks to the shared server without any change and the worker process
+never loads the model, index or metadata itself.
+"""
+import os
+
+import httpx
+import numpy as np
+
+SERVER_URL = os.environ.get('RETRIEVAL_SERVER_URL', '')
+SERVER_SOCKET = os.environ.get('RETRIEVAL_SERVER_SOCKET', '')
+SERVER_TIMEOUT_SECONDS = float(os.environ.get('RETRIEVAL_SERVER_TIMEOUT_SECONDS', 30))
+
+_client = None
+_shards = None
+_dimension = None
+_ready_health = None
+
+def _http():
+    # One pooled client per process; httpx clients are thread-safe
+    global _client
+    if _client is None:
+        if SERVER_SOCKET:
+            _client = httpx.Client(base_url="http://retrieval", transport=httpx.HTTPTransport(uds=SERVER_SOCKET), timeout=SERVER_TIMEOUT_SECONDS)
+        else:
+            _client = httpx.Client(base_url=SERVER_URL, timeout=SERVER_TIMEOUT_SECONDS)
+    return _client
+
+def _request(method, path, payload=None):
+    response = _http().request(method, path, json=payload)
+    if response.status_code == 400:
+        raise ValueError(response.json()["error"])
+    if response.status_code != 200:
+        raise RuntimeError(f"Retrieval server error on {path}: {response.text}")
+    return response.json()
+
+def _health():
+    try:
+        return _request("GET", "/health")
+    except (httpx.HTTPError, RuntimeError) as e:
+        return {"ready": False, "load_times": {}, "load_errors": {"server": e}, "cache_stats": {}}
+
+def _load_status():
+    # The app checks readiness on every rerun; once the server has reported ready its
+    # resources stay loaded, so that answer is kept and the server is no longer polled
+    global _ready_health
+    if _ready_health is not None:
+        return _ready_health
+    health = _health()
+    if health["ready"]:
+        _ready_health = health
+    return health
+
+def _with_numpy_distances(results):
+    return [[{**hit, "distance": np.float32(hit["distance"])} for hit in hits] for hits in results]
+
+def warm_up():
+    """
+    The server loads its resources at startup; nothing to do in the worker.
+    """
+
+def is_ready():
+    """
+    Returns True once the server has finished loading its resources.
+    """
+    return _load_status()["ready"]
+
+def load_errors():
+    """
+    Returns the server's load errors, or the connection error if it is unreachable.
+    Once the server has reported ready, returns the errors it reported then.
+    """
+    return _load_status()["load_errors"]
+
+def load_times():
+    """
+    Returns the server's load time in seconds of each resource.
+    """
+    return _health()["load_times"]
+
+def _shard_names():
+    # The server's shards only change when it restarts, so they are fetched once
+    global _shards
+    if _shards is None:
+        health = _health()
+        if "shards" not in health:
+            # unreachable; try again on the next call
+            return {"available": [], "default": []}
+        _shards = health["shards"]
+    return _shards
+
+def available_shards():
+    """
+    Returns the names of the server's shards that can be selected for retrieval.
+    """
+    return list(_shard_names()["available"])
+
+def default_shards():
+    """
+    Returns the names of the shards the server searches when a call selects none.
+    """
+    return list(_shard_names()["default"])
+
+def cache_stats():
+    """
+    Returns the counters of the server's embedding, result and filter caches.
+    """
+    return _health()["cache_stats"]
+
+def encode(texts):
+    """
+    Embeds a batch of texts on the server, see retrieval.encode.
+    """
+    response = _request("POST", "/encode", {"texts": list(texts)})
+    return np.asarray(response["embeddings"], dtype=np.float32).reshape(-1, response["dimension"])
+
+def embedding_dimension():
+    """
+    Returns the dimension of the server's embeddings, asked for once per process.
+    """
+    global _dimension
+    if _dimension is None:
+        _dimension = encode([]).shape[1]
+    return _dimension
+
+def search(query_embeddings, top_k, filters=None, shards=None):
+    """
+    Searches the server's shards with a batch of query embeddings, see retrieval.search.
+    """
+    if len(query_embeddings) == 0:
+        return []
+    embeddings = np.asarray(query_embeddings, dtype=np.float32).tolist()
+    payload = {"embeddings": embeddings, "top_k": top_k, "filters": filters, "shards": shards}
+    return _with_numpy_distances(_request("POST", "/search", payload)["results"])
+
+def retrieve_many(queries, top_k, filters=None, shards=None):
+    """
+    Retrieves the closest sentences for many queries on the server, see retrieval.retrieve_many.
+    """
+    payload = {"queries": list(queries), "top_k": top_k, "filters": filters, "shards": shards}
+    return _with_numpy_distances(_request("POST", "/retrieve", payload)["results"])
+
+def retrieve(query, top_k, filters=None, shards=None):
+    """
+    Retrieves the top_k sentences closest to a single query on the server.
+    """
+    return retrieve_many([query], top_k, filters, shards)[0]
@@ -0,0 +1,256 @@
+"""
+Local retrieval server shared by several Streamlit worker processes.
+
+Each worker that imports retrieval.py loads its own copy of the model, index and
+metadata. This server holds a single copy and serves them over localhost HTTP or a
+Unix socket; workers started with RETRIEVAL_SERVER_URL or RETRIEVAL_SERVER_SOCKET
+use it through retrieval_client.py without any change to notepad.py. Concurrent
+requests are gathered into micro-batches, so the queries of many sessions share one
+encoder forward pass and one index.search call.
+
+Endpoints (JSON bodies):
+    POST /encode    {"texts"}                       -> {"embeddings", "dimension"}
+    POST /search    {"embeddings", "top_k", "filters", "shards"}  -> {"results"}
+    POST /retrieve  {"queries", "top_k", "filters", "shards"}     -> {"results"}
+    GET  /health    -> {"ready", "load_times", "load_errors", "cache_stats", "shards", "batches"}
+
+Usage:
+    python retrieval_server.py --port 8765                     # RETRIEVAL_SERVER_URL=http://127.0.0.1:8765
+    python retrieval_server.py --socket /tmp/retrieval.sock    # RETRIEVAL_SERVER_SOCKET=/tmp/retrieval.sock
+"""
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# The server itself must use the local resources, never another server
+os.environ.pop('RETRIEVAL_SERVER_URL', None)
+os.environ.pop('RETRIEVAL_SERVER_SOCKET', None)
+import retrieval
+from metadata_filters import normalize_filters
+
+class MicroBatcher:
+    """
+    Gathers concurrent calls into batches processed by a single worker thread. A batch
+    is closed when it holds max_batch_size items or max_wait_ms after its first item.
+
+    Args:
+        name (str): Name used in the stats.
+        process_batch (callable): Maps a list of items to a list of results, in order.
+        max_batch_size (int): Maximum number of items per batch.
+        max_wait_ms (float): Longest time the first item of a batch waits for others.
+    """
+    def __init__(self, name, process_batch, max_batch_size=64, max_wait_ms=5):
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True).start()
+
+    def __call__(self, item):
+        """
+        Submits an item and blocks until its batch has been processed.
+        """
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            items, futures = zip(*batch)
+            try:
+                results = self.process_batch(list(items))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(items)
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+########################################
+#################### BATCHED OPERATIONS
+########################################
+
+def encode_batch(items):
+    # items: lists of texts; one encoder call for all of them
+    texts = [text for item in items for text in item]
+    embeddings = retrieval.encode(texts)
+    bounds = np.cumsum([0] + [len(item) for item in items])
+    return [embeddings[bounds[i]:bounds[i + 1]] for i in range(len(items))]
+
+def _grouped(items, run):
+    # items: (payload, top_k, filters, shards); one call per distinct (top_k, filters, shards)
+    groups = defaultdict(list)
+    for position, (_, top_k, filters, shards) in enumerate(items):
+        groups[(top_k, normalize_filters(filters), retrieval.select_shards(shards))].append(position)
+    results = [None] * len(items)
+    for (top_k, _, shards), positions in groups.items():
+        filters = items[positions[0]][2]
+        for position, result in zip(positions, run([items[p][0] for p in positions], top_k, filters, shards)):
+            results[position] = result
+    return results
+
+def search_batch(items):
+    def run(payloads, top_k, filters, shards):
+        hits = retrieval.search(np.concatenate(payloads), top_k, filters, shards)
+        bounds = np.cumsum([0] + [len(payload) for payload in payloads])
+        return [hits[bounds[i]:bounds[i + 1]] for i in range(len(payloads))]
+    return _grouped(items, run)
+
+def retrieve_batch(items):
+    def run(payloads, top_k, filters, shards):
+        hits = retrieval.retrieve_many([query for payload in payloads for query in payload], top_k, filters, shards)
+        bounds = np.cumsum([0] + [len(payload) for payload in payloads])
+        return [hits[bounds[i]:bounds[i + 1]] for i in range(len(payloads))]
+    return _grouped(items, run)
+
+def _jsonable_hits(results):
+    return [[{**hit, "distance": float(hit["distance"])} for hit in hits] for hits in results]
+
+########################################
+#################### HTTP SERVER
+########################################
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    batchers = {}
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._reply(404, {"error": f"Unknown path {self.path}"})
+        self._reply(200, {
+            "ready": retrieval.is_ready(),
+            "load_times": retrieval.load_times(),
+            "load_errors": {name: repr(error) for name, error in retrieval.load_errors().items()},
+            "cache_stats": retrieval.cache_stats(),
+            "shards": {"available": retrieval.available_shards(), "default": retrieval.default_shards()},
+            "batches": {name: batcher.stats() for name, batcher in self.batchers.items()},
+        })
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            # reject invalid filters and shards here rather than failing the whole batch
+            normalize_filters(request.get("filters"))
+            retrieval.select_shards(request.get("shards"))
+            if self.path == "/encode":
+                embeddings = self.batchers["encode"](request["texts"])
+                return self._reply(200, {"embeddings": embeddings.tolist(), "dimension": embeddings.shape[1]})
+            if self.path == "/search":
+                if not request["embeddings"]:
+                    return self._reply(200, {"results": []})
+                embeddings = np.asarray(request["embeddings"], dtype=np.float32).reshape(len(request["embeddings"]), -1)
+                results = self.batchers["search"]((embeddings, request["top_k"], request.get("filters"), request.get("shards")))
+                return self._reply(200, {"results": _jsonable_hits(results)})
+            if self.path == "/retrieve":
+                results = self.batchers["retrieve"]((request["queries"], request["top_k"], request.get("filters"), request.get("shards")))
+                return self._reply(200, {"results": _jsonable_hits(results)})
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+        except (KeyError, ValueError) as e:
+            self._reply(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+# Many workers may connect at once; the socketserver default backlog is 5
+LISTEN_BACKLOG = 128
+
+class RetrievalHTTPServer(ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+def serve(host='127.0.0.1', port=8765, socket_path=None, max_batch_size=64, max_wait_ms=5):
+    """
+    Loads the retrieval resources and serves them until interrupted.
+
+    Args:
+        host (str): Address to listen on for HTTP.
+        port (int): Port to listen on for HTTP.
+        socket_path (str, optional): Listen on this Unix socket instead.
+        max_batch_size (int): Maximum number of requests per micro-batch.
+        max_wait_ms (float): Longest time a request waits for others to join its batch.
+    """
+    RetrievalHandler.batchers = {
+        "encode": MicroBatcher("encode", encode_batch, max_batch_size, max_wait_ms),
+        "search": MicroBatcher("search", search_batch, max_batch_size, max_wait_ms),
+        "retrieve": MicroBatcher("retrieve", retrieve_batch, max_batch_size, max_wait_ms),
+    }
+    retrieval.warm_up()
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RetrievalHandler)
+        print(f"Retrieval server listening on {socket_path}")
+    else:
+        server = RetrievalHTTPServer((host, port), RetrievalHandler)
+        print(f"Retrieval server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve retrieval to several Streamlit workers from one process.")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on.")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on.")
+    parser.add_argument('--socket', help="Listen on this Unix socket instead of HTTP.")
+    parser.add_argument('--max-batch', type=int, default=64, help="Maximum requests per micro-batch.")
+    parser.add_argument('--max-wait-ms', type=float, default=5, help="Longest wait for a micro-batch to fill.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    serve(args.host, args.port, args.socket, args.max_batch, args.max_wait_ms)
@@ -0,0 +1,254 @@
+"""
+Optional SQLite-backed store of each user's session: notepad, characters, feedback
+history and chat history.
+
+Without it, all of a user's work lives in Streamlit's in-process session_state and is
+lost when the worker restarts. With SESSION_STORE_PATH set, every session gets an id
+kept in the page URL (?session=...), and its state is saved to a local SQLite
+database and restored when the URL is opened again, in a new session or after a
+restart.
+
+Writes are write-behind: save() and save_message() only record the latest value of
+each key in memory, and a background thread writes everything pending in a single
+transaction every SESSION_STORE_FLUSH_SECONDS. Repeated edits of the notepad between
+two flushes cost one row write. The chat history is paged: a resumed session loads
+the latest page of it, and earlier messages stay in the database until the user asks
+for them. The notepad, characters and feedback history are loaded whole and stay in
+session_state while the session is open, since the app's widgets are bound to them.
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from chat_log import CHAT_MEMORY_MESSAGES, ChatLog
+
+SESSION_STORE_PATH = os.environ.get('SESSION_STORE_PATH', '')
+SESSION_STORE_FLUSH_SECONDS = float(os.environ.get('SESSION_STORE_FLUSH_SECONDS', 1.0))
+
+class SessionStore:
+    """
+    Write-behind store of session values and chat messages, safe to share between threads.
+
+    Args:
+        path (str): Path of the SQLite database file.
+        flush_seconds (float): Interval between writes of the pending changes.
+    """
+    def __init__(self, path=SESSION_STORE_PATH, flush_seconds=SESSION_STORE_FLUSH_SECONDS):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.flushes = 0
+        self.rows_written = 0
+        # _lock guards the pending changes, _db_lock the connection; saves never wait for a write
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._pending_values = {}
+        self._pending_messages = {}
+        # changes being written, still visible to reads until committed
+        self._flushing_values = {}
+        self._flushing_messages = {}
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS session_values ("
+                " session_id TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " updated REAL NOT NULL,"
+                " PRIMARY KEY (session_id, key))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS chat_messages ("
+                " session_id TEXT NOT NULL,"
+                " position INTEGER NOT NULL,"
+                " message TEXT NOT NULL,"
+                " PRIMARY KEY (session_id, position))"
+            )
+        self._stopped = threading.Event()
+        threading.Thread(target=self._run, name="session-store-flush", daemon=True).start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Session store flush failed: {e}")
+
+    def flush(self):
+        """
+        Writes all pending changes in one transaction.
+        """
+        with self._db_lock:
+            with self._lock:
+                values, self._pending_values = self._pending_values, {}
+                messages, self._pending_messages = self._pending_messages, {}
+                self._flushing_values, self._flushing_messages = values, messages
+            if not values and not messages:
+                return
+            now = time.time()
+            try:
+                with self._connection:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO session_values (session_id, key, value, updated) VALUES (?, ?, ?, ?)",
+                        [(session_id, key, value, now) for (session_id, key), value in values.items()]
+                    )
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO chat_messages (session_id, position, message) VALUES (?, ?, ?)",
+                        [(session_id, position, message) for (session_id, position), message in messages.items()]
+                    )
+            except sqlite3.Error:
+                # keep the changes for the next flush, unless newer ones replaced them
+                with self._lock:
+                    self._pending_values = {**values, **self._pending_values}
+                    self._pending_messages = {**messages, **self._pending_messages}
+                raise
+            finally:
+                with self._lock:
+                    self._flushing_values, self._flushing_messages = {}, {}
+            self.flushes += 1
+            self.rows_written += len(values) + len(messages)
+
+    def close(self):
+        """
+        Stops the background thread and writes the pending changes.
+        """
+        self._stopped.set()
+        self.flush()
+
+    def save(self, session_id, key, value):
+        """
+        Schedules a JSON-serializable value of a session for writing.
+        """
+        encoded = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._pending_values[(session_id, key)] = encoded
+
+    def load(self, session_id, key, default=None):
+        """
+        Returns a value of a session, including one not yet written, or default.
+        """
+        with self._lock:
+            encoded = self._pending_values.get((session_id, key), self._flushing_values.get((session_id, key)))
+        if encoded is None:
+            with self._db_lock:
+                row = self._connection.execute(
+                    "SELECT value FROM session_values WHERE session_id = ? AND key = ?", (session_id, key)
+                ).fetchone()
+            encoded = row[0] if row is not None else None
+        return json.loads(encoded) if encoded is not None else default
+
+    def save_message(self, session_id, position, message):
+        """
+        Schedules a chat message of a session for writing at its position in the history.
+        """
+        encoded = json.dumps(message, ensure_ascii=False)
+        with self._lock:
+            self._pending_messages[(session_id, position)] = encoded
+
+    def message_count(self, session_id):
+        """
+        Returns the number of chat messages of a session.
+        """
+        with self._db_lock:
+            count = self._connection.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM chat_messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            unwritten = self._unwritten_messages(session_id)
+        return max([count] + [position + 1 for position in unwritten])
+
+    def _unwritten_messages(self, session_id):
+        # Messages of a session not yet committed, newest version of each position;
+        # called with _db_lock held so that no flush commits them in between
+        with self._lock:
+            return {
+                position: message
+                for changes in (self._flushing_messages, self._pending_messages)
+                for (pending_id, position), message in changes.items()
+                if pending_id == session_id
+            }
+
+    def messages(self, session_id, start, stop):
+        """
+        Returns the chat messages of a session with positions in [start, stop).
+        """
+        with self._db_lock:
+            rows = dict(self._connection.execute(
+                "SELECT position, message FROM chat_messages WHERE session_id = ? AND position >= ? AND position < ?",
+                (session_id, start, stop)
+            ).fetchall())
+            unwritten = self._unwritten_messages(session_id)
+        for position, message in unwritten.items():
+            if start <= position < stop:
+                rows[position] = message
+        return [json.loads(rows[position]) for position in sorted(rows)]
+
+    def stats(self):
+        """
+        Returns the number of flushes, rows written and changes waiting to be written.
+        """
+        with self._lock:
+            return {
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "pending": len(self._pending_values) + len(self._pending_messages),
+            }
+
+class SessionChatLog(ChatLog):
+    """
+    ChatLog whose messages are all saved in a SessionStore, and whose older messages
+    are read back from it instead of a spill file. Opening it loads only the latest
+    max_in_memory messages.
+
+    Args:
+        store (SessionStore): The store.
+        session_id (str): The session whose history this is.
+        max_in_memory (int): Number of most recent messages kept in memory (at least 1).
+    """
+    def __init__(self, store, session_id, max_in_memory=CHAT_MEMORY_MESSAGES):
+        super().__init__(max_in_memory)
+        self.store = store
+        self.session_id = session_id
+        count = store.message_count(session_id)
+        self._spilled = max(count - self.max_in_memory, 0)
+        self._recent = store.messages(session_id, self._spilled, count)
+
+    @property
+    def spilled(self):
+        return self._spilled
+
+    def _spill(self, messages):
+        # Already saved by append(); they only leave memory
+        self._spilled += len(messages)
+
+    def _read_spilled(self, start, stop):
+        return self.store.messages(self.session_id, start, stop) if start < stop else []
+
+    def append(self, message):
+        self.store.save_message(self.session_id, len(self), message)
+        super().append(message)
+
+    def update(self, position, **fields):
+        if position < 0:
+            position += len(self)
+        message = super().update(position, **fields)
+        self.store.save_message(self.session_id, position, message)
+        return message
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    Returns the process-wide SessionStore, or None if SESSION_STORE_PATH is not set.
+    """
+    global _store
+    if not SESSION_STORE_PATH:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore()
+        return _store
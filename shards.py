@@ -0,0 +1,58 @@
+"""
+Layout of the corpus shards built by preprocessing.py and searched by retrieval.py.
+
+Each corpus is a shard with its own FAISS index, metadata and filter index. The
+ROCStories corpus is the default shard and keeps the top-level files it always had;
+every other corpus is built with `preprocessing.py <dataset> --shard <name>` into
+
+    shards/<name>/faiss_index
+    shards/<name>/metadata.csv
+    shards/<name>/metadata_store/     (with its metadata filter index)
+    shards/<name>/build/              work directory: embeddings.f32, checkpoint.json
+"""
+import os
+import re
+
+DEFAULT_SHARD = 'rocstories'
+SHARD_DIR = os.environ.get('RETRIEVAL_SHARD_DIR', 'shards')
+
+# Shard names become directory names
+_SHARD_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+def shard_paths(name):
+    """
+    Returns where a shard's files are built and loaded from.
+
+    Args:
+        name (str): The shard name, e.g. 'cloze_val'.
+
+    Returns:
+        dict: The "index_file", "metadata_file", "metadata_store" and "work_dir" paths.
+    """
+    if not _SHARD_NAME.match(name):
+        raise ValueError(f"Invalid shard name '{name}'. Use letters, digits, '_' and '-'.")
+    if name == DEFAULT_SHARD:
+        return {
+            'index_file': 'faiss_index',
+            'metadata_file': 'metadata.csv',
+            'metadata_store': 'metadata_store',
+            'work_dir': 'build',
+        }
+    directory = os.path.join(SHARD_DIR, name)
+    return {
+        'index_file': os.path.join(directory, 'faiss_index'),
+        'metadata_file': os.path.join(directory, 'metadata.csv'),
+        'metadata_store': os.path.join(directory, 'metadata_store'),
+        'work_dir': os.path.join(directory, 'build'),
+    }
+
+def built_shards():
+    """
+    Returns the names of the shards whose index has been built, the default shard first.
+    """
+    names = [DEFAULT_SHARD] if os.path.exists(shard_paths(DEFAULT_SHARD)['index_file']) else []
+    if os.path.isdir(SHARD_DIR):
+        for name in sorted(os.listdir(SHARD_DIR)):
+            if name != DEFAULT_SHARD and _SHARD_NAME.match(name) and os.path.exists(shard_paths(name)['index_file']):
+                names.append(name)
+    return names
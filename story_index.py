@@ -0,0 +1,230 @@
+"""
+Live, per-story index of the user's own sentences.
+
+The FAISS index built by preprocessing.py only covers ROCStories. A StoryIndex
+holds the sentences of the user's story (the notepad and accepted chat responses)
+in a small IndexIDMap2 over an exact flat index, so sentences are added and removed
+one by one as the text changes, without a rebuild. Story indexes are private to the
+session that writes them. A session that can be resumed (see session_store.py) saves
+its index to disk after every change, so it is reopened with the session; otherwise
+the index lives in memory only. Its results use the same embeddings and L2 distance
+as the global index, so merge_results() ranks both in one list.
+
+Layout of a story index directory (STORY_INDEX_ROOT/<session key>/<story key>/):
+    index.faiss     IndexIDMap2 over IndexFlatL2 with the ids below
+    sentences.json  id -> [sentence, source], the next id to assign, and the marks
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+
+import faiss
+import numpy as np
+
+STORY_INDEX_ROOT = os.environ.get('STORY_INDEX_DIR', 'story_indexes')
+
+INDEX_FILE = 'index.faiss'
+SENTENCES_FILE = 'sentences.json'
+
+def story_key(name):
+    """
+    Returns the directory name of a story: a readable slug plus a hash of the exact name.
+    """
+    slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')[:40] or 'untitled'
+    return f"{slug}-{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}"
+
+class StoryIndex:
+    """
+    Incrementally updated index of one story's sentences, safe to share between threads.
+
+    Args:
+        name (str): The story name, shown as the story title of its results.
+        directory (str): Directory the index is loaded from and saved to, or None to
+            keep it in memory only.
+        dimension (int): Embedding dimension, used when the index is new.
+
+    Attributes:
+        marks (dict): Progress markers saved with the index, e.g. how many spilled chat
+            messages have been indexed; see set_mark().
+    """
+    def __init__(self, name, directory, dimension):
+        self.name = name
+        self.directory = directory
+        self.marks = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._entries = {}
+        self._ids = {}
+        self._next_id = 0
+
+        index_path = os.path.join(directory or '', INDEX_FILE)
+        sentences_path = os.path.join(directory or '', SENTENCES_FILE)
+        if directory is not None and os.path.exists(index_path) and os.path.exists(sentences_path):
+            self.index = faiss.read_index(index_path)
+            with open(sentences_path, encoding='utf-8') as f:
+                saved = json.load(f)
+            self._next_id = saved['next_id']
+            self.marks = saved.get('marks', {})
+            # the two files are replaced one after the other; keep what both agree on
+            indexed = set(faiss.vector_to_array(self.index.id_map).tolist())
+            self._entries = {int(i): tuple(entry) for i, entry in saved['sentences'].items() if int(i) in indexed}
+            stale = np.array(sorted(indexed - set(self._entries)), dtype=np.int64)
+            if len(stale):
+                self.index.remove_ids(stale)
+            self._ids = {entry: i for i, entry in self._entries.items()}
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, sentences, embeddings, source):
+        """
+        Adds sentences with their embeddings; sentences already indexed for source are skipped.
+
+        Args:
+            sentences (list[str]): The sentences.
+            embeddings (np.ndarray): float32 array of shape (len(sentences), dimension).
+            source (str): Where the sentences come from, e.g. "notepad" or "chat".
+
+        Returns:
+            int: The number of sentences added.
+        """
+        with self._lock:
+            new = [i for i, sentence in enumerate(sentences) if (sentence, source) not in self._ids]
+            if not new:
+                return 0
+            ids = np.arange(self._next_id, self._next_id + len(new), dtype=np.int64)
+            self.index.add_with_ids(np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32)[new]), ids)
+            for i, position in zip(ids.tolist(), new):
+                self._entries[i] = (sentences[position], source)
+                self._ids[(sentences[position], source)] = i
+            self._next_id += len(new)
+            return len(new)
+
+    def remove(self, sentences, source):
+        """
+        Removes sentences of a source from the index.
+
+        Returns:
+            int: The number of sentences removed.
+        """
+        with self._lock:
+            ids = [self._ids.pop((sentence, source)) for sentence in set(sentences) if (sentence, source) in self._ids]
+            if not ids:
+                return 0
+            for i in ids:
+                del self._entries[i]
+            self.index.remove_ids(np.array(ids, dtype=np.int64))
+            return len(ids)
+
+    def sync(self, source, sentences, encode, previous=()):
+        """
+        Updates the sentences of a source to match the current text: sentences not yet
+        indexed are encoded and added, and sentences in previous that are gone are
+        removed. Sentences indexed in earlier sessions are kept unless this session saw
+        them removed. Saves the index if anything changed.
+
+        Args:
+            source (str): Where the sentences come from, e.g. "notepad" or "chat".
+            sentences (list[str]): The source's current sentences.
+            encode (callable): Maps a list of strings to an (n, dimension) array, e.g. retrieval.encode.
+            previous (set[str]): The source's sentences at the previous sync of this session.
+
+        Returns:
+            set[str]: The current sentences, to pass as previous next time.
+        """
+        current = set(sentences)
+        with self._lock:
+            new = [sentence for sentence in dict.fromkeys(sentences) if (sentence, source) not in self._ids]
+        changed = self.remove(set(previous) - current, source)
+        if new:
+            changed += self.add(new, encode(new), source)
+        if changed:
+            self.save()
+        return current
+
+    def set_mark(self, key, value):
+        """
+        Records a progress marker, e.g. up to where an append-only source has been
+        indexed, and saves the index with it.
+        """
+        with self._lock:
+            self.marks[key] = value
+        self.save()
+
+    def search(self, query_embeddings, top_k, exclude=()):
+        """
+        Searches the story's sentences.
+
+        Args:
+            query_embeddings (np.ndarray): float32 array of shape (n_queries, dimension).
+            top_k (int): Number of results per query.
+            exclude (set[str]): Sentences to leave out, e.g. the ones the query was built from.
+
+        Returns:
+            list[list[dict]]: For each query, results with "sentence", "story_title",
+            "distance" and "source", like retrieval.search.
+        """
+        results = [[] for _ in range(len(query_embeddings))]
+        with self._lock:
+            if not self._entries:
+                return results
+            n_candidates = min(top_k + len(exclude), len(self._entries))
+            distances, ids = self.index.search(np.ascontiguousarray(query_embeddings, dtype=np.float32), n_candidates)
+            for hits, row_distances, row_ids in zip(results, distances, ids):
+                for distance, i in zip(row_distances, row_ids.tolist()):
+                    if i < 0 or len(hits) == top_k or self._entries[i][0] in exclude:
+                        continue
+                    sentence, source = self._entries[i]
+                    hits.append({"sentence": sentence, "story_title": self.name, "distance": distance, "source": source})
+        return results
+
+    def save(self):
+        """
+        Writes the index and its sentences to the story's directory, if it has one.
+        """
+        if self.directory is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                index_bytes = faiss.serialize_index(self.index).tobytes()
+                saved = {
+                    'next_id': self._next_id,
+                    'sentences': {str(i): list(entry) for i, entry in self._entries.items()},
+                    'marks': dict(self.marks),
+                }
+            os.makedirs(self.directory, exist_ok=True)
+            for file_name, data in ((SENTENCES_FILE, json.dumps(saved).encode('utf-8')), (INDEX_FILE, index_bytes)):
+                path = os.path.join(self.directory, file_name)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+
+def open_story_index(name, dimension, session_id=None):
+    """
+    Opens a session's index of a story. Each call returns a new StoryIndex; the
+    caller keeps it for the session.
+
+    Args:
+        name (str): The story name.
+        dimension (int): Embedding dimension, used when the story has no index yet.
+        session_id (str, optional): Id of a resumable session: the index is loaded from
+            and saved to a directory of that session. Without it, the index is kept in
+            memory only.
+    """
+    if session_id is None:
+        return StoryIndex(name, None, dimension)
+    # session ids come from the URL; hash them rather than use them as a path
+    session_key = hashlib.sha1(session_id.encode('utf-8')).hexdigest()[:16]
+    return StoryIndex(name, os.path.join(STORY_INDEX_ROOT, session_key, story_key(name)), dimension)
+
+def merge_results(result_lists, top_k):
+    """
+    Merges result lists of the same query (e.g. from the global and the story index)
+    into one list of the top_k results by distance.
+    """
+    merged = [hit for hits in result_lists for hit in hits]
+    return sorted(merged, key=lambda hit: hit["distance"])[:top_k]
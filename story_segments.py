@@ -0,0 +1,93 @@
+"""
+Incremental, sentence-level embeddings of the notepad for autocomplete retrieval.
+
+Instead of embedding the whole notepad on every Autocomplete click (which the model
+truncates at its token limit), the text is split into sentences, long sentences are
+split further into word windows, and each segment's embedding is kept per session.
+Only new or edited segments are encoded. The retrieval query is a recency-weighted
+mean of the most recent segments, so latency stays flat as the story grows.
+"""
+import re
+
+import numpy as np
+
+# Sentences end at ., ! or ? (plus closing quotes/brackets) or at a line break
+SENTENCE_PATTERN = re.compile(r'[^.!?\n]*(?:[.!?]+["\'”’)\]]*|\n|$)')
+
+# Segments longer than this are split into windows, well below the model's 256 token limit
+MAX_SEGMENT_WORDS = 100
+
+# Number of trailing segments that drive retrieval, and the weight lost per step back
+RECENT_SEGMENTS = 8
+RECENCY_DECAY = 0.7
+
+def split_segments(text, max_words=MAX_SEGMENT_WORDS):
+    """
+    Splits text into sentences, and sentences longer than max_words into word windows.
+
+    Args:
+        text (str): The notepad text.
+        max_words (int): Maximum number of words per segment.
+
+    Returns:
+        list[str]: The non-empty segments, in order.
+    """
+    segments = []
+    for match in SENTENCE_PATTERN.finditer(text):
+        words = match.group().split()
+        for start in range(0, len(words), max_words):
+            segments.append(" ".join(words[start:start + max_words]))
+    return segments
+
+def recency_weights(n_segments, decay=RECENCY_DECAY):
+    """
+    Weights for the last n_segments segments, oldest first, with the newest weighted 1.
+    """
+    return decay ** np.arange(n_segments - 1, -1, -1, dtype=np.float32)
+
+class SegmentEmbeddings:
+    """
+    Per-session cache of segment embeddings, meant to live in st.session_state.
+    """
+    def __init__(self):
+        self._embeddings = {}
+
+    def __len__(self):
+        return len(self._embeddings)
+
+    def query_embedding(self, text, encode, recent=RECENT_SEGMENTS, decay=RECENCY_DECAY):
+        """
+        Builds a retrieval query from the most recent segments of the text, encoding
+        only those segments that have not been encoded before. Embeddings of segments
+        no longer in the text are dropped.
+
+        Args:
+            text (str): The current notepad text.
+            encode (callable): Maps a list of strings to an (n, dimension) array,
+                e.g. retrieval.encode.
+            recent (int): Number of trailing segments to combine.
+            decay (float): Weight multiplier per segment further back in the text.
+
+        Returns:
+            np.ndarray: A unit-length (1, dimension) float32 query, or None if the text is empty.
+        """
+        segments = split_segments(text)
+        if not segments:
+            self._embeddings = {}
+            return None
+
+        # earlier segments never affect the query, so only the tail is encoded
+        tail = segments[-recent:]
+        new_segments = list(dict.fromkeys(segment for segment in tail if segment not in self._embeddings))
+        if new_segments:
+            self._embeddings.update(zip(new_segments, encode(new_segments)))
+
+        present = set(segments)
+        self._embeddings = {segment: embedding for segment, embedding in self._embeddings.items() if segment in present}
+
+        embeddings = np.stack([self._embeddings[segment] for segment in tail])
+        query = recency_weights(len(tail), decay) @ embeddings
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        return query.astype(np.float32).reshape(1, -1)
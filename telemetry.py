@@ -0,0 +1,184 @@
+"""
+Lightweight per-stage latency instrumentation.
+
+A trace covers one user request (a chat turn, an autocomplete or a refinement) and
+collects the timing spans recorded while it is active on the current thread, e.g.
+query embedding, index search, metadata gathering, prompt construction, time to
+first token and the full stream. Finished traces are appended to a JSONL log, and
+every span also feeds a process-wide rolling window per stage from which
+p50/p95/p99 are computed.
+
+Usage:
+    with trace("chat") as current:
+        with span("index_search"):
+            index.search(...)
+
+    python telemetry.py traces.jsonl    # per-stage percentiles of a collected log
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# JSONL file finished traces are appended to; set to an empty string to disable
+TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH', 'traces.jsonl')
+
+# Number of most recent spans per stage used for the percentiles
+STAGE_WINDOW = int(os.environ.get('TRACE_STAGE_WINDOW', 1000))
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_log_lock = threading.Lock()
+_stage_durations = defaultdict(lambda: deque(maxlen=STAGE_WINDOW))
+
+class Trace:
+    """
+    The spans recorded during one request.
+
+    Args:
+        name (str): The request type, e.g. "chat".
+        attributes (dict): Extra fields written to the log.
+    """
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self.spans = []
+        self.total_ms = None
+
+    def to_dict(self):
+        return {
+            "trace": self.name,
+            "started": self.started,
+            "total_ms": self.total_ms,
+            "spans": self.spans,
+            **self.attributes,
+        }
+
+def current_trace():
+    """
+    Returns the trace active on this thread, or None.
+    """
+    return getattr(_local, "trace", None)
+
+def record(stage, seconds):
+    """
+    Records a duration for a stage, e.g. one measured without a span like time to first token.
+
+    Args:
+        stage (str): The stage name.
+        seconds (float): The duration.
+    """
+    ms = seconds * 1000
+    with _stats_lock:
+        _stage_durations[stage].append(ms)
+    active = current_trace()
+    if active is not None:
+        active.spans.append({"stage": stage, "ms": round(ms, 3)})
+
+@contextmanager
+def span(stage):
+    """
+    Times the enclosed block as a stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+@contextmanager
+def attach(active):
+    """
+    Records the spans of this thread into a trace started on another thread, e.g. in a
+    pool thread doing part of that request. Does nothing for None.
+
+    Args:
+        active (Trace): The trace, from current_trace() on the thread that started it.
+    """
+    previous = current_trace()
+    _local.trace = active
+    try:
+        yield active
+    finally:
+        _local.trace = previous
+
+@contextmanager
+def trace(name, **attributes):
+    """
+    Collects the spans recorded on this thread into a trace, which is logged on exit.
+    Nested traces are not supported: the inner one is ignored and its spans join the outer one.
+
+    Yields:
+        Trace: The active trace.
+    """
+    outer = current_trace()
+    if outer is not None:
+        yield outer
+        return
+
+    active = Trace(name, attributes)
+    _local.trace = active
+    start = time.perf_counter()
+    try:
+        yield active
+    finally:
+        _local.trace = None
+        active.total_ms = round((time.perf_counter() - start) * 1000, 3)
+        _write_log(active)
+
+def _write_log(finished):
+    if not TRACE_LOG_PATH:
+        return
+    line = json.dumps(finished.to_dict(), default=str)
+    try:
+        with _log_lock, open(TRACE_LOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"Could not write trace log: {e}")
+
+def stage_percentiles():
+    """
+    Returns per-stage latency percentiles over the most recent spans of this process.
+
+    Returns:
+        dict: stage -> {"count", "p50_ms", "p95_ms", "p99_ms"}.
+    """
+    with _stats_lock:
+        durations = {stage: list(values) for stage, values in _stage_durations.items() if values}
+    return _percentiles(durations)
+
+def _percentiles(durations):
+    return {
+        stage: {
+            "count": len(values),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)),
+        }
+        for stage, values in durations.items()
+    }
+
+def aggregate_log(path=TRACE_LOG_PATH):
+    """
+    Computes per-stage percentiles from a JSONL trace log, e.g. one collected in production.
+
+    Returns:
+        dict: stage -> {"count", "p50_ms", "p95_ms", "p99_ms"}.
+    """
+    durations = defaultdict(list)
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                for recorded in json.loads(line)["spans"]:
+                    durations[recorded["stage"]].append(recorded["ms"])
+    return _percentiles(durations)
+
+if __name__ == '__main__':
+    import sys
+    for stage, stats in aggregate_log(sys.argv[1] if len(sys.argv) > 1 else TRACE_LOG_PATH).items():
+        print(f"{stage:<22} n={stats['count']:<6} p50={stats['p50_ms']:.1f}ms  p95={stats['p95_ms']:.1f}ms  p99={stats['p99_ms']:.1f}ms")